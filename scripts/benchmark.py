@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+"""
+Hermetic benchmark of create-model-tree.py
+
+* Generate a synthetic repo of N stub libraries with synthrepo.py
+* Serve it from a local HTTP server
+* Put a stub `dnf` on PATH that answers `provides`, `download --url` and
+  the `repoquery` requires and sizes from an index of that repo, so the
+  dnf code path runs without a Fedora host or network access
+* Time a cold build (empty work directory) and a warm build (same work
+  directory again) for each size and mode, reading the time of each
+  stage (resolve, retrieve, unpack, model) from the --profile summary
+* Write a JSON report that can be compared between runs
+
+Modes:
+  dnf       resolve through the stub dnf
+  index     resolve through --repo-index
+  pipeline  --repo-index with --pipeline
+
+USAGE:
+    benchmark.py [--sizes 10,100,1000] [--modes dnf,index,pipeline] [--report <file>]
+    benchmark.py compare <old report> <new report>
+    benchmark.py serve [--port N] [--rate BYTES] [--drop-after BYTES] <dir>
+"""
+
+import argparse
+import functools
+import http.server
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import nevra
+import repodata
+import synthrepo
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+modes = ("dnf", "index", "pipeline")
+
+# profile spans that make up each stage of a phased and a pipelined build
+stage_spans = {
+    'resolve': ("resolve", "stage.resolve"),
+    'retrieve': ("retrieve", "stage.fetch"),
+    'unpack': ("unpack", "stage.unpack"),
+    'model': ("model", "stage.place"),
+}
+
+# environment variable naming the index the stub dnf answers from
+INDEX_ENV = "BENCHMARK_REPO_INDEX"
+
+# environment variable naming a file the stub dnf appends each command line to
+LOG_ENV = "BENCHMARK_DNF_LOG"
+
+
+# ------------------------------------------------------------------------------
+# Stub dnf
+# ------------------------------------------------------------------------------
+def stub_dnf(args):
+    """
+    Answer the dnf commands create-model-tree.py runs from a repo index.
+    Return the exit status.
+    """
+    if os.environ.get(LOG_ENV):
+        with open(os.environ[LOG_ENV], "a") as f:
+            f.write(json.dumps(args) + "\n")
+
+    index = repodata.RepoIndex(os.environ[INDEX_ENV])
+
+    words = []
+    flags = set()
+    arch = None
+    queryformat = None
+    skip = False
+    for (i, arg) in enumerate(args):
+        if skip:
+            skip = False
+        elif arg == "--urlprotocol":
+            skip = True
+        elif arg == "--queryformat":
+            (queryformat, skip) = (args[i + 1], True)
+        elif arg.startswith("--forcearch="):
+            arch = arg.partition("=")[2]
+        elif arg.startswith("-"):
+            flags.add(arg)
+        else:
+            words.append(arg)
+
+    if not words:
+        return 1
+    (command, keys) = (words[0], words[1:])
+
+    if command == "provides":
+        status = 0
+        for key in keys:
+            packages = [p for p in index.whatprovides(key) if arch is None or p['arch'] in (arch, "noarch")]
+            status = status or (0 if packages else 1)
+            for pkg in packages:
+                print(f"{pkg['nevra']} : {pkg['summary']}")
+                print(f"Repo         : {pkg['repo']}")
+                print(f"Matched From :")
+                print(f"Filename     : {key}")
+                print()
+        return status
+
+    if command == "download" and "--url" in flags:
+        for key in keys:
+            pkg = index.best(index.whatprovides(key) if key.startswith("/") else index.by_name(key), arch=arch)
+            if pkg is None:
+                print(f"No package {key} available.", file=sys.stderr)
+                return 1
+            for found in index.closure(pkg, arch=arch) if "--resolve" in flags else [pkg]:
+                print(index.url(found))
+        return 0
+
+    if command == "repoquery" and ("--requires" in flags or queryformat is not None):
+        for key in keys:
+            name = nevra.Nevra.parse(key).name
+            for pkg in index.by_name(name):
+                if pkg['nevra'] != key:
+                    continue
+                if "--requires" in flags:
+                    print("\n".join(pkg['requires']))
+                else:
+                    print(re.sub(r"%\{(\w+)\}", lambda m: str(pkg[{'downloadsize': 'size'}.get(m[1], m[1])]),
+                                 queryformat).replace("\\n", "\n"), end="")
+        return 0
+
+    print(f"stub dnf: unsupported command: {' '.join(args)}", file=sys.stderr)
+    return 1
+
+
+def write_stub_dnf(bin_dir, index_path):
+    """
+    Write an executable `dnf` that runs stub_dnf against an index
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, "dnf")
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\n")
+        f.write(f"{INDEX_ENV}='{os.path.abspath(index_path)}' "
+                f"exec '{sys.executable}' '{os.path.abspath(__file__)}' dnf \"$@\"\n")
+    os.chmod(path, 0o755)
+    return path
+
+
+# ------------------------------------------------------------------------------
+# Local repo server
+# ------------------------------------------------------------------------------
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serve files, answering Range requests. Responses can be throttled to
+    rate bytes a second or cut off after drop_after bytes, to stand in
+    for a slow or unreliable mirror. Each request's path and Range
+    header are appended to requests.
+    """
+
+    def __init__(self, *args, rate=None, drop_after=None, requests=None, **kwargs):
+        self._rate = rate
+        self._drop_after = drop_after
+        self._requests = requests
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._requests is not None and self._requests.append((self.path, self.headers.get("Range")))
+        path = self.translate_path(self.path)
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if not os.path.isfile(path) or (match is None and self._rate is None and self._drop_after is None):
+            return super().do_GET()
+
+        size = os.path.getsize(path)
+        start = int(match.group(1)) if match else 0
+        if start >= size and match:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size - start))
+        match and self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        self.end_headers()
+
+        with open(path, "rb") as f:
+            f.seek(start)
+            sent = 0
+            try:
+                for block in iter(lambda: f.read(64 * 1024), b""):
+                    if self._drop_after is not None and sent + len(block) > self._drop_after:
+                        self.wfile.write(block[:self._drop_after - sent])
+                        self.close_connection = True
+                        return
+                    self.wfile.write(block)
+                    sent += len(block)
+                    self._rate and time.sleep(len(block) / self._rate)
+            except (BrokenPipeError, ConnectionResetError):
+                # the client gave up on a slow transfer
+                self.close_connection = True
+
+
+class RepoServer(object):
+    """
+    Serve a directory over HTTP on a local port from a thread,
+    optionally throttled or dropping connections. requests lists the
+    (path, Range header) of every request served.
+    """
+
+    def __init__(self, directory, port=0, rate=None, drop_after=None):
+        self.requests = []
+        handler = functools.partial(_QuietHandler, directory=directory, rate=rate, drop_after=drop_after,
+                                    requests=self.requests)
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        (host, port) = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# ------------------------------------------------------------------------------
+# Runs
+# ------------------------------------------------------------------------------
+def build_command(mode, package, daemon, index_path, profile):
+    command = [sys.executable, os.path.join(script_dir, "create-model-tree.py"),
+               "--no-manifest", "--profile", profile, "--daemon-file", daemon]
+    if mode in ("index", "pipeline"):
+        command += ["--repo-index", index_path]
+    if mode == "pipeline":
+        command.append("--pipeline")
+    return command + [package]
+
+
+def stages(summary):
+    spans = summary['spans']
+    return {
+        stage: round(sum(spans[name]['total'] for name in names if name in spans), 6)
+        for (stage, names) in stage_spans.items()
+    }
+
+
+def run_build(command, run_dir, env, profile):
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=run_dir, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"build failed ({result.returncode}): {' '.join(command)}\n{result.stderr}")
+
+    with open(os.path.join(run_dir, f"{profile}.json")) as f:
+        summary = json.load(f)
+
+    return {
+        'wall': round(wall, 6),
+        'stages': stages(summary),
+        'counters': summary['counters'],
+    }
+
+
+def benchmark_size(workdir, size, run_modes, fanout, depth, padding, repeat, verbose=False):
+    """
+    Generate a repo of one size and time each mode on it
+    """
+    size_dir = os.path.join(workdir, f"size-{size}")
+    repo_dir = os.path.join(size_dir, "repo")
+    shutil.rmtree(size_dir, ignore_errors=True)
+
+    start = time.perf_counter()
+    (package, daemon) = synthrepo.generate(repo_dir, libraries=size, fanout=fanout, depth=depth, padding=padding)
+    generate_time = time.perf_counter() - start
+
+    results = []
+    with RepoServer(repo_dir) as server:
+        # the index is built from the server so that every URL is remote
+        index_path = os.path.join(size_dir, "repo.idx")
+        start = time.perf_counter()
+        repodata.build_index([repodata.Repository(server.url, workdir=os.path.join(size_dir, "repocache"))],
+                             index_path)
+        index_time = time.perf_counter() - start
+
+        env = dict(os.environ)
+        env['PATH'] = os.path.dirname(write_stub_dnf(os.path.join(size_dir, "bin"), index_path)) + \
+            os.pathsep + env.get('PATH', "")
+
+        for mode in run_modes:
+            for n in range(repeat):
+                run_dir = os.path.join(size_dir, f"{mode}-{n}")
+                os.makedirs(run_dir)
+                for phase in ("cold", "warm"):
+                    profile = f"profile-{phase}"
+                    command = build_command(mode, package, daemon, index_path, profile)
+                    verbose and print(f"size {size} {mode} {phase}: {' '.join(command)}")
+                    result = run_build(command, run_dir, env, profile)
+                    results.append(dict({'size': size, 'mode': mode, 'run': phase, 'repeat': n}, **result))
+                    verbose and print(f"  {result['wall']:.3f}s {result['stages']}")
+
+    return {
+        'size': size,
+        'generate': round(generate_time, 6),
+        'index': round(index_time, 6),
+        'results': results,
+    }
+
+
+def report_table(report):
+    lines = [f"{'size':>6} {'mode':<9} {'run':<5} {'wall':>8} " +
+             " ".join(f"{stage:>9}" for stage in stage_spans)]
+    for size in report['sizes']:
+        for result in size['results']:
+            lines.append(f"{result['size']:>6} {result['mode']:<9} {result['run']:<5} {result['wall']:>8.3f} " +
+                         " ".join(f"{result['stages'][stage]:>9.3f}" for stage in stage_spans))
+    return "\n".join(lines)
+
+
+def compare(old, new):
+    """
+    The change in wall time of each (size, mode, run) in both reports
+    """
+    def best(report):
+        times = {}
+        for size in report['sizes']:
+            for r in size['results']:
+                key = (r['size'], r['mode'], r['run'])
+                times[key] = min(times.get(key, r['wall']), r['wall'])
+        return times
+
+    (before, after) = (best(old), best(new))
+    lines = [f"{'size':>6} {'mode':<9} {'run':<5} {'old':>8} {'new':>8} {'change':>8}"]
+    for key in sorted(set(before) & set(after)):
+        change = (after[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+        lines.append(f"{key[0]:>6} {key[1]:<9} {key[2]:<5} {before[key]:>8.3f} {after[key]:>8.3f} {change:>+7.1f}%")
+    return "\n".join(lines)
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    # the stub dnf takes dnf's own arguments
+    if len(sys.argv) > 1 and sys.argv[1] == "dnf":
+        sys.exit(stub_dnf(sys.argv[2:]))
+
+    # a stand-in mirror for download tests
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        parser = argparse.ArgumentParser(prog="benchmark.py serve")
+        parser.add_argument("--port", type=int, default=0)
+        parser.add_argument("--rate", type=int, default=None, help="bytes a second for each response")
+        parser.add_argument("--drop-after", type=int, default=None, help="close each response after this many bytes")
+        parser.add_argument("directory")
+        opts = parser.parse_args(sys.argv[2:])
+        with RepoServer(opts.directory, port=opts.port, rate=opts.rate, drop_after=opts.drop_after) as server:
+            print(server.url, flush=True)
+            try:
+                threading.Event().wait()
+            except KeyboardInterrupt:
+                pass
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        parser = argparse.ArgumentParser(prog="benchmark.py compare")
+        parser.add_argument("old")
+        parser.add_argument("new")
+        opts = parser.parse_args(sys.argv[2:])
+        with open(opts.old) as f_old, open(opts.new) as f_new:
+            print(compare(json.load(f_old), json.load(f_new)))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="time create-model-tree.py against a synthetic repo")
+    parser.add_argument('--verbose', '-v', action=argparse.BooleanOptionalAction)
+    parser.add_argument("--sizes", default="10,100,1000", help="comma separated library counts")
+    parser.add_argument("--modes", default=",".join(modes), help=f"comma separated, from {', '.join(modes)}")
+    parser.add_argument("--fanout", type=int, default=3, help="DT_NEEDED entries per library")
+    parser.add_argument("--depth", type=int, default=4, help="layers in the library graph")
+    parser.add_argument("--padding", type=int, default=0, help="extra bytes in each ELF file")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--workdir", default=None, help="keep the repos and builds here")
+    parser.add_argument("--report", default=None, help="write the JSON report to this file")
+    opts = parser.parse_args()
+
+    sizes = [int(s) for s in opts.sizes.split(",") if s]
+    run_modes = [m for m in opts.modes.split(",") if m]
+    unknown = set(run_modes) - set(modes)
+    if unknown:
+        sys.exit(f"unknown modes: {sorted(unknown)}")
+
+    workdir = opts.workdir or tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        report = {
+            'created': time.time(),
+            'host': {'python': platform.python_version(), 'machine': platform.machine(),
+                     'system': platform.platform(), 'cpus': os.cpu_count()},
+            'parameters': {'sizes': sizes, 'modes': run_modes, 'fanout': opts.fanout,
+                           'depth': opts.depth, 'padding': opts.padding, 'repeat': opts.repeat},
+            'sizes': [benchmark_size(workdir, size, run_modes, opts.fanout, opts.depth,
+                                     opts.padding, opts.repeat, verbose=opts.verbose)
+                      for size in sizes],
+        }
+    finally:
+        opts.workdir is None and shutil.rmtree(workdir, ignore_errors=True)
+
+    print(report_table(report))
+    if opts.report is not None:
+        with open(opts.report, "w") as f:
+            json.dump(report, f, indent=1)
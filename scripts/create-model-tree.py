@@ -19,23 +19,46 @@ and shared libraries needed for each file.
 """
 
 import argparse
+import asyncio
+import concurrent.futures
+import contextlib
 import functools
-import glob
+import hashlib
+import json
 import os
 import re
 import shutil
 import stat
 import subprocess
 import sys
-import urllib.request
 import yaml
 
+import elffile
+import fetch
+import lockfile
+import metacache
+import minimize
+import nevra
+import ocilayout
+import pipeline
+import profiler
+import repodata
+import rpmfile
+import store
+import units
+import workdir
+
 defaults = {
-    'package_name': "dhcp-server",
-    'daemon_file':  "dhcpd",
+    'package_names': ["dhcp-server"],
+    'daemon_files':  ["dhcpd"],
     'package_dir':  "./workdir/packages",
     'unpack_dir':   "./workdir/unpack",
     'model_dir': "./workdir/model",
+    'download_workers': 8,
+    'cache_file': "./workdir/metadata.sqlite",
+    'cache_ttl': 86400,
+    'store_dir': "./workdir/store",
+    'profile': "./workdir/profile",
     'extra_files': []
 }
 
@@ -52,6 +75,8 @@ def parse_args():
     parser.add_argument('--manifest', action=argparse.BooleanOptionalAction, default=True)
     parser.add_argument('--resolve', action=argparse.BooleanOptionalAction, default=True)
     parser.add_argument('--model', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--incremental', action=argparse.BooleanOptionalAction, default=True,
+                        help="update only changed files in an existing model tree")
     
     # parser.add_argument('--check', '-v', type=bool, default=False)
 
@@ -59,14 +84,94 @@ def parse_args():
     parser.add_argument('--package-dir', default=defaults['package_dir'])
     parser.add_argument('--unpack-dir', default=defaults['unpack_dir'])
     parser.add_argument('--model-dir', default=defaults['model_dir'])
-
-    parser.add_argument("--daemon-file", default=defaults['daemon_file'])
+    parser.add_argument('--download-workers', type=int, default=defaults['download_workers'])
+
+    # choose among mirrors by measured throughput
+    parser.add_argument('--mirrorlist', action='append', default=[], metavar="FILE_OR_URL",
+                        help="base URLs of the repo's mirrors, one per line")
+    parser.add_argument('--metalink', action='append', default=[], metavar="FILE_OR_URL",
+                        help="metalink for the repo's repomd.xml, as in a .repo file")
+    parser.add_argument('--min-rate', default=None, metavar="SIZE",
+                        help="leave a mirror slower than this per second for the next one, e.g. 200K")
+
+    # share the work directories with builds running at the same time
+    parser.add_argument('--shared-workdir', action=argparse.BooleanOptionalAction, default=True,
+                        help="lock, mark and stage package and unpack entries so concurrent builds can share them")
+    parser.add_argument('--workdir-cap', default=None, metavar="SIZE",
+                        help="after the build, evict the entries used longest ago beyond this size, e.g. 2G")
+
+    # download only the packages files are placed from
+    parser.add_argument('--plan', action=argparse.BooleanOptionalAction, default=False,
+                        help="report the packages and bytes a build would download, then stop")
+    parser.add_argument('--fetch-closure', action=argparse.BooleanOptionalAction, default=False,
+                        help="download the daemon packages' whole dependency closure, as dnf download --resolve")
+
+    # persistent dnf query cache
+    parser.add_argument('--cache', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--cache-file', default=defaults['cache_file'])
+    parser.add_argument('--cache-ttl', type=int, default=defaults['cache_ttl'],
+                        help="seconds before a cached query is asked again, 0 for no limit")
+    parser.add_argument('--refresh-cache', action=argparse.BooleanOptionalAction, default=False)
+
+    # content addressed package and file store
+    parser.add_argument('--store', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--store-dir', default=defaults['store_dir'])
+    parser.add_argument('--placement', choices=store.placements, default="auto",
+                        help="how files are put into model trees from the store")
+
+    # overlap resolving, fetching, unpacking and placing
+    parser.add_argument('--pipeline', action=argparse.BooleanOptionalAction, default=False,
+                        help="move each library through the stages as soon as it is ready")
+    parser.add_argument('--stage-workers', action='append', default=[], metavar="STAGE=COUNT",
+                        help="concurrent calls in a pipeline stage (resolve, fetch, unpack, place)")
+
+    # record where the build time goes
+    parser.add_argument('--profile', nargs='?', const=defaults['profile'], default=None, metavar="PREFIX",
+                        help="write a JSON summary to PREFIX.json and a Chrome trace to PREFIX.trace.json")
+
+    # resolve from an index built by repodata.py instead of dnf
+    parser.add_argument('--repo-index', default=None)
+
+    # build for other arches than the host, several at once
+    parser.add_argument('--arch', dest='arches', action='append', default=None,
+                        help="target arch, may be repeated or comma separated. "
+                        "Each arch works in <unpack dir>/<arch> and <model dir>/<arch>")
+
+    parser.add_argument("--daemon-file", dest='daemon_files', action='append', default=None,
+                        help="path or file name of an executable to build a model for, may be repeated")
+    parser.add_argument('--scan-workers', type=int, default=None,
+                        help="threads reading file headers when finding executables in large packages")
 
     parser.add_argument("--extra-files", dest='extras', action='append', default=defaults['extra_files'])
+
+    # pin a build, or build again from the pins with no resolution
+    parser.add_argument('--write-lock', default=None, metavar="FILE",
+                        help="write every RPM and placed file of the build to a lockfile")
+    parser.add_argument('--from-lock', default=None, metavar="FILE",
+                        help="build the model trees pinned in a lockfile, with no dnf queries")
+
+    # make the model trees smaller and hold them to a size budget
+    parser.add_argument('--minimize', action=argparse.BooleanOptionalAction, default=False,
+                        help="strip ELF files and collapse duplicate files in each model tree")
+    parser.add_argument('--strip', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--dedupe', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--size-budget', action='append', default=[], metavar="[PACKAGE=]SIZE",
+                        help="fail if a model tree, or a package in it, is larger than this, e.g. 20M")
+
+    # write each model tree into an OCI image layout, without buildah
+    parser.add_argument('--oci-layout', default=None, metavar="DIR",
+                        help="write an image <daemon>:<tag> for each model tree into this layout")
+    parser.add_argument('--oci-tag', default="latest")
+    parser.add_argument('--split-layers', action=argparse.BooleanOptionalAction, default=True,
+                        help="layer the files all daemons share, then each daemon's libraries, then its own files")
+    ocilayout.add_image_arguments(parser.add_argument_group("image settings, as for buildah config"))
+
     # Positional arguments
-    parser.add_argument("package", default=defaults['package_name'])
+    parser.add_argument("packages", metavar="package", nargs='*', default=defaults['package_names'])
 
-    return parser.parse_args()
+    opts = parser.parse_args()
+    opts.daemon_files = opts.daemon_files or defaults['daemon_files']
+    return opts
 
 # ----------------------
 # Package name parsing and comparison
@@ -76,13 +181,25 @@ def parse_args():
 # ------------------------------------------------------------------------------
 class DynamicExecutable(object):
 
-    def __init__(self, name, path=None, package=None):
+    # threads used to read file headers when finding executables
+    scan_workers = None
+
+    def __init__(self, name, path=None, package=None, kind=None, arch=None):
         self._name = name
         self._path = path
         #self._name = basename[path]
         self._package = package
+        self._kind = kind
+        self._arch = arch
         self._dependancies = []
         self._libraries = None
+        self._library_index = {}
+        self._missing = set()
+        self._walker = None
+        self._plan = None
+        self._sources = None
+        self._extras = []
+        self._manifest = None
 
     @property
     def name(self):
@@ -92,167 +209,467 @@ class DynamicExecutable(object):
     def path(self):
         return self._path
 
+    @property
+    def kind(self):
+        return self._kind
+
+    @property
+    def arch(self):
+        """
+        The arch the executable is built for, None for the host
+        """
+        return self._arch
+
+    def _label(self):
+        # names the executable in profiles
+        return self._name if self._arch is None else f"{self._name}.{self._arch}"
+
     @staticmethod
-    def find(root_dir, package=None):
+    def find(root_dir, package=None, workers=None, arch=None):
         """
-        Return a list of executable files in a file tree.
+        Return the executables in a file tree that need their shared
+        libraries resolved (dynamic and PIE ELF files), keyed by path.
+        Scripts, static binaries and shared objects are left out.
         """
-        exec_paths = []
-        for (dirpath, dirnames, filenames) in os.walk(root_dir):
-            for f in filenames:
-                path = os.path.join(dirpath, f)
-                fstat = os.lstat(path)
-                try:
-                    # check each file for permission 'x' in mode string
-                    # raises exception if no match
-                    stat.filemode(fstat.st_mode).index('x')
-
-                    # don't include symlinks
-                    stat.S_ISLNK(fstat.st_mode) or exec_paths.append(path)
-                
-                except ValueError:
-                    # str.index throws ValueError if match is not found
-                    # meaning the file isn't executable
-                    next
+        kinds = elffile.scan(root_dir, workers=workers)
+        return {
+            path: DynamicExecutable(path.split('/')[-1], path=path, package=package, kind=kind, arch=arch)
+            for (path, kind) in kinds.items() if kind in elffile.needs_resolution
+        }
 
-        # normalize to the OS path (remove the local root dir path
-        #return [ path.replace(root_dir,'') for path in executables ]
-        execs = {}
-        for path in exec_paths:
-            # create a DynamicExecutable object for each path
-            dyn_exec = DynamicExecutable(path.split('/')[-1],
-                                         path=path.replace(root_dir, ''),
-                                         package=package)
-            execs[dyn_exec._name] = dyn_exec
+    @staticmethod
+    def select(executables, name):
+        """
+        Find an executable by path or by file name in executables keyed by
+        path. Return None if nothing matches. A file name that matches
+        more than one path raises ValueError.
+        """
+        if name in executables:
+            return executables[name]
 
-        return execs
+        matches = [exe for (path, exe) in executables.items() if exe.name == name]
+        if len(matches) > 1:
+            raise ValueError(f"{name} matches several executables: {[exe.path for exe in matches]}")
+        return matches[0] if matches else None
 
+    @profiler.traced("DynamicExecutable.libraries", item=_label)
     def libraries(self, root_dir=None):
         """
         Given the root of a tree containing a dynamically linked executable,
         And the normalized path of the executable file,
         Get the list of shared libraries.
+
+        The ELF headers are read directly and needed libraries are looked
+        up in the unpacked package trees under root_dir, not on the host.
         """
-	#       linux-vdso.so.1 (0x0000ffff9e2ac000)
-        # 	libc.so.6 => /lib64/libc.so.6 (0x0000ffff9db40000)
-	#       /lib/ld-linux-aarch64.so.1 (0x0000ffff9e270000)
-        ldd_re = re.compile(r"^(\s*\S+\s=>)?\s+(/\S+)\s+\S+$")
-        
         if self._libraries is None and root_dir is not None:
-            #dlink_root = os.path.join(root_dir, self._package, self._path)
-            dlink_root = f"{ root_dir }/{ self._package }{ self._path }"
-            response = subprocess.check_output(['ldd', dlink_root]).decode('utf-8').split("\n")
-
-            libpaths = []
-            for line in response:
-                match = ldd_re.match(line)
-                if match is not None:
-                    libpath = match.group(2)
-                    libpaths.append(libpath)
-
-             # remove leading tabs            
-#            lines = [line.strip().split() for line in response]
-#            libpaths = [lib[2] for lib in lines if len(lib) > 2]
-
-            libraries = [DynamicLibrary(path.split('/')[-1], path=path) for path in libpaths]
+            # every unpacked package is a tree to search
+            if self._walker is None:
+                self._walker = elffile.DependencyWalker([])
+            for tree in sorted(os.listdir(root_dir)):
+                # hidden names are locks, markers and trees being unpacked
+                not tree.startswith(".") and os.path.isdir(f"{root_dir}/{tree}") and \
+                    self._walker.add_root(f"{root_dir}/{tree}")
+
+            closure = self._walker.closure(f"{root_dir}/{self._package}", self._path)
+
+            libraries = []
+            self._missing = set()
+            for (tree, path) in closure:
+                lib = DynamicLibrary(path.split('/')[-1], path=path, arch=self._arch)
+                # keep any package already found for this library
+                lib = self._library_index.setdefault(lib.path, lib)
+                tree is None and self._missing.add(lib.path)
+                libraries.append(lib)
 
             self._libraries = libraries
             
         return self._libraries
 
-    def resolve(self, root_dir, verbose=False):
+    def resolve(self, root_dir, package_dir=None, verbose=False):
         """
         Find all of the libraries and their packages
         """
-        for lib in self.libraries(root_dir):
-            verbose and print(f"finding releases for lib: {lib.name}")
+        DynamicExecutable.resolve_all([self], root_dir, package_dir=package_dir, verbose=verbose)
+
+    @staticmethod
+    def resolve_all(executables, root_dir, package_dir=None, verbose=False):
+        """
+        Find all of the libraries and their packages for a set of
+        executables as one graph. ELF files are parsed once, a library
+        needed by several executables is the same object for all of them
+        and each package is looked up, retrieved and unpacked only once.
+
+        Libraries that are not yet in an unpacked tree may need more
+        libraries of their own. When package_dir is given their packages
+        are retrieved and unpacked and the executables are walked again
+        until nothing new turns up.
+        """
+        walker = elffile.DependencyWalker([])
+        library_index = {}
+        for exe in executables:
+            exe._walker = walker
+            exe._library_index = library_index
+
+        unpacked = set()
+        while True:
+            libraries = {}
+            for exe in executables:
+                for lib in exe.libraries(root_dir):
+                    libraries.setdefault(lib.path, lib)
+            libraries = list(libraries.values())
+
+            # one dnf query for every library, then fill in any stragglers
+            verbose and print(f"finding releases for libs: {[lib.name for lib in libraries]}")
+            DynamicExecutable._providers(libraries)
+
+            absent = {path for exe in executables for path in exe._missing}
+            missing = {}
+            for lib in libraries:
+                if lib.path in absent and lib.path not in unpacked:
+                    missing.setdefault(lib.package.name, (lib.package, []))[1].append(lib)
+            if package_dir is None or not missing:
+                break
+
+            # only the library files are needed to continue the walk
+            verbose and print(f"unpacking library packages: {sorted(missing)}")
+            Package.retrieve_all([pkg for (pkg, libs) in missing.values()], package_dir, dependencies=False)
+            for (pkg, libs) in missing.values():
+                pkg.unpack(package_dir, root_dir, paths=[lib.package.latest._filename for lib in libs])
+                unpacked.update(lib.path for lib in libs)
+            for exe in executables:
+                exe._libraries = None
+
+
+    @staticmethod
+    def _providers(libraries):
+        """
+        Find the package and releases of each library
+        """
+        DynamicLibrary.resolve_packages(libraries)
+        for lib in libraries:
             lib.package.releases()
 
+    @staticmethod
+    def init_model_root(dst_root):
+        """
+        Create the model root and the merged /usr symlinks if needed
+        """
+        for libdir in ("lib", "lib64"):
+            os.makedirs(f"{dst_root}/usr/{libdir}", exist_ok=True)
+            if not os.path.islink(f"{dst_root}/{libdir}"):
+                os.symlink(f"usr/{libdir}", f"{dst_root}/{libdir}", target_is_directory=True)
 
-    def model(self, package_dir, unpack_dir, model_dir, follow_symlinks=False, verbose=False):
+    def plan(self, package_dir, pkg, extras=None):
+        """
+        Return the files the model tree should hold, keyed by path, and
+        the package for each release. Each entry names its package and
+        release and holds the file's sha256 and mode or its symlink target,
+        all taken from the RPM headers.
+        """
+        wanted = {}
+
+        # the binary, any symlinks to it in the same directory and extras
+        rpm = rpmfile.RpmFile(os.path.join(package_dir, pkg.rpm))
+        bindir = os.path.dirname(self._path)
+        aliases = [
+            path for (path, (mode, link)) in rpm.files.items()
+            if link is not None and os.path.dirname(path) == bindir
+            and os.path.normpath(os.path.join(bindir, link)) == self._path
+        ]
+        wanted[pkg.rpm] = (pkg, [self._path] + aliases + list(extras or []))
+
+        for lib in self.libraries():
+            wanted.setdefault(lib._package.rpm, (lib._package, []))[1].append(lib._package.latest._filename)
+
+        plan = {}
+        sources = {}
+        for (filename, (source, paths)) in wanted.items():
+            sources[filename[:-len(".rpm")]] = source
+            rpm = rpmfile.RpmFile(os.path.join(package_dir, filename))
+            (files, digests) = (rpm.files, rpm.digests)
+            for path in sorted(rpm.closure(paths)):
+                (mode, link) = files[path]
+                entry = {'package': source.name, 'release': filename[:-len(".rpm")], 'mode': mode}
+                if link is not None:
+                    entry['target'] = link
+                else:
+                    entry['sha256'] = digests.get(path)
+                plan[path] = entry
+
+        return (plan, sources)
+
+    @staticmethod
+    def fingerprint(plan):
+        """
+        A digest of everything that goes into a model tree
+        """
+        return hashlib.sha256(json.dumps(plan, sort_keys=True).encode()).hexdigest()
+
+    @profiler.traced("DynamicExecutable.model", item=_label)
+    def model(self, package_dir, unpack_dir, model_dir, follow_symlinks=False, incremental=True, extras=None, verbose=False):
         """
         Build a model file tree for a container image for the daemon.
 
-        - download the RPM file
-        - unpack the RPM file
-        - create the root directory
-        - place the binary file in the tree
-        - for each library
-        -   * fetch the package
-            * unpack the package
-            * copy the file
+        - download the RPM files
+        - plan the file list from the RPM headers
+        - compare the plan with the one saved from the last build
+        - remove files that are no longer wanted
+        - extract only new or changed files from their RPMs
+
+        The fingerprint and file list are saved next to the model tree in
+        <model_dir>/<name>.state.json
         """
         
+        # fetch the daemon and every library package at once
+        verbose and print(f"retrieving packages for: {self._name}")
+        pkg = Package(self._package, arch=self._arch)
+        Package.retrieve_all([pkg] + [lib._package for lib in self.libraries()], package_dir, dependencies=False)
+
+        self._extras = list(extras or [])
+        (self._plan, self._sources) = self.plan(package_dir, pkg, extras=extras)
+        self.place(self._plan, self._sources, package_dir, model_dir, incremental=incremental, verbose=verbose)
+
+    def place(self, plan, sources, package_dir, model_dir, incremental=True, verbose=False):
+        """
+        Make the model tree match a plan, extracting files from the
+        package of each release in sources. Return the paths placed.
+        """
+        # builds sharing the model directory place each tree in turn
+        with Package.workdirs.get(model_dir).lock(self._name) if Package.workdirs is not None \
+                else contextlib.nullcontext():
+            return self._place(plan, sources, package_dir, model_dir, incremental=incremental, verbose=verbose)
+
+    def _place(self, plan, sources, package_dir, model_dir, incremental=True, verbose=False):
         dst_root = f"{ model_dir }/{self._name}"
+        state_path = f"{ model_dir }/{self._name}.state.json"
+
+        if not incremental and os.path.isdir(dst_root):
+            verbose and print(f"removing old model root: {dst_root}")
+            shutil.rmtree(dst_root)
+            os.path.exists(state_path) and os.unlink(state_path)
 
         verbose and print(f"initializing model root: {dst_root}")
-        
-        os.makedirs(dst_root, exist_ok=True)
-        os.makedirs(f"{dst_root}/usr/lib", exist_ok=True)
-        os.symlink("usr/lib", f"{dst_root}/lib", target_is_directory=True) 
-        os.makedirs(f"{dst_root}/usr/lib64", exist_ok=True)
-        os.symlink("usr/lib64", f"{dst_root}/lib64", target_is_directory=True) 
-
-        pkg = Package(self._package)
-        verbose and print(f"preparing package: {self._package}")
-        # Get the daemon binary first
-        pkg.retrieve(package_dir)
-        pkg.unpack(package_dir, unpack_dir)
-
-        src = f"{unpack_dir}/{pkg._name}{self._path}"
-        dst = f"{dst_root}{self._path}"
-        # copy the binary
-        verbose and print(f"placing exe file: {src} => {dst}")
-        os.makedirs(os.path.dirname(dst), exist_ok=True)
-        shutil.copy(src, dst, follow_symlinks=follow_symlinks)
-        # copy any symlinks to the binary in the same directory
-
-        # For each symlink in the bin dir that points to the binary, copy that too
-        bin_inode = os.stat(src).st_ino
-        verbose and print(f"finding symlinks matching {src} (inode: {bin_inode}")
-        srcdir = os.path.dirname(src)
-        symlinks = [f for f in glob.glob(f"{srcdir}/*") if stat.S_ISLNK(os.lstat(f).st_mode)]
-        verbose and print(f"symlinks in {src}: {symlinks}")
-        binlinks = [l for l in symlinks if os.stat(l).st_ino == bin_inode]
-        verbose and print(f"symlinks matching {src}: {binlinks}")
-        for link in binlinks:
-            alias = os.path.basename(link)
-            verbose and print(f"creating symlink: {alias} -> {os.path.basename(self._path)}")
-#            print(f"shutil.copy({link}, f\"{dst_root}{os.path.dirname(self._path)}/{alias}\", follow_symlinks=False)")
-            shutil.copy(link, f"{dst_root}{os.path.dirname(self._path)}/{alias}", follow_symlinks=False)
-
-        # for each shared library:
-        # - retrieve
-        # - unpack
-        # - mkdir
-        # - copy
-        for lib in self.libraries():
-            verbose and print(f"preparing library: {lib.name}")
-            lib._package.retrieve(package_dir)
-            lib._package.unpack(package_dir, unpack_dir)
-
-            # mkdir
-            # copy
-            filename = lib._package._releases[0]._filename
-            src = f"{unpack_dir}/{lib._package.name}{filename}"
-            dst = f"{dst_root}{filename}"
-            verbose and print(f"placing lib file: {src} => {dst}")
-            os.makedirs(os.path.dirname(dst), exist_ok=True)
-            shutil.copy(src, dst, follow_symlinks=False)
-
-            # If the copied file is a symlink
-            if stat.S_ISLNK(os.lstat(dst).st_mode):
-                # get the destination and copy that too
-                link_value = os.readlink(src)
-                src=f"{os.path.dirname(src)}/{link_value}"
-                dst=f"{os.path.dirname(dst)}/{link_value}"
-                verbose and print(f"placing link target: {src} => {dst}")
-                shutil.copy(src, dst, follow_symlinks=follow_symlinks)
+        DynamicExecutable.init_model_root(dst_root)
+
+        fingerprint = DynamicExecutable.fingerprint(plan)
+
+        old = {}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                old = json.load(f)
+
+        # files the minimizer stripped or turned into links no longer match
+        # their packages, so they are placed again
+        minimized = set(old.get('minimized', []))
+
+        present = {path for path in plan if os.path.lexists(f"{dst_root}{path}")}
+        if old.get('fingerprint') == fingerprint and len(present) == len(plan) and not minimized:
+            verbose and print(f"model is up to date: {dst_root}")
+            return []
+
+        old_files = old.get('files', {})
+
+        # remove what is no longer wanted, then any directories left empty
+        for path in sorted(set(old_files) - set(plan), reverse=True):
+            verbose and print(f"removing: {dst_root}{path}")
+            os.path.lexists(f"{dst_root}{path}") and os.unlink(f"{dst_root}{path}")
+            parent = os.path.dirname(f"{dst_root}{path}")
+            while parent != dst_root and os.path.isdir(parent) and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = os.path.dirname(parent)
+        DynamicExecutable.init_model_root(dst_root)
+
+        # extract new and changed files from their packages
+        changed = {}
+        for (path, entry) in plan.items():
+            if old_files.get(path) != entry or path not in present or path in minimized:
+                changed.setdefault(entry['release'], []).append(path)
+
+        for (release, paths) in changed.items():
+            verbose and print(f"placing files from {release}: {paths} => {dst_root}")
+            sources[release].extract(package_dir, dst_root, paths)
+
+        # save the new state only once the tree matches it
+        with open(f"{state_path}.tmp", "w") as f:
+            json.dump({'fingerprint': fingerprint, 'files': plan}, f, indent=1, sort_keys=True)
+        os.replace(f"{state_path}.tmp", state_path)
+
+        return [path for paths in changed.values() for path in paths]
+
+    def lock(self, package_dir, model_dir):
+        """
+        The lockfile entry for the model: every RPM by NEVRA, URL and
+        sha256 and every file in the plan with its hash, and the manifest.
+        Files whose package carries no sha256 are hashed as placed.
+        """
+        dst_root = f"{ model_dir }/{self._name}"
+        files = {}
+        for (path, entry) in self._plan.items():
+            entry = dict(entry)
+            if 'target' not in entry and not entry.get('sha256') and os.path.isfile(f"{dst_root}{path}"):
+                entry['sha256'] = store.file_digest(f"{dst_root}{path}")
+            files[path] = entry
+
+        rpms = []
+        for (release, pkg) in sorted(self._sources.items()):
+            rpm_path = os.path.join(package_dir, pkg.rpm)
+            checksum = pkg._checksum
+            digest = checksum[1] if checksum is not None and checksum[0] == "sha256" else store.file_digest(rpm_path)
+            rpms.append(lockfile.rpm_entry(rpmfile.RpmFile(rpm_path), pkg.url, digest))
+
+        entry = {
+            'name': self._name,
+            'path': self._path,
+            'package': self._package,
+            'release': self._plan[self._path]['release'],
+            'extras': sorted(self._extras),
+            'rpms': rpms,
+            'files': files,
+            'manifest': self.manifest(),
+        }
+        self._arch is not None and entry.setdefault('arch', self._arch)
+        return entry
+
+    @staticmethod
+    def from_lock(entry):
+        """
+        An executable and the plan and packages to place it from a
+        lockfile entry, without resolving anything
+        """
+        exe = DynamicExecutable(entry['name'], path=entry['path'], package=entry['package'], arch=entry.get('arch'))
+        exe._plan = entry['files']
+        exe._extras = entry.get('extras', [])
+        exe._manifest = entry.get('manifest')
+        exe._sources = {}
+        for rpm in entry['rpms']:
+            pkg = Package(url=rpm['url'], filename=rpm['url'].split("/")[-1], arch=exe._arch)
+            pkg._checksum = ("sha256", rpm['sha256'])
+            exe._sources[pkg.rpm[:-len(".rpm")]] = pkg
+        return exe
+
+    def minimize(self, model_dir, strip=True, dedupe=True, verbose=False):
+        """
+        Make the model tree smaller and report its size by file and
+        package in <model_dir>/<name>.size.json. Return the report.
+        """
+        dst_root = f"{ model_dir }/{self._name}"
+        state_path = f"{ model_dir }/{self._name}.state.json"
+        owners = minimize.state_owners(state_path) if os.path.exists(state_path) else None
+
+        report = minimize.minimize(dst_root, owners, strip_files=strip, dedupe_files=dedupe, verbose=verbose)
+
+        # record the files that now differ from their packages so the next
+        # build places them again
+        if owners is not None:
+            with open(state_path) as f:
+                state = json.load(f)
+            state['minimized'] = sorted(set(state.get('minimized', [])) | set(report['stripped']) |
+                                        set(report['collapsed']))
+            with open(f"{state_path}.tmp", "w") as f:
+                json.dump(state, f, indent=1, sort_keys=True)
+            os.replace(f"{state_path}.tmp", state_path)
+
+        report_path = f"{ model_dir }/{self._name}.size.json"
+        with open(f"{report_path}.tmp", "w") as f:
+            json.dump(report, f, indent=1)
+        os.replace(f"{report_path}.tmp", report_path)
+        return report
+
+    def _image_settings(self, settings):
+        # the command defaults to the daemon
+        settings = dict(settings)
+        settings['cmd'] = settings['cmd'] or (None if settings['entrypoint'] else [self._path])
+        return settings
+
+    @staticmethod
+    def _identity(local):
+        # what a path in a model tree holds, to compare it between trees
+        st = os.lstat(local)
+        if stat.S_ISLNK(st.st_mode):
+            return ("link", os.readlink(local))
+        if stat.S_ISDIR(st.st_mode):
+            return ("dir", stat.S_IMODE(st.st_mode))
+        return ("file", stat.S_IMODE(st.st_mode), store.file_digest(local))
+
+    def _dependency_files(self, model_dir):
+        # the placed files that come from packages other than the daemon's
+        dst_root = f"{ model_dir }/{self._name}"
+        own = self._plan[self._path]['release']
+        return {path for (path, entry) in self._plan.items()
+                if entry['release'] != own and os.path.lexists(f"{dst_root}{path}")}
+
+    @staticmethod
+    def common_files(daemons, model_dir):
+        """
+        The dependency files that every daemon's model tree holds with the
+        same content, such as the C library and the dynamic loader
+        """
+        if not daemons:
+            return []
+        common = set.intersection(*[exe._dependency_files(model_dir) for exe in daemons])
+        first = daemons[0]
+        return sorted(
+            path for path in common
+            if all(DynamicExecutable._identity(f"{model_dir}/{exe.name}{path}") ==
+                   DynamicExecutable._identity(f"{model_dir}/{first.name}{path}") for exe in daemons[1:]))
+
+    def layers(self, model_dir, common=()):
+        """
+        Split the model tree into the paths of each image layer, bottom
+        first: the files common to all daemons, then the rest of this
+        daemon's dependency files, then its own package, the extra files
+        and anything else in the tree. Empty layers are left out.
+        """
+        dst_root = f"{ model_dir }/{self._name}"
+        common = set(common)
+        dependencies = self._dependency_files(model_dir) - common
+        own = ["/" + path for path in ocilayout.tree_entries(dst_root)
+               if "/" + path not in common and "/" + path not in dependencies]
+        return [paths for paths in (sorted(common), sorted(dependencies), own) if paths]
+
+    def image(self, model_dir, layout_dir, tag="latest", settings=None, layers=None, verbose=False):
+        """
+        Write the model tree as an image into an OCI image layout, named
+        <name>:<tag>, in one layer or in the layers given.
+        """
+        ref = f"{self._name}:{tag}"
+        descriptor = ocilayout.write_image(layout_dir, f"{model_dir}/{self._name}", ref,
+                                           self._image_settings(settings), self._arch, layers=layers)
+        verbose and print(f"image {ref}: {descriptor['digest']} in {layout_dir}")
+        return descriptor
+
+    @staticmethod
+    def multiarch_image(builds, layout_dir, tag="latest", settings=None, split=False, verbose=False):
+        """
+        Write an image index <name>:<tag> for each daemon, with an image
+        for every arch it was built for. builds are (arch, model dir,
+        daemons) as returned by build(). With split, each image is
+        layered as by layers(), with the files common to the daemons of
+        its arch at the bottom.
+        """
+        by_name = {}
+        for (arch, model_dir, daemons) in builds:
+            common = DynamicExecutable.common_files(daemons, model_dir) if split else None
+            for exe in daemons:
+                layers = exe.layers(model_dir, common) if split else None
+                by_name.setdefault(exe.name, []).append((exe, f"{model_dir}/{exe.name}", layers))
+
+        for (name, built) in by_name.items():
+            ref = f"{name}:{tag}"
+            trees = {exe.arch: tree for (exe, tree, layers) in built}
+            layers = {exe.arch: layers for (exe, tree, layers) in built} if split else None
+            descriptor = ocilayout.write_index(layout_dir, trees, ref, built[0][0]._image_settings(settings),
+                                               layers=layers)
+            verbose and print(f"image index {ref}: {descriptor['digest']} for {sorted(trees)} in {layout_dir}")
 
     def manifest(self):
         """
         Write a JSON manifest of the files and packages included in the container
         """
+        if self._manifest is not None:
+            # built from a lockfile
+            return self._manifest
 
         # executable:
         #   package
@@ -262,6 +679,7 @@ class DynamicExecutable(object):
             'name': self.name,
             'path': self.path,
             'package': self._package,
+            **({'arch': self._arch} if self._arch is not None else {}),
             'libraries': [
                 {
                     'path': lib.path,
@@ -283,8 +701,9 @@ class DynamicLibrary(object):
     Then the package can be unpacked to extract the library file.
     """
 
-    def __init__(self, name, path=None):
+    def __init__(self, name, path=None, arch=None):
         self._name = name
+        self._arch = arch
         if path:
             self._path = path if path.startswith("/usr") else "/usr" + path
         else:
@@ -311,7 +730,7 @@ class DynamicLibrary(object):
             self._path = path
 
         if self._package is None:
-            self._package = Package(filename=self._path)
+            self._package = Package(filename=self._path, arch=self._arch)
 
         return self._package
 
@@ -319,6 +738,29 @@ class DynamicLibrary(object):
     def retrieve_package(self, path=None):
         self._package.retrieve(path)
 
+    @staticmethod
+    def resolve_packages(libraries):
+        """
+        Find the providing package for a set of libraries with a single
+        dnf query. Some libraries are listed as /lib(64)? instead of
+        /usr/lib(64)? so both spellings are included in the query.
+        """
+        by_arch = {}
+        for lib in libraries:
+            if lib._package is None and lib.path is not None:
+                by_arch.setdefault(lib._arch, {})[lib] = [lib.path, lib.path.replace('/usr', '', 1)]
+
+        for (arch, candidates) in by_arch.items():
+            found = Package.provides(sorted({f for names in candidates.values() for f in names}), arch=arch)
+
+            for (lib, names) in candidates.items():
+                for filename in names:
+                    if filename in found:
+                        lib._package = Package(filename=filename, arch=arch)
+                        lib._package._releases = found[filename]
+                        lib._package.releases()
+                        break
+
 
 # ------------------------------------------------------------------------------
 # Package Management
@@ -329,9 +771,67 @@ class Package():
     from a yum repository and unpack it so that individual files can be
     located and extracted.
     """
+
+    # persistent store of dnf query results shared by all packages
+    cache = None
+
+    # offline repodata index used instead of dnf when it is set
+    index = None
+
+    # content addressed store of RPMs and files when it is set
+    store = None
+
+    # package and unpack directories shared safely with concurrent builds
+    # when it is set
+    workdirs = None
+
+    # (url, checksum) of every package looked up, by arch and search term
+    # and by arch and package name, so each package is only looked up
+    # once per run. noarch packages are kept under "noarch" for every arch.
+    _urls = {}
+
+    @staticmethod
+    def dnf(arch, *words):
+        """
+        A dnf command line that looks in the repos for an arch
+        """
+        if arch is None or arch == os.uname().machine:
+            return ["dnf"] + list(words)
+        return ["dnf", f"--forcearch={arch}"] + list(words)
+
+    @staticmethod
+    def query(command, check=False):
+        """
+        Run a dnf query and return its output, from the metadata cache if
+        it holds a current answer.
+        With check, a failed query raises CalledProcessError.
+        """
+        # the exit status is kept with the output so a cached failure
+        # still fails a checked query; older entries are plain strings
+        if Package.cache is not None:
+            cached = Package.cache.get(command)
+            if isinstance(cached, dict):
+                if check and cached['returncode'] != 0:
+                    raise subprocess.CalledProcessError(cached['returncode'], command)
+                return cached['output']
+
+        with profiler.span("dnf", command=" ".join(command)):
+            profiler.count("subprocesses")
+            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+        output = result.stdout.decode('utf-8')
+        # a failure with no output is not an answer worth keeping
+        if Package.cache is not None and (result.returncode == 0 or output):
+            Package.cache.put(command, {'returncode': result.returncode, 'output': output})
+
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, command)
+
+        return output
     
-    def __init__(self, name=None, filename=None, url=None, symlinks=False, extras=[]):
+    def __init__(self, name=None, filename=None, url=None, symlinks=False, extras=[], arch=None):
         self._name = name
+        self._arch = arch
         self._filename = filename
         self._symlinks = symlinks
         self._extras = extras
@@ -339,6 +839,26 @@ class Package():
         self._releases = None
         self._dependencies = []
         self._url = url
+        self._checksum = None
+
+    def _label(self):
+        # names the package in profiles, by file until its name is known
+        label = self._name or self._filename
+        return label if self._arch is None else f"{label}.{self._arch}"
+
+    @property
+    def arch(self):
+        """
+        The arch the package is wanted for, None for the host
+        """
+        return self._arch
+
+    @property
+    def arches(self):
+        """
+        The release arches that can be used for the wanted arch
+        """
+        return (self._arch, "noarch") if self._arch is not None else None
 
     @property
     def name(self):
@@ -355,29 +875,89 @@ class Package():
         return self._releases[0]
         
     @property
+    @profiler.traced("Package.url", item=_label)
     def url(self):
         """
         Get download URLs for the package and any dependencies
         """
         if self._url is None:
             search = self._filename if self._filename is not None else self._name
-            rpm_cmd = f"/usr/bin/dnf download --url --urlprotocol https { search }"
-            result = subprocess.run(rpm_cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            self._url = result.stdout.decode('utf-8').split("\n")[0]
-            self._filename = self._url.split('/')[-1]
+            known = next((Package._urls[key] for arch in (self._arch, "noarch") for key in
+                          ((arch, self._name), (arch, search)) if key in Package._urls), None)
+            if known is not None:
+                (self._url, self._checksum) = known
+            elif Package.index is not None:
+                record = Package.index.best(
+                    Package.index.whatprovides(search) if search.startswith("/") else Package.index.by_name(search),
+                    arch=self._arch)
+                self._url = Package.index.url(record) if record is not None else ""
+                self._checksum = (record['checksum_type'], record['checksum']) if record is not None else None
+            else:
+                rpm_cmd = Package.dnf(self._arch, "download", "--url", "--urlprotocol", "https", search)
+                self._url = Package.query(rpm_cmd).split("\n")[0]
+            self._located(search)
 
         return self._url
 
+    def _located(self, search):
+        # remember the URL found for a search term and the package name
+        arch = "noarch" if self._url.endswith(".noarch.rpm") else self._arch
+        Package._urls[(arch, search)] = (self._url, self._checksum)
+        self._name is not None and Package._urls.setdefault((arch, self._name), (self._url, self._checksum))
+        self._filename = self._url.split('/')[-1]
+
+    @staticmethod
+    @profiler.traced("Package.locate")
+    def locate(packages):
+        """
+        Find the download URLs of a set of packages with one dnf query
+        per arch, so that each package does not start a dnf of its own.
+        Packages with a known URL, or no name yet, are left to
+        Package.url, as are any the query does not answer.
+        """
+        if Package.index is not None:
+            return
+
+        by_arch = {}
+        for pkg in packages:
+            if pkg._url is not None or pkg._name is None:
+                continue
+            search = pkg._filename if pkg._filename is not None else pkg._name
+            if any(key in Package._urls for arch in (pkg._arch, "noarch") for key in
+                   ((arch, pkg._name), (arch, search))):
+                continue
+            by_arch.setdefault(pkg._arch, {}).setdefault(pkg._name, []).append((pkg, search))
+
+        for (arch, wanted) in by_arch.items():
+            rpm_cmd = Package.dnf(arch, "download", "--url", "--urlprotocol", "https", *sorted(wanted))
+            # dnf prints one URL per package, in no particular order
+            for url in Package.query(rpm_cmd).split("\n"):
+                if not url.endswith(".rpm"):
+                    continue
+                for (pkg, search) in wanted.pop(nevra.Nevra.parse(url.split("/")[-1][:-len(".rpm")]).name, []):
+                    pkg._url = url
+                    pkg._located(search)
+
+    @property
+    def rpm(self):
+        """
+        The file name of the package RPM
+        """
+        return self.url.split('/')[-1]
+
     def executables(self, unpack_dir):
         if self._executables == None:
             self._executables = DynamicExecutable.find(
                 os.path.join(unpack_dir,self._name),
-                package=self._name
+                package=self._name,
+                workers=DynamicExecutable.scan_workers,
+                arch=self._arch
             )
 
         return self._executables
 
     @property
+    @profiler.traced("Package.dependencies", item=_label)
     def dependencies(self):
         """
         Get download URLs for the package and any dependencies
@@ -385,58 +965,159 @@ class Package():
         if self._dependencies:
             return self._dependencies
   
-        rpm_cmd = f"/usr/bin/dnf download --resolve --url --urlprotocol https { self._name }"
-        result = subprocess.run(rpm_cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        checksums = {}
+        if Package.index is not None:
+            record = Package.index.best(Package.index.by_name(self._name), arch=self._arch)
+            closure = Package.index.closure(record, arch=self._arch) if record is not None else []
+            urls = [Package.index.url(r) for r in closure]
+            checksums = {Package.index.url(r): (r['checksum_type'], r['checksum']) for r in closure}
+        else:
+            rpm_cmd = Package.dnf(self._arch, "download", "--resolve", "--url", "--urlprotocol", "https", self._name)
+            urls = Package.query(rpm_cmd).split("\n")[:-1]
 
-        urls = result.stdout.decode('utf-8').split("\n")[:-1]
         self._dependencies = []
         for url in urls:
             basename = url.split("/")[-1]
-            if basename != self._filename:
-                self._dependencies.append(Package(filename=basename, url=url))
+            if basename != self.rpm:
+                dep = Package(filename=basename, url=url, arch=self._arch)
+                dep._checksum = checksums.get(url)
+                self._dependencies.append(dep)
         
         return self._dependencies
 
-    def retrieve(self, destdir, dependencies=True):
+    def downloads(self, destdir, dependencies=True):
+        """
+        Return the (url, path, checksum) needed to retrieve this package
+        and its dependencies. checksum is (type, value) or None.
+        """
+        url = self.url
+        requests = [(url, f"{ destdir }/{ self.rpm }", self._checksum)]
+
+        if dependencies:
+            for dep in self.dependencies:
+                # get the basename of the URL
+                requests.append((dep.url, os.path.join(destdir, dep.rpm), dep._checksum))
+
+        return requests
+
+    @profiler.traced("Package.retrieve", item=_label)
+    def retrieve(self, destdir, dependencies=True, pool=None):
         """
         Retrieve an RPM and the dependencies from the default repository
         place the RPMs in the directory indicated.
         """
+        Package.retrieve_all([self], destdir, dependencies=dependencies, pool=pool)
+
+    @staticmethod
+    @profiler.traced("Package.retrieve_all")
+    def retrieve_all(packages, destdir, dependencies=True, pool=None):
+        """
+        Retrieve a set of packages concurrently. Each RPM is downloaded
+        only once even if several packages share it as a dependency.
+        """
 
         # Create the destination directory 
         not os.path.isdir(destdir) and os.makedirs(destdir, exist_ok=True)
 
-        url = self.url
-        path = f"{ destdir }/{ self._filename }"
-
-        os.path.exists(path) or urllib.request.urlretrieve(url, path)
-        
-        # download each of the packages if needed
-        if dependencies:
-            for dep in self.dependencies:
-                # get the basename of the URL
-                path = os.path.join(destdir, dep._filename)
-                os.path.exists(path) or urllib.request.urlretrieve(dep.url, path)
+        # every URL from one query before the pool starts, and any the
+        # query left out side by side rather than one after another
+        Package.locate(packages)
+        pending = [pkg for pkg in packages if pkg._url is None]
+        if len(pending) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(pending), defaults['download_workers']),
+                                                       thread_name_prefix="locate") as executor:
+                list(executor.map(lambda pkg: pkg.url, pending))
+
+        wanted = {}
+        for pkg in packages:
+            for (url, path, checksum) in pkg.downloads(destdir, dependencies=dependencies):
+                wanted.setdefault(path, (url, checksum))
+
+        pool = pool if pool is not None else fetch.shared_pool()
+        if Package.workdirs is not None:
+            # each file is fetched by one build while the others wait
+            Package.workdirs.get(destdir).fetch(wanted, functools.partial(Package._fetch, pool=pool))
+        else:
+            Package._fetch(wanted, pool)
 
-    def unpack(self, package_dir, destroot, force=False):
+    @staticmethod
+    def _fetch(wanted, pool):
+        """
+        Download the files in wanted, {path: (url, checksum)}, that are
+        neither present nor in the store.
+        Return the sha256 of each file placed that is known to match its
+        repo checksum, so it is not read again to check it.
+        """
+        requests = {}
+        checksums = {}
+        digests = {}
+        for (path, (url, checksum)) in wanted.items():
+            sha256 = checksum[1] if checksum is not None and checksum[0] == "sha256" else None
+            # skip files that are already present or in the store
+            if os.path.exists(path):
+                continue
+            if Package.store is not None and checksum is not None and Package.store.link_rpm(*checksum, path):
+                sha256 is not None and digests.setdefault(path, sha256)
+                continue
+            requests.setdefault(url, path)
+            checksums[path] = checksum
+
+        # the pool checks each download against its repo checksum
+        fetched = pool.fetch([(url, path, checksums[path]) for (url, path) in requests.items()])
+
+        for path in fetched:
+            checksum = checksums[path]
+            if Package.store is not None:
+                try:
+                    digests[path] = Package.store.add_rpm(path, *(checksum or (None, None)), verified=True)
+                except store.StoreError:
+                    # never leave a bad download where it looks complete
+                    os.unlink(path)
+                    raise
+            elif checksum is not None and checksum[0] == "sha256":
+                digests[path] = checksum[1]
+
+        return digests
+
+    @profiler.traced("Package.unpack", item=_label)
+    def unpack(self, package_dir, destroot, force=False, paths=None):
         """
         Unpack an RPM into a directory
+        If paths is given, unpack only those files and their symlink targets
         """
         destdir = os.path.join(destroot, self._name)
-        
-        convert_command = f"rpm2cpio { os.path.join(package_dir, self._filename) }"
-        unpack_command = f"cpio -idmu --quiet --directory {destdir}"
+
+        if Package.workdirs is not None:
+            # unpacked aside and moved into place, once for all builds
+            digest = Package.workdirs.get(package_dir).digest(self.rpm, self._checksum)
+            Package.workdirs.get(destroot).unpack(self._name, digest, functools.partial(self.extract, package_dir),
+                                                  paths=paths, force=force)
+            return
 
         # Create the destination directory if needed
         not os.path.isdir(destdir) and os.makedirs(destdir, exist_ok=True)
 
+        if paths is not None:
+            # only the requested files that are not there yet
+            paths = [p for p in paths if force or not os.path.lexists(f"{destdir}{p}")]
+            paths and self.extract(package_dir, destdir, paths)
+
         # only unpack if the destdir is empty or forced 
-        if force == True or len(os.listdir(destdir)) == 0:
-            # rpm2ostree | cpio - Yes Adam, yes.
-            convert = subprocess.Popen(convert_command.split(), stdout = subprocess.PIPE)
-            unpack = subprocess.Popen(unpack_command.split(), stdin=convert.stdout)
-            convert.wait()
+        elif force == True or len(os.listdir(destdir)) == 0:
+            self.extract(package_dir, destdir)
+
+    @profiler.traced("Package.extract", item=_label)
+    def extract(self, package_dir, destdir, paths=None):
+        """
+        Write files from the RPM directly into a file tree.
+        Return the package paths that were written.
+        """
+        rpm_path = os.path.join(package_dir, self.rpm)
+        if Package.store is not None and paths is not None:
+            return Package.store.extract(rpm_path, destdir, paths)
+        return rpmfile.RpmFile(rpm_path).extract(destdir, paths)
 
+    @profiler.traced("Package.releases", item=_label)
     def releases(self):
         """
         """
@@ -445,59 +1126,113 @@ class Package():
         
         if self._releases is None:
             # find all the available releases
-            try: 
-                provides_command=f"dnf --quiet provides {self._filename}"
-                response = subprocess.check_output(provides_command.split(), stderr=subprocess.DEVNULL).decode('utf-8').split("\n")
-            except subprocess.CalledProcessError as e:
-                shortname = self._filename.replace('/usr', '')
-                provides_cmd=f"dnf --quiet provides { shortname }"
-                response = subprocess.check_output(provides_cmd.split()).decode('utf-8').split("\n")
-                self._filename = shortname
-
-            # The stdout contains a series of RPM records  like this
-            #
-            # <pkgname>    : <description>
-            # Repo         : <reponame>
-            # Matched From : blank
-            # Filename     : <filename>
-            # <blank>
-            entry_re = re.compile(r"^(\S+\s?\S+)\s+:\s+(.*)$")
-            releases = []
-            name = None
-            description = None
-            filename = None
-            repo = None
-            
-            for line in response:
-                match = entry_re.match(line)
-                if match == None:
-                    if name is not None:
-                        releases.append(Release(name, description, filename, repo))
-                        name = None
-                        description = None
-                        filename = None
-                        repo = None
-                else:
-                    # extract key/value
-                    (key, value) = match.groups(1)
-                    key = key.lower()
-                    if key == 'repo':
-                        repo = value
-                    elif key == 'filename':
-                        filename = value
-                    elif key == 'matched from':
-                        next
-                    else:
-                        name = key
-                        description = value
-
-            self._releases = sorted(releases, key=functools.cmp_to_key(Release.compare), reverse=True)
+            if Package.index is not None:
+                other = self._filename.replace('/usr', '', 1) if self._filename.startswith('/usr') else '/usr' + self._filename
+                found = Package.provides([self._filename, other], arch=self._arch)
+                if not found:
+                    raise ValueError(f"no package provides { self._filename }")
+                self._releases = next(iter(found.values()))
+            else:
+                try: 
+                    provides_command = Package.dnf(self._arch, "--quiet", "provides", self._filename)
+                    response = Package.query(provides_command, check=True).split("\n")
+                except subprocess.CalledProcessError as e:
+                    shortname = self._filename.replace('/usr', '')
+                    provides_cmd = Package.dnf(self._arch, "--quiet", "provides", shortname)
+                    response = Package.query(provides_cmd, check=True).split("\n")
+                    self._filename = shortname
+
+                self._releases = Release.latest_first(Release.parse_provides(response), self.arches)
+                if not self._releases:
+                    raise ValueError(f"no {self._arch} package provides { self._filename }")
 
         self._name = self._releases[0].name
         self._filename = self._releases[0]._filename
 
         return self._releases
 
+    @staticmethod
+    def provides(filenames, arch=None):
+        """
+        Find the releases that provide each of a list of files using a
+        single dnf query.
+        Return a dict keyed by the matched filename. Each value is a list
+        of releases for the arch (the host by default), latest first.
+        Files with no provider are left out.
+        """
+        arches = (arch, "noarch") if arch is not None else None
+        if not filenames:
+            return {}
+
+        if Package.index is not None:
+            found = {}
+            for filename in filenames:
+                records = Package.index.whatprovides(filename)
+                releases = Release.latest_first(
+                    [Release(r['nevra'], r['summary'], filename, r['repo']) for r in records], arches)
+                releases and found.setdefault(filename, releases)
+            return found
+
+        # dnf exits non-zero if any one file has no match but still reports
+        # the ones it found, so the exit status is ignored here
+        provides_command = Package.dnf(arch, "--quiet", "provides", *filenames)
+        response = Package.query(provides_command).split("\n")
+
+        found = {}
+        for release in Release.parse_provides(response):
+            found.setdefault(release._filename, []).append(release)
+
+        found = {filename: Release.latest_first(releases, arches) for (filename, releases) in found.items()}
+        return {filename: releases for (filename, releases) in found.items() if releases}
+
+    def _record(self):
+        # the index record of the release the package URL points at
+        name = nevra.Nevra.parse(self.rpm[:-len(".rpm")]).name
+        return next((r for r in Package.index.by_name(name) if r['location'].split("/")[-1] == self.rpm), None)
+
+    @staticmethod
+    def requires(packages):
+        """
+        The capabilities a list of packages require, from the repo
+        metadata, with one dnf query per arch.
+        """
+        if Package.index is not None:
+            return {c for pkg in packages for c in (pkg._record() or {}).get('requires', [])}
+
+        by_arch = {}
+        for pkg in packages:
+            by_arch.setdefault(pkg.arch, set()).add(pkg.rpm[:-len(".rpm")])
+
+        capabilities = set()
+        for (arch, releases) in by_arch.items():
+            command = Package.dnf(arch, "repoquery", "--quiet", "--requires", *sorted(releases))
+            capabilities.update(line.strip() for line in Package.query(command).split("\n") if line.strip())
+        return capabilities
+
+    @staticmethod
+    def sizes(packages):
+        """
+        The download size of each package, keyed by RPM file name, from the
+        repo metadata with one dnf query per arch. A size the repo does
+        not give is None.
+        """
+        if Package.index is not None:
+            return {pkg.rpm: (pkg._record() or {}).get('size') for pkg in packages}
+
+        by_arch = {}
+        for pkg in packages:
+            by_arch.setdefault(pkg.arch, set()).add(pkg.rpm)
+
+        sizes = {}
+        for (arch, rpms) in by_arch.items():
+            command = Package.dnf(arch, "repoquery", "--quiet", "--queryformat",
+                                  "%{name}-%{version}-%{release}.%{arch}.rpm %{downloadsize}\\n",
+                                  *sorted(rpm[:-len(".rpm")] for rpm in rpms))
+            for line in Package.query(command).split("\n"):
+                (rpm, space, size) = line.strip().partition(" ")
+                rpm in rpms and size.isdigit() and sizes.setdefault(rpm, int(size))
+        return {pkg.rpm: sizes.get(pkg.rpm) for pkg in packages}
+
 class Release():
     """
     This class provides methods to decompose and query the components of
@@ -512,136 +1247,619 @@ class Release():
         self._repo = repo
         self._url = None
 
-    # class variable 
-    _release_name_re = re.compile(r'^(.*)[-:]((\d+)\.(\d+)(\.(\d+))?-(\d+))\.(\S+)\.(\S+)$')
+        # parsed once, every property and comparison reads the parts
+        self._nevra = nevra.Nevra.parse(fullname)
+        if self._nevra is None:
+            raise ValueError(f"not a package name: {fullname}")
 
     @property
     def fullname(self):
         return self._fullname
 
     @property
-    def spec(self):
-        """
-        Split a package name into components
-        (name,version(major, minor, release, build), distro, arch)
+    def nevra(self):
+        return self._nevra
 
-        <name>-<version>.<distro>.<arch>$
+    @property
+    def key(self):
         """
-        match = self._release_name_re.match(self._fullname)
-
-        if match is None:
-            return None
-
-        return {
-            "name": match.group(1),
-            "version": match.group(2),
-            "major": int(match.group(3)),
-            "minor": int(match.group(4)),
-            "release": int(match.group(6)) if match.group(5) is not None else 0,
-            "build": int(match.group(7)),
-            "distro": match.group(8),
-            "arch": match.group(9)
-        }
+        Sort key ordering releases the way rpm orders versions
+        """
+        return self._nevra.key
 
     @property
     def name(self):
-        return self.spec['name']
-
-    @property
-    def version(self):
-        return self.spec['version']
+        return self._nevra.name
 
     @property
-    def major(self):
-        return self.spec['major']
+    def epoch(self):
+        return self._nevra.epoch
 
     @property
-    def minor(self):
-        return self.spec['minor']
+    def version(self):
+        """
+        The version and release without the distro: <version>-<build>
+        """
+        (build, dot, distro) = self._nevra.release.rpartition(".")
+        return f"{self._nevra.version}-{build if dot else distro}"
 
     @property
     def release(self):
-        return self.spec['release']
-
-    @property
-    def build(self):
-        return self.spec['build']
+        return self._nevra.release
 
     @property
     def distro(self):
-        return self.spec['distro']
+        return self._nevra.distro
 
     @property
     def arch(self):
-        return self.spec['arch']
+        return self._nevra.arch
+
+    @staticmethod
+    def latest_first(releases, arches=None):
+        """
+        Sort releases latest first, keeping those for the given arches.
+        By default those are the host arch and noarch, and if nothing is
+        built for them every release is kept.
+        """
+        releases = list(releases)
+        matching = nevra.select(releases, arches or nevra.host_arches())
+        if arches is None:
+            matching = matching or releases
+        return sorted(matching, key=lambda r: r.key, reverse=True)
+
+    @staticmethod
+    def parse_provides(response):
+        """
+        Parse the output lines of `dnf provides` into a list of releases
+        """
+        # The stdout contains a series of RPM records  like this
+        #
+        # <pkgname>    : <description>
+        # Repo         : <reponame>
+        # Matched From : blank
+        # Filename     : <filename>
+        # <blank>
+        #
+        # A record matched by a capability has "Provide : <capability>"
+        # in place of the file name.
+        entry_re = re.compile(r"^(\S+\s?\S+)\s+:\s+(.*)$")
+        releases = []
+        name = None
+        description = None
+        filename = None
+        repo = None
+
+        # a trailing blank line closes the last record
+        for line in list(response) + [""]:
+            match = entry_re.match(line)
+            if match == None:
+                # "Matched from:" has no value and does not end the record
+                if line.strip() != "":
+                    continue
+                if name is not None:
+                    releases.append(Release(name, description, filename, repo))
+                    name = None
+                    description = None
+                    filename = None
+                    repo = None
+            else:
+                # extract key/value
+                (key, value) = match.groups(1)
+                key = key.lower()
+                if key == 'repo':
+                    repo = value
+                elif key == 'filename':
+                    filename = value
+                elif key == 'provide':
+                    filename = value.split(" ")[0]
+                elif key == 'matched from':
+                    next
+                else:
+                    name = key
+                    description = value
+
+        return releases
 
     @staticmethod
     def compare(release1, release2):
         """
         Compare two RPM names.
-        If the name, distro or arch don't match, throw an error.
-        If they do match, compare the major, minor, release and build
+        If the names don't match, throw an error. Otherwise compare the
+        epoch, version and release as rpm does. Releases for other
+        arches or distros are filtered out before comparing, by
+        latest_first or nevra.select, rather than refused here.
         """
+        for part in ('name',):
+            (value1, value2) = (getattr(release1, part), getattr(release2, part))
+            if value1 != value2:
+                raise ValueError(f"mismatch package {part}: {value1} != {value2}")
 
-        rpm1 = release1.spec
-        rpm2 = release2.spec
+        return (release1.key > release2.key) - (release1.key < release2.key)
 
-        if rpm1['name'] != rpm2['name']:
-            raise ValueError(f"mismatch package names: {rpm1['name']} != {rpm2['name']}")
-        if rpm1['distro'] != rpm2['distro']:
-            raise ValueError(f"mismatch package distro: {rpm1['distro']} != {rpm2['distro']}")
-        if rpm1['arch'] != rpm2['arch']:
-            raise ValueError(f"mismatch package arch: {rpm1['arch']} != {rpm2['arch']}")
 
-        if rpm1['major'] == rpm2['major']:
-            if rpm1['minor'] == rpm2['minor']:
-                if rpm1['release'] == rpm2['release']:
-                    return rpm1['build'] - rpm2['build']
-                else:
-                    return rpm1['release'] - rpm2['release']
-            else:
-                return rpm1['minor'] - rpm2['minor']
-        else:
-            return rpm1['major'] - rpm2['major']
+# ------------------------------------------------------------------------------
+# Fetch planning
+# ------------------------------------------------------------------------------
+class FetchPlan(object):
+    """
+    The RPMs a build needs, worked out from the repo metadata without
+    downloading anything.
+
+    A model tree holds files from the daemon packages and from the
+    packages that provide the shared libraries they load. The plan
+    follows only the shared library requirements rpm generates from ELF
+    files, so it leaves out the scriptlet and other requirements that the
+    full `dnf download --resolve` closure pulls in. Requirements are per
+    package, not per file, so the plan may name a package the ELF walk of
+    the chosen daemon turns out not to need, but not miss one it does.
+    """
 
-        raise ValueError("invalid package names")
+    def __init__(self, packages, arch=None):
+        self._packages = packages
+        self._arch = arch
+        self._unresolved = set()
 
+    def needed(self):
+        """
+        The daemon packages and the providers of their libraries, keyed by
+        RPM file name
+        """
+        found = {}
+        Package.locate(self._packages)
+        for pkg in self._packages:
+            if not pkg.url:
+                raise ValueError(f"no package {pkg.name}" + (f" for {self._arch}" if self._arch else ""))
+            found[pkg.rpm] = pkg
+
+        frontier = list(found.values())
+        asked = set()
+        while frontier:
+            wanted = {repodata.library_capability(c) for c in Package.requires(frontier)} - {None} - asked
+            asked.update(wanted)
+
+            providers = Package.provides(sorted(wanted), arch=self._arch)
+            self._unresolved.update(wanted - set(providers))
+
+            # the URLs of every provider in one query
+            candidates = [Package(name, arch=self._arch)
+                          for name in sorted({releases[0].name for releases in providers.values()})]
+            Package.locate(candidates)
+            frontier = []
+            for pkg in candidates:
+                if pkg.url and pkg.rpm not in found:
+                    found[pkg.rpm] = pkg
+                    frontier.append(pkg)
+        return found
+
+    def closure(self):
+        """
+        The packages `dnf download --resolve` would fetch, keyed by RPM
+        file name
+        """
+        found = {}
+        for pkg in self._packages:
+            found.setdefault(pkg.rpm, pkg)
+            for dep in pkg.dependencies:
+                found.setdefault(dep.rpm, dep)
+        return found
 
-# ===============================
-# MAIN
-# ===============================
-if __name__ == "__main__":
-        
-    opts = parse_args()
+    @staticmethod
+    def present(pkg, package_dir):
+        """
+        Whether a package is already downloaded or in the content store
+        """
+        return os.path.exists(os.path.join(package_dir, pkg.rpm)) or \
+            (Package.store is not None and pkg._checksum is not None and
+             Package.store.find_rpm(*pkg._checksum) is not None)
 
-    # Identify and pull a copy of the service deaemon package
-    opts.verbose and print(f"Processings package: {opts.package}")
-    pkg = Package(opts.package, extras=opts.extras)
+    @profiler.traced("FetchPlan.report")
+    def report(self, package_dir):
+        """
+        The planned packages with their sizes and the bytes left to
+        download, against the full closure
+        """
+        needed = self.needed()
+        closure = self.closure()
+        sizes = Package.sizes(list({**closure, **needed}.values()))
+
+        packages = [
+            {'rpm': rpm, 'size': sizes[rpm], 'present': FetchPlan.present(pkg, package_dir)}
+            for (rpm, pkg) in sorted(needed.items())
+        ]
+        return {
+            'arch': self._arch or os.uname().machine,
+            'packages': packages,
+            'unresolved': sorted(self._unresolved),
+            'planned': {
+                'packages': len(needed),
+                'bytes': sum(sizes[rpm] or 0 for rpm in needed),
+                'download': sum(entry['size'] or 0 for entry in packages if not entry['present']),
+            },
+            'closure': {
+                'packages': len(closure),
+                'bytes': sum(sizes[rpm] or 0 for rpm in closure),
+                'skipped': sorted(set(closure) - set(needed)),
+            },
+        }
 
-    opts.verbose and print(f"Retrieving package: {opts.package}")
-    pkg.retrieve(opts.package_dir)
 
-    opts.verbose and print(f"Unpacking package: {opts.package}")
-    pkg.unpack(opts.package_dir, opts.unpack_dir)
+# ------------------------------------------------------------------------------
+# Pipelined build
+# ------------------------------------------------------------------------------
+class PipelinedBuild(object):
+    """
+    Resolve, fetch, unpack and place the files for a set of daemons as a
+    pipeline instead of in phases.
+
+    Each daemon's library graph is walked as far as the unpacked trees
+    allow. Every missing library becomes a task of its own that finds its
+    provider, fetches the package and unpacks the library, and the walk
+    goes on from whichever library is ready first. A daemon's model tree
+    is placed as soon as its own graph is complete, while other daemons
+    may still be resolving.
+    """
 
-    # Find the executable files in the package file tree
-    opts.verbose and print(f"Finding exe binaries in : {opts.package}")
-    executables = pkg.executables(opts.unpack_dir)
-    opts.verbose and print(f"{list(executables.keys())}")
+    def __init__(self, pipe, unpack_dir, package_dir, model_dir, incremental=True, extras=None, arch=None,
+                 fetch_closure=False, verbose=False):
+        self._pipe = pipe
+        self._arch = arch
+        self._fetch_closure = fetch_closure
+        self._unpack_dir = unpack_dir
+        self._package_dir = package_dir
+        self._model_dir = model_dir
+        self._incremental = incremental
+        self._extras = extras
+        self._verbose = verbose
+        self._walker = elffile.DependencyWalker([])
+        self._library_index = {}
+        self._locks = {}
 
-    # Select the binary to package
-    opts.verbose and print(f"Processing exe: {opts.daemon_file}")
-    daemon_exe = executables[opts.daemon_file]
+    def run(self, packages, daemon_files):
+        """
+        Build a model tree for each daemon. Return the daemons.
+        """
+        return asyncio.run(self._run(packages, daemon_files))
+
+    async def _run(self, packages, daemon_files):
+        executables = {}
+        for found in await asyncio.gather(*[self._package(pkg) for pkg in packages]):
+            for (path, exe) in found.items():
+                executables.setdefault(path, exe)
+
+        daemons = []
+        for daemon_file in daemon_files:
+            try:
+                exe = DynamicExecutable.select(executables, daemon_file)
+            except ValueError as e:
+                sys.exit(str(e))
+            if exe is None:
+                sys.exit(f"no executable {daemon_file} in packages {[pkg.name for pkg in packages]}")
+            daemons.append(exe)
+
+        for exe in daemons:
+            exe._walker = self._walker
+            exe._library_index = self._library_index
+
+        await asyncio.gather(*[self._daemon(exe) for exe in daemons])
+        return daemons
+
+    async def _package(self, pkg):
+        """
+        Fetch and unpack a daemon package and find its executables
+        """
+        await self._pipe.run("fetch", Package.retrieve_all, [pkg], self._package_dir,
+                             dependencies=self._fetch_closure)
+        await self._pipe.run("unpack", pkg.unpack, self._package_dir, self._unpack_dir)
+        return await self._pipe.run("unpack", pkg.executables, self._unpack_dir)
 
-    # Find all shared libraries and their packages
+    async def _daemon(self, exe):
+        """
+        Walk the daemon's libraries as they become available, then place
+        its model tree
+        """
+        root = f"{self._unpack_dir}/{exe._package}"
+        self._walker.add_root(root)
+
+        finished = set()
+        while True:
+            missing = [path for (tree, path) in self._walker.closure(root, exe.path)
+                       if tree is None and path not in finished]
+            if not missing:
+                break
+
+            tasks = {path: self._pipe.once(('library', path), functools.partial(self._library, path))
+                     for path in missing}
+            self._verbose and print(f"{exe.name}: waiting for {sorted(tasks)}")
+            await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_COMPLETED)
+
+            for (path, task) in tasks.items():
+                if task.done():
+                    self._walker.add_root(task.result())
+                    finished.add(path)
+            # a library may have been read while it was still being written
+            self._walker.refresh()
+
+        exe._libraries = None
+        libraries = exe.libraries(self._unpack_dir)
+
+        # libraries found in the daemon's own tree have no provider yet
+        await self._pipe.run("resolve", DynamicExecutable._providers, libraries)
+
+        self._verbose and print(f"Creating model for {exe.name}")
+        await self._pipe.run("place", exe.model, self._package_dir, self._unpack_dir, self._model_dir,
+                             incremental=self._incremental, extras=self._extras, verbose=self._verbose)
+
+    async def _library(self, path):
+        """
+        Find the package for a missing library, fetch it and unpack the
+        library. Return the unpacked tree.
+        """
+        lib = DynamicLibrary(path.split('/')[-1], path=path, arch=self._arch)
+        lib = self._library_index.setdefault(lib.path, lib)
+        await self._pipe.run("resolve", DynamicExecutable._providers, [lib])
+
+        pkg = lib.package
+        await self._pipe.once(('fetch', pkg.name), functools.partial(
+            self._pipe.run, "fetch", Package.retrieve_all, [pkg], self._package_dir, dependencies=False))
+
+        # libraries from one package unpack into the same tree one at a time
+        async with self._locks.setdefault(pkg.name, asyncio.Lock()):
+            self._verbose and print(f"unpacking {pkg.latest._filename} from {pkg.name}")
+            await self._pipe.run("unpack", pkg.unpack, self._package_dir, self._unpack_dir,
+                                 paths=[pkg.latest._filename])
+
+        return f"{self._unpack_dir}/{pkg.name}"
+
+
+# ------------------------------------------------------------------------------
+# Build for one arch
+# ------------------------------------------------------------------------------
+def arch_dirs(opts, arch=None):
+    """
+    The unpack and model directories for an arch. Builds for a named arch
+    work in <dir>/<arch>. Downloads are shared by every arch.
+    """
+    if arch is None:
+        return (opts.unpack_dir, opts.model_dir)
+    return (f"{opts.unpack_dir}/{arch}", f"{opts.model_dir}/{arch}")
+
+
+def build(opts, arch=None):
+    """
+    Retrieve, resolve and model the daemons for one arch, None for the
+    host. Return (arch, model directory, daemons).
+    """
+    (unpack_dir, model_dir) = arch_dirs(opts, arch)
+
+    # Identify and pull a copy of each service daemon package
+    opts.verbose and print(f"Processings packages: {opts.packages}" + (f" for {arch}" if arch else ""))
+    packages = [Package(name, extras=opts.extras, arch=arch) for name in opts.packages]
+
+    if opts.pipeline and opts.resolve and opts.model:
+        try:
+            concurrency = dict({'fetch': opts.download_workers}, **pipeline.parse_concurrency(opts.stage_workers))
+        except ValueError as e:
+            sys.exit(str(e))
+        pipe = pipeline.Pipeline(concurrency=concurrency, verbose=opts.verbose)
+        pipelined = PipelinedBuild(pipe, unpack_dir, opts.package_dir, model_dir, incremental=opts.incremental,
+                                   extras=opts.extras, arch=arch, fetch_closure=opts.fetch_closure,
+                                   verbose=opts.verbose)
+        try:
+            daemons = pipelined.run(packages, opts.daemon_files)
+        finally:
+            pipe.close()
+        opts.verbose and print(f"pipeline stages: {pipe.stats}")
+        return (arch, model_dir, daemons)
+
+    opts.verbose and print(f"Retrieving packages: {opts.packages}")
+    with profiler.span("retrieve"):
+        Package.retrieve_all(packages, opts.package_dir, dependencies=opts.fetch_closure)
+
+    executables = {}
+    for pkg in packages:
+        opts.verbose and print(f"Unpacking package: {pkg.name}")
+        with profiler.span("unpack"):
+            pkg.unpack(opts.package_dir, unpack_dir)
+
+            # Find the executable files in the package file tree
+            opts.verbose and print(f"Finding exe binaries in : {pkg.name}")
+            found = pkg.executables(unpack_dir)
+        opts.verbose and print(f"{list(found.keys())}")
+        for (path, exe) in found.items():
+            executables.setdefault(path, exe)
+
+    # Select the binaries to package, by path or by file name
+    daemons = []
+    for daemon_file in opts.daemon_files:
+        try:
+            daemon_exe = DynamicExecutable.select(executables, daemon_file)
+        except ValueError as e:
+            sys.exit(str(e))
+        if daemon_exe is None:
+            sys.exit(f"no executable {daemon_file} in packages {opts.packages}")
+        opts.verbose and print(f"Processing exe: {daemon_exe.path}")
+        daemons.append(daemon_exe)
+
+    # Find all shared libraries and their packages as one graph
     if opts.resolve:
-        opts.verbose and print(f"Processing shared libraries for {daemon_exe.name}")
-        daemon_exe.resolve(opts.unpack_dir, verbose=opts.verbose)
+        opts.verbose and print(f"Processing shared libraries for {[exe.name for exe in daemons]}")
+        with profiler.span("resolve"):
+            DynamicExecutable.resolve_all(daemons, unpack_dir, package_dir=opts.package_dir, verbose=opts.verbose)
 
-    # Create a file tree for the daemon container
+    # Create a file tree for each daemon container
     if opts.model:
-        opts.verbose and print(f"Creating model for {daemon_exe.name}")
-        daemon_exe.model(opts.package_dir, opts.unpack_dir, opts.model_dir, verbose=opts.verbose)
+        with profiler.span("model"):
+            # every library package any daemon needs, each fetched once
+            Package.retrieve_all([lib._package for exe in daemons for lib in exe.libraries() or []], opts.package_dir,
+                                 dependencies=False)
+            for daemon_exe in daemons:
+                opts.verbose and print(f"Creating model for {daemon_exe.name}")
+                daemon_exe.model(opts.package_dir, unpack_dir, model_dir,
+                                 incremental=opts.incremental, extras=opts.extras, verbose=opts.verbose)
+
+    return (arch, model_dir, daemons)
 
-    # Create and print the package manifest
-    opts.manifest and print(yaml.dump(daemon_exe.manifest()))
+
+def build_from_lock(opts, lock_path):
+    """
+    Place the model trees pinned in a lockfile without any dnf query or
+    resolution. Every RPM is fetched at once and checked against its
+    sha256, and every file placed is checked against its own. Return
+    builds as build() does.
+    """
+    images = lockfile.read(lock_path)
+    executables = [DynamicExecutable.from_lock(image) for image in images]
+
+    opts.verbose and print(f"Retrieving pinned packages from {lock_path}")
+    packages = {pkg.rpm: pkg for exe in executables for pkg in exe._sources.values()}
+    with profiler.span("retrieve"):
+        Package.retrieve_all(list(packages.values()), opts.package_dir, dependencies=False)
+        lockfile.verify_rpms([rpm for image in images for rpm in image['rpms']], opts.package_dir, remove=True)
+
+    builds = {}
+    with profiler.span("model"):
+        for exe in executables:
+            (unpack_dir, model_dir) = arch_dirs(opts, exe.arch)
+            opts.verbose and print(f"Creating model for {exe.name} from {lock_path}")
+            placed = exe.place(exe._plan, exe._sources, opts.package_dir, model_dir,
+                               incremental=opts.incremental, verbose=opts.verbose)
+            lockfile.verify_files(f"{model_dir}/{exe.name}", exe._plan, placed)
+            builds.setdefault(exe.arch, (exe.arch, model_dir, []))[2].append(exe)
+
+    return list(builds.values())
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+        
+    opts = parse_args()
+
+    DynamicExecutable.scan_workers = opts.scan_workers
+
+    # Time every step if asked, before any work starts
+    opts.profile is not None and profiler.enable()
+
+    # All package downloads share one bounded pool
+    try:
+        min_rate = units.parse_size(opts.min_rate) if opts.min_rate is not None else None
+        mirrors = fetch.Mirrors.load(opts.mirrorlist, opts.metalink)
+    except (fetch.DownloadError, OSError, ValueError) as e:
+        sys.exit(str(e))
+    fetch.shared_pool(workers=opts.download_workers, mirrors=mirrors, min_rate=min_rate, verbose=opts.verbose)
+
+    # Share downloads and unpacked trees safely with concurrent builds
+    if opts.shared_workdir:
+        Package.workdirs = workdir.Workdirs(verbose=opts.verbose)
+    try:
+        workdir_cap = units.parse_size(opts.workdir_cap) if opts.workdir_cap is not None else None
+    except ValueError as e:
+        sys.exit(str(e))
+
+    # Share package files and placed files through the content store
+    if opts.store:
+        Package.store = store.ContentStore(opts.store_dir, placement=opts.placement, verbose=opts.verbose)
+
+    # Look packages up in the offline repodata index if there is one
+    if opts.repo_index is not None:
+        Package.index = repodata.RepoIndex(opts.repo_index)
+
+    # Reuse dnf answers from earlier runs until the repo metadata changes
+    if opts.cache:
+        Package.cache = metacache.MetadataCache(
+            opts.cache_file,
+            ttl=opts.cache_ttl or None,
+            revision=metacache.repo_revision(),
+            refresh=opts.refresh_cache)
+
+    # Build for each target arch at once, each in its own directories
+    arches = [a for arch in opts.arches for a in arch.split(",") if a] if opts.arches else [None]
+
+    # Report what a build would download and stop
+    if opts.plan:
+        opts.from_lock is not None and sys.exit("--plan does not apply to --from-lock builds")
+        try:
+            with profiler.span("plan"):
+                reports = [FetchPlan([Package(name, arch=arch) for name in opts.packages], arch=arch)
+                           .report(opts.package_dir) for arch in arches]
+        except ValueError as e:
+            sys.exit(str(e))
+        print(yaml.dump_all(reports, sort_keys=False))
+        if profiler.active() is not None:
+            profiler.active().write(opts.profile)
+        sys.exit(0)
+
+    if opts.from_lock is not None:
+        try:
+            builds = build_from_lock(opts, opts.from_lock)
+        except (lockfile.LockError, store.StoreError, OSError) as e:
+            sys.exit(str(e))
+    elif len(arches) == 1:
+        builds = [build(opts, arches[0])]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(arches), thread_name_prefix="arch") as executor:
+            builds = list(executor.map(functools.partial(build, opts), arches))
+
+    modelled = opts.model or opts.from_lock is not None
+
+    # Pin everything the model trees were built from
+    if opts.write_lock is not None and modelled:
+        lockfile.write(opts.write_lock, [exe.lock(opts.package_dir, model_dir)
+                                         for (arch, model_dir, daemons) in builds for exe in daemons])
+        opts.verbose and print(f"lockfile: {opts.write_lock}")
+
+    # Shrink the model trees and check their size
+    if (opts.minimize or opts.size_budget) and modelled:
+        try:
+            budget = minimize.parse_budget(opts.size_budget)
+            failures = []
+            with profiler.span("minimize"):
+                for (arch, model_dir, daemons) in builds:
+                    for daemon_exe in daemons:
+                        report = daemon_exe.minimize(model_dir, strip=opts.minimize and opts.strip,
+                                                     dedupe=opts.minimize and opts.dedupe, verbose=opts.verbose)
+                        opts.verbose and print(minimize.report_table(report))
+                        failures += [f"{daemon_exe._label()}: {problem}"
+                                     for problem in minimize.check(report, budget)]
+        except (minimize.MinimizeError, elffile.ElfError, ValueError) as e:
+            sys.exit(str(e))
+        failures and sys.exit("\n".join(failures))
+
+    # Write the model trees into an image layout
+    if opts.oci_layout is not None and modelled:
+        try:
+            settings = ocilayout.image_settings(opts)
+            with profiler.span("image"):
+                if all(arch is None for (arch, model_dir, daemons) in builds):
+                    for (arch, model_dir, daemons) in builds:
+                        # the files every daemon shares go in one layer of the same digest
+                        common = DynamicExecutable.common_files(daemons, model_dir) if opts.split_layers else None
+                        for daemon_exe in daemons:
+                            layers = daemon_exe.layers(model_dir, common) if opts.split_layers else None
+                            daemon_exe.image(model_dir, opts.oci_layout, opts.oci_tag, settings, layers=layers,
+                                             verbose=opts.verbose)
+                else:
+                    # one image index per daemon holding an image for each arch
+                    DynamicExecutable.multiarch_image(builds, opts.oci_layout, opts.oci_tag, settings,
+                                                      split=opts.split_layers, verbose=opts.verbose)
+        except (ocilayout.OciError, ValueError) as e:
+            sys.exit(str(e))
+
+    # Create and print a manifest for each daemon
+    opts.manifest and print(yaml.dump_all([exe.manifest() for (arch, model_dir, daemons) in builds for exe in daemons]))
+
+    Package.cache is not None and opts.verbose and print(f"metadata cache: {Package.cache.stats}")
+    opts.verbose and print(f"downloads:\n{fetch.shared_pool().report()}")
+
+    # End this build's sessions, then keep the shared directories to their cap
+    if Package.workdirs is not None:
+        Package.workdirs.close()
+        if workdir_cap is not None:
+            removed = Package.workdirs.evict(workdir_cap)
+            opts.verbose and print(f"evicted {len(removed)} work directory entries")
+
+    if profiler.active() is not None:
+        paths = profiler.active().write(opts.profile)
+        opts.verbose and print(f"profile: {paths[0]} {paths[1]}")
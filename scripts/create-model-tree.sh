@@ -7,9 +7,12 @@
 #
 
 BINARY=$1
-ARCH=$(uname -m)
+SCRIPT_DIR=$(dirname $0)
 
 # Allow overrides from environment variables
+# ldd only reads binaries for the host arch: use
+# create-model-tree.py --arch to build for other arches
+: ARCH=${ARCH:=$(uname -m)}
 : WORKDIR_ROOT=${WORKDIR_ROOT:=./workdir}
 : PACKAGE_DIR=${PACKAGE_DIR:=${WORKDIR_ROOT}/rpms}
 : UNPACK_ROOT=${UNPACK_ROOT:=${WORKDIR_ROOT}/unpack}
@@ -210,8 +213,9 @@ function find_libraries() {
 
     [ -z "${DEBUG}" ] || echo "discovering shared libraries on ${exe_path}" >&2
 
-    # Select Only lines with filenames and only one file path
-    ldd ${exe_path} | grep / | sed 's|^[^/]*/|/|;s/ .*$//' | sort -u
+    # Read the ELF headers rather than running the binary with ldd.
+    # Search the package tree first, then the host for anything else
+    python3 ${SCRIPT_DIR}/elffile.py --root ${unpack_dir} --root / ${exe_path} | sort -u
 }
 
 #
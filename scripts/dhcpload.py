@@ -0,0 +1,714 @@
+#!/usr/bin/env python
+"""
+DHCP load generator and benchmark of the dhcpd images
+
+* Simulated clients, each with its own MAC address, run DISCOVER/OFFER
+  and REQUEST/ACK handshakes concurrently over one UDP socket
+  (asyncio), then release their lease so the pool does not run out
+* A target is started in a network namespace joined to this one by a
+  veth pair, and the clients broadcast to it as they would on a LAN
+  (needs root). A server that is already running is reached as a relay
+  agent (giaddr) at its address, or by broadcast on an interface.
+* Reported for each target: the time from start to the first OFFER,
+  handshakes a second, latency percentiles of each exchange, timeouts
+  and NAKs
+* Reports of two runs, e.g. before and after the model tree's
+  libraries change, can be compared
+
+Targets:
+  image:<ref>       a dhcpd image, run with podman as dhcpd.container does
+  binary:<path>     the dhcpd binary
+  stand-in          a minimal DHCP server in this script, to check the harness
+  server:<address>  a server that is already running
+
+A started target gets example/etc/dhcp/dhcpd.conf followed by a subnet
+for the test network with a range for the clients.
+
+USAGE:
+    dhcpload.py [--clients 64] [--duration 10] [--report <file>] <name>=<target> ...
+    dhcpload.py compare <old report> <new report>
+    dhcpload.py stand-in [--interface <name>] [--address <address>] --network <cidr>
+"""
+
+import argparse
+import asyncio
+import contextlib
+import ipaddress
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+example_config = os.path.join(os.path.dirname(script_dir), "example", "etc", "dhcp", "dhcpd.conf")
+
+SERVER_PORT = 67
+CLIENT_PORT = 68
+
+MAGIC_COOKIE = b"\x63\x82\x53\x63"
+
+# DHCP message types (option 53)
+DISCOVER = 1
+OFFER = 2
+REQUEST = 3
+DECLINE = 4
+ACK = 5
+NAK = 6
+RELEASE = 7
+
+# options
+OPTION_REQUESTED_ADDRESS = 50
+OPTION_LEASE_TIME = 51
+OPTION_MESSAGE_TYPE = 53
+OPTION_SERVER_ID = 54
+OPTION_PARAMETERS = 55
+OPTION_CLIENT_ID = 61
+OPTION_SUBNET_MASK = 1
+OPTION_END = 255
+
+# op, htype, hlen, hops, xid, secs, flags, ciaddr, yiaddr, siaddr, giaddr, chaddr, sname, file
+_header = struct.Struct("!BBBBIHH4s4s4s4s16s64s128s")
+
+# ask for the server to broadcast its replies: the client has no address yet
+BROADCAST_FLAG = 0x8000
+
+# Names of the veth pair and the namespace the server runs in
+veth_client = "dhcpload0"
+veth_server = "dhcpload1"
+
+
+class LoadError(Exception):
+    pass
+
+
+# ------------------------------------------------------------------------------
+# Packets
+# ------------------------------------------------------------------------------
+def packet(message_type, xid, mac, giaddr="0.0.0.0", ciaddr="0.0.0.0", yiaddr="0.0.0.0", reply=False,
+           options=()):
+    """
+    A BOOTP request (or reply) with a DHCP message type and options, given
+    as (code, bytes)
+    """
+    relayed = giaddr != "0.0.0.0"
+    header = _header.pack(2 if reply else 1, 1, 6, 1 if relayed and not reply else 0, xid, 0,
+                          0 if relayed or reply else BROADCAST_FLAG,
+                          socket.inet_aton(ciaddr), socket.inet_aton(yiaddr), bytes(4), socket.inet_aton(giaddr),
+                          mac.ljust(16, b"\0"), bytes(64), bytes(128))
+    body = [MAGIC_COOKIE, bytes([OPTION_MESSAGE_TYPE, 1, message_type])]
+    for (code, value) in options:
+        body.append(bytes([code, len(value)]) + value)
+    body.append(bytes([OPTION_END]))
+    data = header + b"".join(body)
+    # the smallest BOOTP message some servers and relays accept
+    return data.ljust(300, b"\0")
+
+
+def parse(data):
+    """
+    The fields and options of a BOOTP message, or None if it is not DHCP
+    """
+    if len(data) < _header.size + 4 or data[_header.size:_header.size + 4] != MAGIC_COOKIE:
+        return None
+    (op, htype, hlen, hops, xid, secs, flags, ciaddr, yiaddr, siaddr, giaddr, chaddr, sname, file) = \
+        _header.unpack_from(data)
+    options = {}
+    pos = _header.size + 4
+    while pos < len(data):
+        code = data[pos]
+        if code == OPTION_END:
+            break
+        if code == 0:
+            pos += 1
+            continue
+        if pos + 1 >= len(data):
+            break
+        length = data[pos + 1]
+        options[code] = data[pos + 2:pos + 2 + length]
+        pos += 2 + length
+    message_type = options.get(OPTION_MESSAGE_TYPE)
+    return {
+        'op': op,
+        'hops': hops,
+        'xid': xid,
+        'flags': flags,
+        'type': message_type[0] if message_type else None,
+        'ciaddr': socket.inet_ntoa(ciaddr),
+        'yiaddr': socket.inet_ntoa(yiaddr),
+        'giaddr': socket.inet_ntoa(giaddr),
+        'mac': chaddr[:hlen],
+        'options': options,
+    }
+
+
+def client_mac(n):
+    # locally administered, one for each simulated client
+    return bytes([0x02, 0x00]) + n.to_bytes(4, "big")
+
+
+def udp_socket(address="", port=CLIENT_PORT, interface=None):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    try:
+        interface and s.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode())
+        s.bind((address, port))
+    except OSError as e:
+        s.close()
+        raise LoadError(f"cannot listen on {address or '*'}:{port}{f' on {interface}' if interface else ''}: {e}")
+    s.setblocking(False)
+    return s
+
+
+# ------------------------------------------------------------------------------
+# Clients
+# ------------------------------------------------------------------------------
+class _Replies(asyncio.DatagramProtocol):
+    """
+    Hand each server reply to the exchange waiting for its xid
+    """
+
+    def __init__(self):
+        self.waiting = {}
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        message = parse(data)
+        if message is None or message['op'] != 2:
+            return
+        waiter = self.waiting.get(message['xid'])
+        if waiter is not None:
+            (types, future) = waiter
+            if message['type'] in types and not future.done():
+                future.set_result((time.perf_counter(), message))
+
+
+def percentiles(values):
+    """
+    p50, p90, p99 and max of latencies, in milliseconds
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def at(fraction):
+        # the nearest rank: the smallest value with fraction of them at or below it
+        return round(ordered[max(0, math.ceil(fraction * len(ordered)) - 1)] * 1000, 3)
+
+    return {'p50': at(0.50), 'p90': at(0.90), 'p99': at(0.99), 'max': round(ordered[-1] * 1000, 3)}
+
+
+class LoadGenerator(object):
+    """
+    Simulated clients sharing one socket. Replies are broadcast to the
+    client port, or sent to the relay address (giaddr) when there is one.
+    """
+
+    def __init__(self, server="255.255.255.255", relay=None, interface=None, timeout=2.0, port=SERVER_PORT,
+                 verbose=False):
+        self._server = server
+        self._relay = relay
+        self._port = port
+        self._interface = interface
+        self._timeout = timeout
+        self._verbose = verbose
+        self._replies = None
+        self._xids = random.Random()
+        self.latencies = {'offer': [], 'ack': [], 'handshake': []}
+        self.counts = {'handshakes': 0, 'timeouts': 0, 'naks': 0}
+
+    @property
+    def _giaddr(self):
+        return self._relay or "0.0.0.0"
+
+    async def __aenter__(self):
+        sock = udp_socket(self._relay or "", self._port if self._relay else CLIENT_PORT, self._interface)
+        loop = asyncio.get_running_loop()
+        (transport, self._replies) = await loop.create_datagram_endpoint(_Replies, sock=sock)
+        return self
+
+    async def __aexit__(self, *exc):
+        self._replies.transport.close()
+
+    def _send(self, data, to=None):
+        self._replies.transport.sendto(data, (to or self._server, self._port))
+
+    def _xid(self):
+        while True:
+            xid = self._xids.getrandbits(32)
+            if xid not in self._replies.waiting:
+                return xid
+
+    async def _exchange(self, data, xid, types, to=None, timeout=None):
+        """
+        Send a request and return (time, reply), or None on a timeout
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._replies.waiting[xid] = (types, future)
+        try:
+            self._send(data, to)
+            return await asyncio.wait_for(future, timeout or self._timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._replies.waiting.pop(xid, None)
+
+    def _options(self, mac):
+        return [(OPTION_CLIENT_ID, b"\x01" + mac),
+                (OPTION_PARAMETERS, bytes([OPTION_SUBNET_MASK, 3, 6, 15, OPTION_LEASE_TIME]))]
+
+    async def handshake(self, mac):
+        """
+        DISCOVER, OFFER, REQUEST, ACK and RELEASE for one client. Return
+        True if it was granted a lease.
+        """
+        xid = self._xid()
+        start = time.perf_counter()
+        offered = await self._exchange(packet(DISCOVER, xid, mac, giaddr=self._giaddr, options=self._options(mac)),
+                                       xid, (OFFER,))
+        if offered is None:
+            self.counts['timeouts'] += 1
+            return False
+        (offer_time, offer) = offered
+        server_id = offer['options'].get(OPTION_SERVER_ID, b"")
+        request = packet(REQUEST, xid, mac, giaddr=self._giaddr, options=self._options(mac) + [
+            (OPTION_REQUESTED_ADDRESS, socket.inet_aton(offer['yiaddr'])), (OPTION_SERVER_ID, server_id)])
+        acked = await self._exchange(request, xid, (ACK, NAK))
+        if acked is None:
+            self.counts['timeouts'] += 1
+            return False
+        (ack_time, ack) = acked
+        if ack['type'] == NAK:
+            self.counts['naks'] += 1
+            return False
+
+        self.latencies['offer'].append(offer_time - start)
+        self.latencies['ack'].append(ack_time - offer_time)
+        self.latencies['handshake'].append(ack_time - start)
+        self.counts['handshakes'] += 1
+
+        # RELEASE is unicast to the server, which does not answer it
+        if len(server_id) == 4:
+            self._send(packet(RELEASE, self._xid(), mac, giaddr=self._giaddr, ciaddr=ack['yiaddr'],
+                              options=[(OPTION_SERVER_ID, server_id), (OPTION_CLIENT_ID, b"\x01" + mac)]),
+                       socket.inet_ntoa(server_id) if self._relay is None else None)
+        return True
+
+    async def first_offer(self, started, deadline, interval=0.05, stopped=None):
+        """
+        The seconds from started to the first OFFER, asking again every
+        interval seconds until deadline or the server stops, or None
+        """
+        mac = client_mac(0xffffffff)
+        xid = self._xid()
+        while time.perf_counter() < deadline and (stopped is None or stopped() is None):
+            offered = await self._exchange(
+                packet(DISCOVER, xid, mac, giaddr=self._giaddr, options=self._options(mac)), xid, (OFFER,),
+                timeout=interval)
+            if offered is not None:
+                return offered[0] - started
+        return None
+
+    async def run(self, clients, duration):
+        """
+        Keep clients handshaking at once for duration seconds. Return the
+        results.
+        """
+        deadline = time.perf_counter() + duration
+
+        async def client(n):
+            mac = client_mac(n)
+            while time.perf_counter() < deadline:
+                await self.handshake(mac)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client(n) for n in range(clients)))
+        elapsed = time.perf_counter() - start
+        self._verbose and print(f"  {self.counts['handshakes']} handshakes in {elapsed:.1f}s")
+        return {
+            'clients': clients,
+            'seconds': round(elapsed, 6),
+            'handshakes_per_second': round(self.counts['handshakes'] / elapsed, 3),
+            'counts': dict(self.counts),
+            'latency_ms': {name: percentiles(values) for (name, values) in self.latencies.items()},
+        }
+
+
+# ------------------------------------------------------------------------------
+# Stand-in server
+# ------------------------------------------------------------------------------
+class StandIn(object):
+    """
+    A DHCP server that offers each MAC the next free address of a
+    network, to check the harness where there is no dhcpd. Only a MAC
+    that was offered an address is granted one.
+    """
+
+    def __init__(self, network, address, interface=None, lease_time=600, port=SERVER_PORT):
+        self._network = ipaddress.ip_network(network)
+        self._address = address
+        self._interface = interface
+        self._lease_time = lease_time
+        self._port = port
+        self._free = (str(a) for a in self._network.hosts() if str(a) != address)
+        self._released = []
+        self._leases = {}
+        self._options = [(OPTION_SERVER_ID, socket.inet_aton(address)),
+                         (OPTION_LEASE_TIME, lease_time.to_bytes(4, "big")),
+                         (OPTION_SUBNET_MASK, self._network.netmask.packed)]
+
+    @property
+    def leases(self):
+        return dict(self._leases)
+
+    def _lease(self, mac):
+        if mac not in self._leases:
+            address = self._released.pop() if self._released else next(self._free, None)
+            if address is None:
+                return None
+            self._leases[mac] = address
+        return self._leases[mac]
+
+    def answer(self, request):
+        """
+        The reply to a parsed request and where to send it, or None
+        """
+        if request is None or request['op'] != 1:
+            return None
+        mac = request['mac']
+        if request['type'] == DISCOVER:
+            address = self._lease(mac)
+            if address is None:
+                return None
+            reply = OFFER
+        elif request['type'] == REQUEST:
+            address = self._leases.get(mac)
+            wanted = request['options'].get(OPTION_REQUESTED_ADDRESS)
+            reply = ACK if address is not None and wanted == socket.inet_aton(address) else NAK
+        elif request['type'] == RELEASE:
+            address = self._leases.pop(mac, None)
+            address is not None and self._released.append(address)
+            return None
+        else:
+            return None
+        response = packet(reply, request['xid'], mac, giaddr=request['giaddr'], reply=True,
+                          yiaddr=address if reply != NAK else "0.0.0.0", options=self._options)
+        relayed = request['giaddr'] != "0.0.0.0"
+        return (response, (request['giaddr'], self._port) if relayed else ("255.255.255.255", CLIENT_PORT))
+
+    def serve(self):
+        sock = udp_socket("", self._port, self._interface)
+        sock.setblocking(True)
+        while True:
+            (data, _) = sock.recvfrom(4096)
+            answer = self.answer(parse(data))
+            answer is not None and sock.sendto(*answer)
+
+
+# ------------------------------------------------------------------------------
+# Test network and targets
+# ------------------------------------------------------------------------------
+def _run(*command):
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode != 0:
+        raise LoadError(f"{' '.join(command)}: {result.stdout.strip()}")
+
+
+class TestNetwork(object):
+    """
+    A network namespace for the server and a veth pair between it and
+    this namespace:
+
+    dhcpload0  <client address>   here, where the clients run
+    dhcpload1  <server address>   in the namespace, where the server runs
+    """
+
+    def __init__(self, network, verbose=False):
+        self.network = ipaddress.ip_network(network)
+        if self.network.version != 4 or self.network.num_addresses < 16:
+            raise LoadError(f"{network}: an IPv4 network of at least 16 addresses is needed")
+        self.namespace = f"dhcpload-{os.getpid()}"
+        self.server_address = str(self.network.network_address + 1)
+        self.client_address = str(self.network.broadcast_address - 1)
+        # the lower quarter is left for the server and any fixed addresses
+        self.range = (str(self.network.network_address + self.network.num_addresses // 4),
+                      str(self.network.broadcast_address - 2))
+        self._verbose = verbose
+
+    def __enter__(self):
+        prefix = self.network.prefixlen
+        _run("ip", "netns", "add", self.namespace)
+        try:
+            _run("ip", "link", "add", veth_client, "type", "veth", "peer", "name", veth_server)
+            _run("ip", "link", "set", veth_server, "netns", self.namespace)
+            _run("ip", "addr", "add", f"{self.client_address}/{prefix}", "dev", veth_client)
+            _run("ip", "link", "set", veth_client, "up")
+            _run("ip", "netns", "exec", self.namespace, "ip", "addr", "add", f"{self.server_address}/{prefix}",
+                 "dev", veth_server)
+            _run("ip", "netns", "exec", self.namespace, "ip", "link", "set", veth_server, "up")
+            _run("ip", "netns", "exec", self.namespace, "ip", "link", "set", "lo", "up")
+        except LoadError:
+            self.__exit__()
+            raise
+        self._verbose and print(f"network {self.network}: clients on {veth_client}, server in {self.namespace}")
+        return self
+
+    def __exit__(self, *exc):
+        # the veth pair goes with the namespace
+        subprocess.run(["ip", "link", "delete", veth_client], stderr=subprocess.DEVNULL)
+        subprocess.run(["ip", "netns", "delete", self.namespace], stderr=subprocess.DEVNULL)
+
+    def exec_prefix(self):
+        return ["ip", "netns", "exec", self.namespace]
+
+
+def write_config(path, network):
+    """
+    The example dhcpd.conf followed by the test subnet
+    """
+    with open(example_config) as f:
+        example = f.read()
+    with open(path, "w") as f:
+        f.write(example.rstrip("\n") + "\n\n"
+                "# added by dhcpload.py for the test network\n"
+                "authoritative;\n"
+                "ddns-update-style none;\n"
+                "default-lease-time 600;\n"
+                "max-lease-time 600;\n\n"
+                f"subnet {network.network.network_address} netmask {network.network.netmask} {{\n"
+                f"  range {network.range[0]} {network.range[1]};\n"
+                "}\n")
+
+
+def parse_target(spec):
+    """
+    (name, kind, value) from <name>=<kind>[:<value>]
+    """
+    (name, _, target) = spec.rpartition("=")
+    (kind, _, value) = target.partition(":")
+    if kind not in ("image", "binary", "stand-in", "server") or (kind != "stand-in" and not value):
+        raise LoadError(f"{spec}: a target is image:<ref>, binary:<path>, stand-in or server:<address>")
+    return (name or target, kind, value)
+
+
+class Target(object):
+    """
+    A DHCP server started in the test network, stopped on exit
+    """
+
+    def __init__(self, name, kind, value, network, workdir, verbose=False):
+        self.name = name
+        self._kind = kind
+        self._value = value
+        self._network = network
+        self._workdir = os.path.join(workdir, name)
+        self._verbose = verbose
+        self._process = None
+        self._log = None
+        self._container = f"dhcpload-{name}-{os.getpid()}"
+
+    def command(self):
+        config = os.path.join(self._workdir, "dhcpd.conf")
+        lease_dir = os.path.join(self._workdir, "dhcpd")
+        os.makedirs(lease_dir, exist_ok=True)
+        write_config(config, self._network)
+        # dhcpd will not start without its lease file
+        open(os.path.join(lease_dir, "dhcpd.leases"), "w").close()
+
+        if self._kind == "image":
+            return ["podman", "run", "--rm", "--name", self._container, "--privileged",
+                    "--network", f"ns:/run/netns/{self._network.namespace}",
+                    "--volume", f"{config}:/etc/dhcp/dhcpd.conf:ro,Z",
+                    "--volume", f"{lease_dir}:/var/lib/dhcpd:rw,Z",
+                    self._value]
+        if self._kind == "binary":
+            return self._network.exec_prefix() + [
+                self._value, "-f", "-d", "--no-pid", "-cf", config, "-lf", os.path.join(lease_dir, "dhcpd.leases"),
+                veth_server]
+        return self._network.exec_prefix() + [
+            sys.executable, os.path.abspath(__file__), "stand-in", "--interface", veth_server,
+            "--address", self._network.server_address, "--network", str(self._network.network)]
+
+    def __enter__(self):
+        command = self.command()
+        self._verbose and print(f"{self.name}: {' '.join(command)}")
+        self._log = open(os.path.join(self._workdir, "server.log"), "w")
+        try:
+            self._process = subprocess.Popen(command, stdout=self._log, stderr=subprocess.STDOUT)
+        except OSError as e:
+            self._log.close()
+            raise LoadError(f"{self.name}: cannot start {command[0]}: {e}")
+        return self
+
+    def __exit__(self, *exc):
+        if self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+        self._kind == "image" and subprocess.run(["podman", "rm", "--force", self._container],
+                                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._log.close()
+
+    def exited(self):
+        """
+        The end of the server log if it has stopped, else None
+        """
+        if self._process.poll() is None:
+            return None
+        with open(os.path.join(self._workdir, "server.log"), errors="replace") as f:
+            return f"exited with {self._process.returncode}: " + "".join(f.readlines()[-5:]).strip()
+
+
+# ------------------------------------------------------------------------------
+# Runs
+# ------------------------------------------------------------------------------
+async def _measure(generator, clients, duration, started, start_timeout, check=None):
+    async with generator:
+        first = await generator.first_offer(started, started + start_timeout, stopped=check)
+        if first is None:
+            problem = check() if check is not None else None
+            raise LoadError(f"no OFFER: the server {problem}" if problem else f"no OFFER within {start_timeout}s")
+        result = await generator.run(clients, duration)
+    result['first_offer_ms'] = round(first * 1000, 3)
+    return result
+
+
+def benchmark_target(spec, network, workdir, clients, duration, timeout, start_timeout, relay=None,
+                     interface=None, verbose=False):
+    """
+    Start a target, or use a running one, and put it under load
+    """
+    (name, kind, value) = parse_target(spec)
+    verbose and print(f"{name}: {kind} {value}".rstrip())
+
+    if kind == "server":
+        if relay is None and interface is None:
+            raise LoadError(f"{name}: a running server is reached with --relay or --interface")
+        generator = LoadGenerator(server=value if relay else "255.255.255.255", relay=relay, interface=interface,
+                                  timeout=timeout, verbose=verbose)
+        result = asyncio.run(_measure(generator, clients, duration, time.perf_counter(), start_timeout))
+    else:
+        if network is None:
+            raise LoadError(f"{name}: a started target needs the test network")
+        generator = LoadGenerator(interface=veth_client, timeout=timeout, verbose=verbose)
+        with Target(name, kind, value, network, workdir, verbose=verbose) as target:
+            started = time.perf_counter()
+            result = asyncio.run(_measure(generator, clients, duration, started, start_timeout, target.exited))
+
+    verbose and print(f"  first OFFER {result['first_offer_ms']}ms, {result['handshakes_per_second']}/s, "
+                      f"handshake {result['latency_ms']['handshake']}")
+    return dict(result, name=name, target=f"{kind}:{value}".rstrip(":"))
+
+
+def report_table(report):
+    lines = [f"{'target':<16} {'first ms':>9} {'hs/s':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} "
+             f"{'max ms':>8} {'timeout':>7} {'nak':>5}"]
+    for r in report['targets']:
+        latency = r['latency_ms']['handshake'] or {'p50': 0, 'p90': 0, 'p99': 0, 'max': 0}
+        lines.append(f"{r['name']:<16} {r['first_offer_ms']:>9.1f} {r['handshakes_per_second']:>9.1f} "
+                     f"{latency['p50']:>8.2f} {latency['p90']:>8.2f} {latency['p99']:>8.2f} {latency['max']:>8.2f} "
+                     f"{r['counts']['timeouts']:>7} {r['counts']['naks']:>5}")
+    return "\n".join(lines)
+
+
+def compare(old, new):
+    """
+    The change in start time, rate and median latency of each target in
+    both reports
+    """
+    (before, after) = ({r['name']: r for r in old['targets']}, {r['name']: r for r in new['targets']})
+    lines = [f"{'target':<16} {'measure':<12} {'old':>9} {'new':>9} {'change':>8}"]
+    for name in sorted(set(before) & set(after)):
+        for (measure, get) in (("first ms", lambda r: r['first_offer_ms']),
+                               ("hs/s", lambda r: r['handshakes_per_second']),
+                               ("p50 ms", lambda r: (r['latency_ms']['handshake'] or {}).get('p50', 0.0)),
+                               ("p99 ms", lambda r: (r['latency_ms']['handshake'] or {}).get('p99', 0.0))):
+            (a, b) = (get(before[name]), get(after[name]))
+            change = (b - a) / a * 100 if a else 0.0
+            lines.append(f"{name:<16} {measure:<12} {a:>9.2f} {b:>9.2f} {change:>+7.1f}%")
+    return "\n".join(lines)
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1 and sys.argv[1] == "stand-in":
+        parser = argparse.ArgumentParser(prog="dhcpload.py stand-in")
+        parser.add_argument("--interface", default=None)
+        parser.add_argument("--address", default=None, help="the server identifier, default the first host")
+        parser.add_argument("--network", required=True)
+        opts = parser.parse_args(sys.argv[2:])
+        try:
+            address = opts.address or str(next(ipaddress.ip_network(opts.network).hosts()))
+            StandIn(opts.network, address, interface=opts.interface).serve()
+        except LoadError as e:
+            sys.exit(str(e))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        parser = argparse.ArgumentParser(prog="dhcpload.py compare")
+        parser.add_argument("old")
+        parser.add_argument("new")
+        opts = parser.parse_args(sys.argv[2:])
+        with open(opts.old) as f_old, open(opts.new) as f_new:
+            print(compare(json.load(f_old), json.load(f_new)))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="put DHCP servers under load and time them")
+    parser.add_argument('--verbose', '-v', action=argparse.BooleanOptionalAction)
+    parser.add_argument("--clients", type=int, default=64, help="clients handshaking at once")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load on each target")
+    parser.add_argument("--timeout", type=float, default=2, help="seconds to wait for each reply")
+    parser.add_argument("--start-timeout", type=float, default=60, help="seconds to wait for the first OFFER")
+    parser.add_argument("--network", default="10.99.0.0/16", help="the test network of started targets")
+    parser.add_argument("--relay", default=None, help="reach a running server as a relay agent with this address")
+    parser.add_argument("--interface", default=None, help="reach a running server by broadcast on this interface")
+    parser.add_argument("--workdir", default=None, help="keep the configurations and server logs here")
+    parser.add_argument("--report", default=None, help="write the JSON report to this file")
+    parser.add_argument("targets", nargs="+", metavar="[name=]target",
+                        help="image:<ref>, binary:<path>, stand-in or server:<address>")
+    opts = parser.parse_args()
+
+    workdir = opts.workdir or tempfile.mkdtemp(prefix="dhcpload-")
+    try:
+        started = [spec for spec in opts.targets if parse_target(spec)[1] != "server"]
+        with TestNetwork(opts.network, verbose=opts.verbose) if started else contextlib.nullcontext() as network:
+            report = {
+                'created': time.time(),
+                'host': {'python': platform.python_version(), 'machine': platform.machine(),
+                         'system': platform.platform(), 'cpus': os.cpu_count()},
+                'parameters': {'clients': opts.clients, 'duration': opts.duration, 'timeout': opts.timeout,
+                               'network': opts.network},
+                'targets': [benchmark_target(spec, network, workdir, opts.clients, opts.duration, opts.timeout,
+                                             opts.start_timeout, relay=opts.relay, interface=opts.interface,
+                                             verbose=opts.verbose)
+                            for spec in opts.targets],
+            }
+    except LoadError as e:
+        sys.exit(str(e))
+    finally:
+        opts.workdir is None and shutil.rmtree(workdir, ignore_errors=True)
+
+    print(report_table(report))
+    if opts.report is not None:
+        with open(opts.report, "w") as f:
+            json.dump(report, f, indent=1)
@@ -0,0 +1,537 @@
+#!/usr/bin/env python
+"""
+Read the dynamic linking information from ELF files without running them.
+
+* Read PT_INTERP, DT_NEEDED, DT_SONAME, DT_RPATH and DT_RUNPATH
+* Walk the transitive closure of shared libraries for an executable,
+  searching one or more unpacked file trees instead of the host
+* Find and classify the executables in a tree (dynamic, PIE, static,
+  shared object or script) from their headers alone
+
+This replaces `ldd` which executes the target through its dynamic loader
+and resolves against the libraries installed on the host.
+
+USAGE: elffile.py [--root <tree>]... <elf file>
+       elffile.py --scan [--workers N] <tree>
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import mmap
+import os
+import struct
+import sys
+
+# e_ident values
+ELFMAG = b"\x7fELF"
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+# e_type values
+ET_EXEC = 2
+ET_DYN = 3
+
+# p_type values
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+# d_tag values
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# struct layouts after e_ident, for each ELF class
+_header_format = {
+    ELFCLASS32: "HHIIIIIHHHHHH",
+    ELFCLASS64: "HHIQQQIHHHHHH",
+}
+
+_phdr_format = {
+    # p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags, p_align
+    ELFCLASS32: "IIIIIIII",
+    # p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_align
+    ELFCLASS64: "IIQQQQQQ",
+}
+
+_dyn_format = {
+    ELFCLASS32: "iI",
+    ELFCLASS64: "qQ",
+}
+
+# Kinds of executable file reported by classify() and scan()
+DYNAMIC = "dynamic"     # ET_EXEC with a program interpreter
+PIE = "pie"             # ET_DYN with a program interpreter
+STATIC = "static"       # no program interpreter and no dynamic section
+SHARED = "shared"       # ET_DYN with a dynamic section but no interpreter
+SCRIPT = "script"       # starts with #!
+
+# The kinds that need their shared libraries resolved
+needs_resolution = (DYNAMIC, PIE)
+
+# scan() reads headers in parallel only for more files than this
+parallel_threshold = 256
+
+# Default library directories searched by the Fedora dynamic loader
+default_lib_dirs = {
+    ELFCLASS32: ["/lib", "/usr/lib"],
+    ELFCLASS64: ["/lib64", "/usr/lib64"],
+}
+
+
+class ElfError(Exception):
+    pass
+
+
+class ElfFile(object):
+    """
+    The dynamic linking records of a single ELF file.
+
+    The file is mapped and parsed once when the object is created. Only
+    the parsed values are kept.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._interp = None
+        self._needed = []
+        self._soname = None
+        self._rpath = []
+        self._runpath = []
+        self._dynamic = False
+
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 64:
+                raise ElfError(f"not an ELF file: {path}")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self._parse(data)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def elf_class(self):
+        return self._class
+
+    @property
+    def machine(self):
+        return self._machine
+
+    @property
+    def elf_type(self):
+        return self._type
+
+    @property
+    def interp(self):
+        return self._interp
+
+    @property
+    def needed(self):
+        return self._needed
+
+    @property
+    def soname(self):
+        return self._soname
+
+    @property
+    def rpath(self):
+        return self._rpath
+
+    @property
+    def runpath(self):
+        return self._runpath
+
+    @property
+    def dynamic(self):
+        """
+        True if the file has a dynamic section and so needs a loader
+        """
+        return self._dynamic
+
+    def _parse(self, data):
+        if data[0:4] != ELFMAG:
+            raise ElfError(f"not an ELF file: {self._path}")
+
+        self._class = data[4]
+        if self._class not in (ELFCLASS32, ELFCLASS64):
+            raise ElfError(f"unknown ELF class {self._class}: {self._path}")
+
+        byteorder = {ELFDATA2LSB: "<", ELFDATA2MSB: ">"}.get(data[5])
+        if byteorder is None:
+            raise ElfError(f"unknown ELF byte order {data[5]}: {self._path}")
+        self._byteorder = byteorder
+
+        # offsets and counts that point past the end of a truncated or
+        # corrupt file make the unpacking fail
+        try:
+            self._parse_headers(data)
+        except (struct.error, IndexError, ValueError) as e:
+            raise ElfError(f"corrupt ELF file: {self._path}: {e}")
+
+    def _parse_headers(self, data):
+        byteorder = self._byteorder
+        header = struct.unpack_from(byteorder + _header_format[self._class], data, 16)
+        (self._type, self._machine, _, _, phoff, _, _, _, phentsize, phnum, _, _, _) = header
+
+        phdr = struct.Struct(byteorder + _phdr_format[self._class])
+        loads = []
+        dynamic = None
+        for i in range(phnum):
+            fields = phdr.unpack_from(data, phoff + i * phentsize)
+            if self._class == ELFCLASS64:
+                (p_type, _, p_offset, p_vaddr, _, p_filesz, _, _) = fields
+            else:
+                (p_type, p_offset, p_vaddr, _, p_filesz, _, _, _) = fields
+
+            if p_type == PT_LOAD:
+                loads.append((p_vaddr, p_filesz, p_offset))
+            elif p_type == PT_DYNAMIC:
+                dynamic = (p_offset, p_filesz)
+            elif p_type == PT_INTERP:
+                self._interp = _cstring(data, p_offset, p_offset + p_filesz)
+
+        if dynamic is not None:
+            self._dynamic = True
+            self._parse_dynamic(data, dynamic, loads)
+
+    def _parse_dynamic(self, data, dynamic, loads):
+        dyn = struct.Struct(self._byteorder + _dyn_format[self._class])
+        (offset, size) = dynamic
+
+        entries = []
+        strtab = None
+        for pos in range(offset, min(offset + size, len(data)) - dyn.size + 1, dyn.size):
+            (tag, value) = dyn.unpack_from(data, pos)
+            if tag == DT_NULL:
+                break
+            if tag == DT_STRTAB:
+                strtab = value
+            entries.append((tag, value))
+
+        if strtab is None:
+            return
+
+        # DT_STRTAB is a virtual address: map it back to a file offset
+        strtab_offset = None
+        for (vaddr, filesz, file_offset) in loads:
+            if vaddr <= strtab < vaddr + filesz:
+                strtab_offset = strtab - vaddr + file_offset
+                break
+        if strtab_offset is None:
+            raise ElfError(f"string table outside of loaded segments: {self._path}")
+
+        for (tag, value) in entries:
+            if tag == DT_NEEDED:
+                self._needed.append(_cstring(data, strtab_offset + value))
+            elif tag == DT_SONAME:
+                self._soname = _cstring(data, strtab_offset + value)
+            elif tag == DT_RPATH:
+                self._rpath.extend(_cstring(data, strtab_offset + value).split(":"))
+            elif tag == DT_RUNPATH:
+                self._runpath.extend(_cstring(data, strtab_offset + value).split(":"))
+
+
+def _cstring(data, start, end=None):
+    """
+    Return the NUL terminated string at an offset in a buffer
+    """
+    stop = data.find(b"\0", start, end if end is not None else len(data))
+    if stop < 0:
+        stop = end if end is not None else len(data)
+    return data[start:stop].decode("utf-8", errors="replace")
+
+
+def classify(path):
+    """
+    Return the kind of an executable file from its first bytes and
+    program headers, or None if it is neither ELF nor a script.
+    Only the 64 byte ELF header and the program header table are read.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        head = os.pread(fd, 64, 0)
+        if head[:2] == b"#!":
+            return SCRIPT
+        if len(head) < 64 or head[:4] != ELFMAG or head[4] not in (ELFCLASS32, ELFCLASS64):
+            return None
+
+        elf_class = head[4]
+        byteorder = {ELFDATA2LSB: "<", ELFDATA2MSB: ">"}.get(head[5])
+        if byteorder is None:
+            return None
+        (e_type, _, _, _, phoff, _, _, _, phentsize, phnum, _, _, _) = \
+            struct.unpack_from(byteorder + _header_format[elf_class], head, 16)
+        if e_type not in (ET_EXEC, ET_DYN) or phentsize < 4:
+            return None
+
+        table = os.pread(fd, phnum * phentsize, phoff)
+        p_types = {
+            struct.unpack_from(byteorder + "I", table, i * phentsize)[0]
+            for i in range(len(table) // phentsize)
+        }
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+    if PT_INTERP in p_types:
+        return PIE if e_type == ET_DYN else DYNAMIC
+    if PT_DYNAMIC in p_types and e_type == ET_DYN:
+        return SHARED
+    return STATIC
+
+
+def scan(root, workers=None):
+    """
+    Find the executable regular files in a tree and classify them.
+    Return {path inside the tree: kind}, sorted by path. Symlinks are
+    not followed or reported. With workers, the headers of large trees
+    are read by that many threads.
+    """
+    candidates = []
+    pending = [root]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mode & 0o111:
+                    candidates.append(entry.path)
+
+    if workers is not None and workers > 1 and len(candidates) > parallel_threshold:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            kinds = list(executor.map(classify, candidates, chunksize=64))
+    else:
+        kinds = [classify(path) for path in candidates]
+
+    prefix = len(root.rstrip("/"))
+    return dict(sorted(
+        (path[prefix:], kind) for (path, kind) in zip(candidates, kinds) if kind is not None))
+
+
+def _unmerged(path):
+    """
+    /lib64 and /usr/lib64 are the same directory on a merged /usr system
+    """
+    return path[4:] if path.startswith("/usr/") else path
+
+
+def tree_realpath(root, path, max_links=40):
+    """
+    Resolve symlinks in path as if root were the file system root.
+    Returns the normalized path inside the tree.
+    """
+    parts = [p for p in path.split("/") if p]
+    resolved = []
+    links = 0
+    while parts:
+        part = parts.pop(0)
+        if part == ".":
+            continue
+        if part == "..":
+            resolved and resolved.pop()
+            continue
+
+        candidate = "/" + "/".join(resolved + [part])
+        local = root.rstrip("/") + candidate
+        if os.path.islink(local):
+            links += 1
+            if links > max_links:
+                raise ElfError(f"too many levels of symbolic links: {path}")
+            target = os.readlink(local)
+            if target.startswith("/"):
+                resolved = []
+            parts = [p for p in target.split("/") if p] + parts
+        else:
+            resolved.append(part)
+
+    return "/" + "/".join(resolved)
+
+
+class DependencyWalker(object):
+    """
+    Compute the shared library closure of ELF files against a list of
+    unpacked file trees.
+
+    Each library is located and parsed only once. Libraries that are not
+    in any tree are reported as missing with the path where the loader
+    would look first, so the package that provides them can be found.
+    """
+
+    def __init__(self, roots):
+        self._roots = list(roots)
+        # (tree path, elf class, machine) -> ElfFile
+        self._parsed = {}
+        # (soname, search path tuple, elf class, machine) -> (root, path) or None
+        self._located = {}
+        self._ld_conf = None
+
+    @property
+    def roots(self):
+        return self._roots
+
+    def add_root(self, root):
+        """
+        Add a tree to search. Libraries that were missing are looked up again.
+        """
+        if root not in self._roots:
+            self._roots.append(root)
+            self.refresh()
+
+    def refresh(self):
+        """
+        Look up missing libraries again, the trees may have changed
+        """
+        self._ld_conf = None
+        self._located = {k: v for (k, v) in self._located.items() if v is not None}
+
+    def parse(self, root, path):
+        """
+        Return the ElfFile for a path inside a tree, parsing it only once
+        """
+        key = (root, path)
+        elf = self._parsed.get(key)
+        if elf is None:
+            local = root.rstrip("/") + tree_realpath(root, path)
+            elf = ElfFile(local)
+            self._parsed[key] = elf
+        return elf
+
+    def _ld_conf_dirs(self):
+        """
+        Library directories added by ld.so.conf.d files in the trees
+        """
+        if self._ld_conf is None:
+            self._ld_conf = []
+            for root in self._roots:
+                for conf in sorted(glob.glob(f"{root.rstrip('/')}/etc/ld.so.conf.d/*.conf")):
+                    with open(conf) as f:
+                        for line in f:
+                            line = line.split("#")[0].strip()
+                            if line.startswith("/") and line not in self._ld_conf:
+                                self._ld_conf.append(line)
+        return self._ld_conf
+
+    def _search_dirs(self, elf, origin):
+        dirs = []
+        # DT_RPATH is only used if there is no DT_RUNPATH
+        if not elf.runpath:
+            dirs += elf.rpath
+        dirs += elf.runpath
+        dirs = [d.replace("$ORIGIN", origin).replace("${ORIGIN}", origin) for d in dirs if d]
+        return dirs + self._ld_conf_dirs() + default_lib_dirs[elf.elf_class]
+
+    def locate(self, soname, elf, origin):
+        """
+        Find a needed library in the trees.
+        Return (root, path) or (None, default path) if it is not present.
+        """
+        search = tuple(self._search_dirs(elf, origin))
+        key = (soname, search, elf.elf_class, elf.machine)
+        if key not in self._located:
+            self._located[key] = None
+            for d in search:
+                path = os.path.normpath(f"{d}/{soname}")
+                for root in self._roots:
+                    if not os.path.lexists(root.rstrip("/") + path):
+                        continue
+                    try:
+                        candidate = self.parse(root, path)
+                    except (ElfError, OSError):
+                        continue
+                    # skip libraries built for a different ABI
+                    if candidate.elf_class == elf.elf_class and candidate.machine == elf.machine:
+                        self._located[key] = (root, path)
+                        break
+                if self._located[key] is not None:
+                    break
+
+        found = self._located[key]
+        if found is None:
+            return (None, f"{search[-1]}/{soname}" if soname.find("/") < 0 else soname)
+        return found
+
+    def closure(self, root, path):
+        """
+        Return the ordered list of (root, path) of every library needed by
+        an ELF file in a tree. root is None for libraries not found in any
+        of the trees. The program interpreter comes last, as with ldd.
+        """
+        elf = self.parse(root, path)
+
+        libraries = []
+        seen = set()
+        queue = [(root, path, elf)]
+        while queue:
+            (lib_root, lib_path, lib_elf) = queue.pop(0)
+            origin = os.path.dirname(lib_path)
+            for soname in lib_elf.needed:
+                (found_root, found_path) = self.locate(soname, lib_elf, origin)
+                if _unmerged(found_path) in seen:
+                    continue
+                seen.add(_unmerged(found_path))
+                libraries.append((found_root, found_path))
+                if found_root is not None:
+                    queue.append((found_root, found_path, self.parse(found_root, found_path)))
+
+        # the loader is normally also a DT_NEEDED of libc, maybe in another directory
+        loaded = {os.path.basename(p) for p in seen}
+        if elf.interp is not None and os.path.basename(elf.interp) not in loaded:
+            interp_root = None
+            for r in self._roots:
+                if os.path.lexists(r.rstrip("/") + elf.interp):
+                    interp_root = r
+                    break
+            libraries.append((interp_root, elf.interp))
+
+        return libraries
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="list the shared libraries needed by an ELF file")
+    parser.add_argument("--root", dest="roots", action="append", default=[],
+                        help="file tree to search for libraries, may be repeated")
+    parser.add_argument("--missing", action=argparse.BooleanOptionalAction, default=True,
+                        help="also list libraries that were not found in any tree")
+    parser.add_argument("--scan", action=argparse.BooleanOptionalAction, default=False,
+                        help="list and classify the executables in a tree instead")
+    parser.add_argument("--workers", type=int, default=None, help="threads for --scan")
+    parser.add_argument("path", help="path of the ELF file, or of the tree with --scan")
+    opts = parser.parse_args()
+
+    if opts.scan:
+        for (path, kind) in scan(opts.path, workers=opts.workers).items():
+            print(f"{kind:8} {path}")
+        sys.exit(0)
+
+    roots = opts.roots or ["/"]
+    walker = DependencyWalker(roots)
+    try:
+        libraries = walker.closure("/", os.path.abspath(opts.path))
+    except (ElfError, OSError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    for (root, path) in libraries:
+        (root is not None or opts.missing) and print(path)
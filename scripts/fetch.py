@@ -0,0 +1,555 @@
+#!/usr/bin/env python
+"""
+Concurrent package download pool for create-model-tree.py
+
+* Bounded number of worker threads
+* One keep-alive connection per mirror host in each worker
+* Each URL is fetched at most once, concurrent requests share the result
+* Files are written to <path>.part and renamed into place when complete
+  and, if a checksum is given, verified
+* An interrupted transfer is resumed from its .part file with an HTTP
+  Range request, on the same mirror or another one
+* With a mirror list or metalink each file is taken from the mirror with
+  the best measured throughput. A mirror that fails, sends bad data or is
+  slower than a minimum rate is left for the next one.
+* Bytes, time and failures are counted for each mirror or host
+
+Supports http, https and file URLs so that a local directory repo or a
+local HTTP server can stand in for a mirror.
+
+USAGE:
+    fetch.py [--mirrorlist <file or URL>] [--metalink <file or URL>]
+             [--sha256 <hex>] [--min-rate <bytes/s>] <url> <path>
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import hashlib
+import http.client
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+
+import profiler
+
+# Follow at most this many HTTP redirects for a single request
+max_redirects = 5
+
+# Read and write in chunks of this size
+chunk_size = 1024 * 1024
+
+# Tries for a file beyond one on each candidate mirror
+retries = 2
+
+# A transfer is judged against the minimum rate only after this long
+slow_grace = 5.0
+
+# Mirrors tried first, in list order, before the measured ones are ranked
+explore = 3
+
+_content_range_re = re.compile(r"bytes (\d+)-\d+/(\d+|\*)")
+
+
+class DownloadError(Exception):
+    pass
+
+
+class SlowMirror(DownloadError):
+    pass
+
+
+def file_matches(path, checksum):
+    """
+    True if a file has a (type, value) repo checksum
+    """
+    (checksum_type, value) = checksum
+    digest = hashlib.new("sha1" if checksum_type == "sha" else checksum_type)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest() == value
+
+
+# ------------------------------------------------------------------------------
+# Mirror lists
+# ------------------------------------------------------------------------------
+class Mirrors(object):
+    """
+    The base URLs of the mirrors of one repo, in order of preference
+    """
+
+    def __init__(self, bases):
+        self._bases = []
+        for base in bases:
+            base = base.rstrip("/") + "/"
+            base not in self._bases and self._bases.append(base)
+        if not self._bases:
+            raise DownloadError("no usable mirrors")
+
+    @property
+    def bases(self):
+        return list(self._bases)
+
+    @staticmethod
+    def parse_mirrorlist(text):
+        """
+        Base URLs from a mirrorlist, one per line
+        """
+        return [line.strip() for line in text.splitlines()
+                if line.strip() and not line.lstrip().startswith("#")]
+
+    @staticmethod
+    def parse_metalink(text):
+        """
+        Repo base URLs from a metalink for repomd.xml, version 3 or 4,
+        in order of preference
+        """
+        try:
+            root = ET.fromstring(text)
+        except ET.ParseError as e:
+            raise DownloadError(f"bad metalink: {e}")
+        urls = []
+        for element in root.iter():
+            if element.tag.rpartition("}")[2] != "url" or not element.text:
+                continue
+            url = element.text.strip()
+            if url.split(":")[0] not in ("http", "https", "file"):
+                continue
+            # version 3 prefers high preference, version 4 low priority
+            if element.get("priority") is not None:
+                rank = int(element.get("priority"))
+            else:
+                rank = -int(element.get("preference", 0))
+            urls.append((rank, len(urls), re.sub(r"repodata/repomd\.xml$", "", url)))
+        return [url for (rank, n, url) in sorted(urls)]
+
+    @staticmethod
+    def load(mirrorlists=(), metalinks=()):
+        """
+        Read mirror lists and metalinks from files or URLs.
+        Return None if there are none.
+        """
+        bases = []
+        for (sources, parse) in ((metalinks, Mirrors.parse_metalink), (mirrorlists, Mirrors.parse_mirrorlist)):
+            for source in sources:
+                if re.match(r"[a-z]+://", source):
+                    with urllib.request.urlopen(source, timeout=60) as f:
+                        text = f.read().decode()
+                else:
+                    with open(source) as f:
+                        text = f.read()
+                bases.extend(parse(text))
+        return Mirrors(bases) if mirrorlists or metalinks else None
+
+    def base(self, url):
+        """
+        The mirror a URL is on, or None
+        """
+        for base in self._bases:
+            if url.startswith(base):
+                return base
+        return None
+
+    def relative(self, url):
+        """
+        The path of a URL within the repo, or None
+        """
+        base = self.base(url)
+        if base is not None:
+            return url[len(base):]
+        # a package URL from dnf names some mirror of the same repo
+        (head, sep, tail) = url.partition("/Packages/")
+        return f"Packages/{tail}" if sep else None
+
+
+# ------------------------------------------------------------------------------
+# Download pool
+# ------------------------------------------------------------------------------
+class DownloadPool(object):
+    """
+    Fetch URLs to local files using a bounded pool of worker threads.
+
+    Each worker keeps an open connection to each host it has talked to so
+    that a series of RPMs from the same mirror reuses one TCP/TLS session.
+    """
+
+    def __init__(self, workers=8, timeout=60, mirrors=None, min_rate=None, verbose=False):
+        self._workers = workers
+        self._timeout = timeout
+        self._mirrors = mirrors
+        self._min_rate = min_rate
+        self._verbose = verbose
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="fetch")
+        self._lock = threading.RLock()
+        self._inflight = {}
+        self._local = threading.local()
+        self._stats = {}
+        self._active = collections.Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def submit(self, url, path, checksum=None):
+        """
+        Schedule a download of url to path and return a Future.
+        A URL that is still queued or downloading returns the same Future.
+        Once it is done a new request checks the file again, so one that
+        was removed or replaced since is downloaded again.
+        """
+        with self._lock:
+            future = self._inflight.get(url)
+            if future is None:
+                future = self._executor.submit(self._fetch, url, path, checksum, profiler.context())
+                self._inflight[url] = future
+                future.add_done_callback(lambda f, url=url: self._forget(url, f))
+            return future
+
+    def _forget(self, url, future):
+        # a later request starts over: a failed download is tried again and
+        # a file that is already there is not fetched twice
+        with self._lock:
+            if self._inflight.get(url) is future:
+                del self._inflight[url]
+
+    def fetch(self, requests):
+        """
+        Download a list of (url, path) or (url, path, checksum) requests
+        and wait for all of them. Raise the first error after every
+        transfer has finished.
+        """
+        futures = [self.submit(*request) for request in requests]
+        concurrent.futures.wait(futures)
+        return [future.result() for future in futures]
+
+    @property
+    def stats(self):
+        """
+        Transfers by mirror, or by host without a mirror list:
+        {source: {files, bytes, seconds, rate, failures}}
+        """
+        with self._lock:
+            return {source: dict(s, seconds=round(s['seconds'], 3),
+                                 rate=round(s['bytes'] / s['seconds']) if s['seconds'] else None)
+                    for (source, s) in self._stats.items()}
+
+    def report(self):
+        """
+        One line per mirror with the bandwidth it gave
+        """
+        lines = []
+        for (source, s) in sorted(self.stats.items()):
+            rate = f"{s['rate'] / 1024 / 1024:.2f} MiB/s" if s['rate'] is not None else "-"
+            lines.append(f"{source}: {s['files']} files, {s['bytes']} bytes in {s['seconds']}s, "
+                         f"{rate}, {s['failures']} failures")
+        return "\n".join(lines)
+
+    def _source(self, url):
+        base = self._mirrors.base(url) if self._mirrors is not None else None
+        if base is not None:
+            return base
+        parts = urllib.parse.urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    @contextlib.contextmanager
+    def _transfer(self, url):
+        source = self._source(url)
+        with self._lock:
+            self._active[source] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active[source] -= 1
+
+    def _record(self, url, size, seconds, failed=False):
+        with self._lock:
+            s = self._stats.setdefault(self._source(url), {'files': 0, 'bytes': 0, 'seconds': 0.0, 'failures': 0})
+            s['bytes'] += size
+            s['seconds'] += seconds
+            s['files' if not failed else 'failures'] += 1
+
+    def candidates(self, url):
+        """
+        The URLs to try for a file, best first: a few untried mirrors
+        until there are measurements, then mirrors by throughput, then
+        mirrors that have only failed. The URL itself comes last if it
+        is on none of the mirrors.
+        """
+        relative = self._mirrors.relative(url) if self._mirrors is not None else None
+        if relative is None:
+            return [url]
+
+        with self._lock:
+            def score(base):
+                s = self._stats.get(base)
+                if s is None or not s['seconds'] or not s['files']:
+                    return None
+                return s['bytes'] / s['seconds'] / (1 + s['failures'])
+
+            bases = self._mirrors.bases
+            measured = sorted([b for b in bases if score(b) is not None], key=score, reverse=True)
+            failed = [b for b in bases if score(b) is None and b in self._stats]
+            # spread transfers that start together over the untried mirrors
+            untried = sorted([b for b in bases if b not in self._stats], key=lambda b: self._active[b])
+
+        ordered = untried + measured if len(measured) < explore else measured + untried
+        urls = [base + relative for base in ordered + failed]
+        url not in urls and urls.append(url)
+        return urls
+
+    # --------------------------------------------------------------
+    # worker side
+    # --------------------------------------------------------------
+    def _fetch(self, url, path, checksum=None, context=None):
+        # every path returned matches its checksum, even one already there
+        if os.path.exists(path) and (checksum is None or file_matches(path, checksum)):
+            return path
+
+        # the bytes count toward the spans of whoever asked for the file
+        with profiler.attach(context), profiler.span("download", url=url):
+            return self._download(url, path, checksum)
+
+    @contextlib.contextmanager
+    def _partial(self, path):
+        """
+        Open the partial file of a download for appending. If another
+        process holds it, use a private one that is removed on failure.
+        """
+        part_path = f"{path}.part"
+        output = open(part_path, "ab")
+        private = False
+        try:
+            fcntl.flock(output.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            output.close()
+            (fd, part_path) = tempfile.mkstemp(dir=os.path.dirname(part_path), prefix=".fetch-", suffix=".part")
+            output = os.fdopen(fd, "ab")
+            private = True
+
+        try:
+            yield (output, part_path)
+        except BaseException:
+            private and os.path.exists(part_path) and os.unlink(part_path)
+            raise
+        finally:
+            output.close()
+
+    def _download(self, url, path, checksum=None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        candidates = self.candidates(url)
+        allowed = len(candidates) + retries
+        (attempt, failures, errors) = (0, 0, [])
+        with self._partial(path) as (output, part_path):
+            while failures < allowed:
+                candidate = candidates[attempt % len(candidates)]
+                attempt += 1
+                if failures >= len(candidates):
+                    # every candidate has failed: back off before going round again
+                    time.sleep(min(2 ** (failures - len(candidates)), 10) * 0.5)
+
+                offset = output.seek(0, os.SEEK_END)
+                start = time.perf_counter()
+                try:
+                    self._verbose and print(f"downloading: {candidate}" + (f" from byte {offset}" if offset else ""))
+                    with self._transfer(candidate):
+                        self._copy(candidate, output, offset, judge_rate=len(candidates) > 1)
+                    output.flush()
+                except (DownloadError, OSError, http.client.HTTPException) as e:
+                    output.flush()
+                    received = max(os.fstat(output.fileno()).st_size - offset, 0)
+                    self._record(candidate, received, time.perf_counter() - start, failed=True)
+                    errors.append(f"{candidate}: {e}")
+                    # a transfer that got further is resumed without using up a retry
+                    failures += received == 0
+                    continue
+
+                if checksum is not None and not file_matches(part_path, checksum):
+                    # corrupt somewhere, possibly in the resumed part: start over
+                    output.truncate(0)
+                    self._record(candidate, 0, time.perf_counter() - start, failed=True)
+                    errors.append(f"{candidate}: {checksum[0]} checksum mismatch")
+                    failures += 1
+                    continue
+
+                received = max(os.fstat(output.fileno()).st_size - offset, 0)
+                self._record(candidate, received, time.perf_counter() - start)
+                os.replace(part_path, path)
+                return path
+
+        raise DownloadError(f"failed to download {url}:\n  " + "\n  ".join(errors[-allowed:]))
+
+    def _copy(self, url, output, offset=0, judge_rate=False):
+        """
+        Append the content of url from offset onward to output
+        """
+        parts = urllib.parse.urlsplit(url)
+
+        if parts.scheme == "file" or parts.scheme == "":
+            with open(urllib.request.url2pathname(parts.path), "rb") as source:
+                source.seek(offset)
+                shutil.copyfileobj(source, output, chunk_size)
+                profiler.count("bytes_downloaded", source.tell() - offset)
+            return
+
+        if parts.scheme not in ("http", "https"):
+            raise DownloadError(f"unsupported URL scheme: {url}")
+
+        redirects = 0
+        while redirects <= max_redirects:
+            response = self._request(parts, {"Range": f"bytes={offset}-"} if offset else {})
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader("Location")
+                response.read()
+                if location is None:
+                    raise DownloadError(f"redirect without location: {url}")
+                parts = urllib.parse.urlsplit(urllib.parse.urljoin(parts.geturl(), location))
+                redirects += 1
+                continue
+
+            if response.status == 416 and offset:
+                # the partial file is no prefix of this one
+                response.read()
+                output.truncate(0)
+                offset = 0
+                continue
+
+            if response.status == 206:
+                match = _content_range_re.match(response.getheader("Content-Range") or "")
+                if match is None or int(match.group(1)) != offset:
+                    response.close()
+                    raise DownloadError(f"bad Content-Range {response.getheader('Content-Range')}: {parts.geturl()}")
+            elif response.status == 200:
+                # the whole file, whether or not part of it was asked for
+                offset and output.truncate(0)
+            else:
+                response.read()
+                raise DownloadError(f"HTTP {response.status} {response.reason}: {parts.geturl()}")
+
+            self._stream(response, output, parts, judge_rate)
+            return
+
+        raise DownloadError(f"too many redirects: {url}")
+
+    def _stream(self, response, output, parts, judge_rate):
+        start = time.perf_counter()
+        received = 0
+        try:
+            while True:
+                block = response.read(chunk_size if not judge_rate else 64 * 1024)
+                if not block:
+                    break
+                output.write(block)
+                received += len(block)
+                profiler.count("bytes_downloaded", len(block))
+
+                elapsed = time.perf_counter() - start
+                if judge_rate and self._min_rate and elapsed > slow_grace and received / elapsed < self._min_rate:
+                    raise SlowMirror(f"{received / elapsed:.0f} bytes/s is below {self._min_rate}")
+
+            length = response.getheader("Content-Length")
+            if length is not None and received != int(length):
+                raise DownloadError(f"connection closed after {received} of {length} bytes")
+        except BaseException:
+            # the connection is in the middle of a response
+            self._connection(parts.scheme, parts.netloc).close()
+            raise
+
+    def _connection(self, scheme, netloc, fresh=False):
+        """
+        Return this worker's open connection to a host, creating it if needed
+        """
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+
+        key = (scheme, netloc)
+        conn = connections.get(key)
+        if fresh and conn is not None:
+            conn.close()
+            conn = None
+
+        if conn is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=self._timeout)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=self._timeout)
+            connections[key] = conn
+
+        return conn
+
+    def _request(self, parts, headers=None):
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+
+        # A kept-alive connection may have been closed by the server while
+        # idle. Retry once on a new connection before giving up.
+        for fresh in (False, True):
+            conn = self._connection(parts.scheme, parts.netloc, fresh=fresh)
+            try:
+                conn.request("GET", target, headers={"Connection": "keep-alive", **(headers or {})})
+                return conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError, http.client.CannotSendRequest):
+                conn.close()
+                if fresh:
+                    raise
+
+
+# A pool shared by every Package in the process
+_shared_pool = None
+_shared_lock = threading.Lock()
+
+
+def shared_pool(workers=8, mirrors=None, min_rate=None, verbose=False):
+    """
+    Return the process wide download pool, creating it on first use
+    """
+    global _shared_pool
+    with _shared_lock:
+        if _shared_pool is None:
+            _shared_pool = DownloadPool(workers=workers, mirrors=mirrors, min_rate=min_rate, verbose=verbose)
+        return _shared_pool
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="download a file, resuming and choosing among mirrors")
+    parser.add_argument('--verbose', '-v', action=argparse.BooleanOptionalAction)
+    parser.add_argument('--mirrorlist', action='append', default=[], help="file or URL, one base URL per line")
+    parser.add_argument('--metalink', action='append', default=[], help="file or URL of a repomd.xml metalink")
+    parser.add_argument('--min-rate', type=int, default=None, metavar="BYTES",
+                        help="leave a mirror slower than this many bytes a second for the next one")
+    parser.add_argument('--sha256', default=None)
+    parser.add_argument("url")
+    parser.add_argument("path")
+    opts = parser.parse_args()
+
+    try:
+        mirrors = Mirrors.load(opts.mirrorlist, opts.metalink)
+        with DownloadPool(workers=1, mirrors=mirrors, min_rate=opts.min_rate, verbose=opts.verbose) as pool:
+            pool.fetch([(opts.url, opts.path, ("sha256", opts.sha256) if opts.sha256 else None)])
+            print(pool.report())
+    except (DownloadError, OSError) as e:
+        sys.exit(str(e))
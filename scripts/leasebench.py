@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""
+Benchmark of leases.py on generated lease files
+
+* Write a dhcpd.leases (or dhcpd6.leases) of N lease statements over a
+  smaller set of addresses, as dhcpd appends them under churn
+* Time a full index, an index of an appended tail, lookups by IP, MAC
+  and client id, and a compaction, each index and compaction in its own
+  process with its peak resident memory
+* Write a JSON report
+
+USAGE:
+    leasebench.py [--entries 500000,2000000] [--addresses 65536] [--v6] [--report <file>]
+    leasebench.py generate [--entries N] [--addresses N] [--v6] <file>
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import leases
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Lease statements are written in batches of this size
+batch_size = 10000
+
+# Seconds between two generated lease statements
+step = 2
+
+# Midnight, 2024-01-01 UTC
+start_time = 1704067200
+
+
+# ------------------------------------------------------------------------------
+# Lease files
+# ------------------------------------------------------------------------------
+def quote(data):
+    """
+    A dhcpd string: printable characters as they are, the rest in octal
+    """
+    return '"' + "".join(chr(b) if 32 <= b < 127 and b not in (34, 92) else f"\\{b:03o}" for b in data) + '"'
+
+
+def _when(seconds):
+    t = time.gmtime(seconds)
+    return time.strftime(f"{(t.tm_wday + 1) % 7} %Y/%m/%d %H:%M:%S", t)
+
+
+def _v4_lease(n, address, client):
+    mac = bytes([0x52, 0x54, 0, (client >> 16) & 255, (client >> 8) & 255, client & 255])
+    starts = start_time + n * step
+    state = "active" if n % 5 else "free"
+    uid = quote(b"\x01" + mac)
+    return (f"lease 10.{(address >> 16) & 255}.{(address >> 8) & 255}.{address & 255} {{\n"
+            f"  starts {_when(starts)};\n"
+            f"  ends {_when(starts + 7200)};\n"
+            f"  cltt {_when(starts)};\n"
+            f"  binding state {state};\n"
+            f"  next binding state free;\n"
+            f"  rewind binding state free;\n"
+            f"  hardware ethernet {mac.hex(':')};\n"
+            f"  uid {uid};\n"
+            f"  set vendor-class-identifier = \"MSFT 5.0\";\n"
+            f"  client-hostname \"host-{client}\";\n"
+            f"}}\n")
+
+
+def _v6_lease(n, address, client):
+    # DUID-LLT of an Ethernet address
+    duid = bytes([0, 1, 0, 1, 0x2d, 0x93, 0x31, 0xc5, 0x52, 0x54, 0, (client >> 16) & 255, (client >> 8) & 255,
+                  client & 255])
+    starts = start_time + n * step
+    state = "active" if n % 5 else "expired"
+    return (f"ia-na {quote(client.to_bytes(4, 'little') + duid)} {{\n"
+            f"  cltt {_when(starts)};\n"
+            f"  iaaddr 2001:db8::{address >> 16:x}:{address & 0xffff:x} {{\n"
+            f"    binding state {state};\n"
+            f"    preferred-life 27000;\n"
+            f"    max-life 43200;\n"
+            f"    ends {_when(starts + 43200)};\n"
+            f"  }}\n"
+            f"}}\n")
+
+
+def generate(path, entries, addresses, v6=False, seed=0, append=False, first=0):
+    """
+    Write a lease file of entries statements over a set of addresses.
+    Each address mostly keeps its client. Return the file size.
+    """
+    rng = random.Random(seed + first)
+    lease = _v6_lease if v6 else _v4_lease
+    with open(path, "a" if append else "w") as f:
+        if not append:
+            f.write("# The format of this file is documented in the dhcpd.leases(5) manual page.\n"
+                    "# This lease file was written by leasebench.py\n\n"
+                    "# authoring-byte-order entry is generated, DO NOT DELETE\n"
+                    "authoring-byte-order little-endian;\n\n")
+            v6 and f.write(f"server-duid {quote(bytes([0, 1, 0, 1, 0x2d, 0x93, 0x31, 0xc5, 0x52, 0x54, 0, 0, 0, 1]))};\n\n")
+        for batch in range(first, first + entries, batch_size):
+            block = []
+            for n in range(batch, min(batch + batch_size, first + entries)):
+                address = rng.randrange(addresses)
+                # one address in twenty goes to another client
+                client = address if rng.randrange(20) else rng.randrange(addresses * 2)
+                block.append(lease(n, address, client))
+            f.write("".join(block))
+    return os.path.getsize(path)
+
+
+# ------------------------------------------------------------------------------
+# Runs
+# ------------------------------------------------------------------------------
+def run_tool(args):
+    """
+    Run leases.py and return its wall time and peak resident memory in KiB
+    """
+    command = [sys.executable, os.path.join(script_dir, "leases.py")] + args
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    (pid, status, usage) = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    error = process.stderr.read().decode()
+    process.stderr.close()
+    if process.returncode != 0:
+        raise RuntimeError(f"failed ({process.returncode}): {' '.join(command)}\n{error}")
+    return {'wall': round(wall, 6), 'maxrss_kib': usage.ru_maxrss}
+
+
+def time_lookups(path, count, addresses, v6=False, seed=1):
+    """
+    The mean time of lookups by IP, MAC and client id against the index
+    """
+    rng = random.Random(seed)
+    with leases.LeaseIndex(path) as index:
+        index.update()
+        found = {'ip': 0, 'mac': 0, 'client_id': 0}
+        times = {}
+        for kind in found:
+            start = time.perf_counter()
+            for _ in range(count):
+                n = rng.randrange(addresses)
+                mac = f"52:54:00:{(n >> 16) & 255:02x}:{(n >> 8) & 255:02x}:{n & 255:02x}"
+                if kind == "ip":
+                    ip = f"2001:db8::{n >> 16:x}:{n & 0xffff:x}" if v6 else f"10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+                    found[kind] += len(index.lookup(ip=ip))
+                elif kind == "mac":
+                    found[kind] += len(index.lookup(mac=mac))
+                else:
+                    client_id = f"00:01:00:01:2d:93:31:c5:{mac}" if v6 else f"01:{mac}"
+                    found[kind] += len(index.lookup(client_id=client_id))
+            times[kind] = round((time.perf_counter() - start) / count * 1e6, 3)
+    return {'mean_us': times, 'found': found}
+
+
+def benchmark_size(workdir, entries, addresses, v6, lookups, verbose=False):
+    """
+    Generate a lease file of one size and time each operation on it
+    """
+    path = os.path.join(workdir, f"dhcpd{'6' if v6 else ''}-{entries}.leases")
+    for stale in (path, f"{path}.index", f"{path}.compact"):
+        os.path.exists(stale) and os.unlink(stale)
+
+    start = time.perf_counter()
+    size = generate(path, entries, addresses, v6=v6)
+    generate_time = time.perf_counter() - start
+    verbose and print(f"{entries} entries: {size} bytes in {generate_time:.1f}s")
+
+    index = run_tool(["index", path])
+    verbose and print(f"  index {index}")
+
+    # dhcpd appends more leases: only the tail is read
+    tail = max(entries // 100, 1)
+    generate(path, tail, addresses, v6=v6, append=True, first=entries)
+    update = run_tool(["index", path])
+    verbose and print(f"  index of {tail} appended {update}")
+
+    lookup = time_lookups(path, lookups, addresses, v6=v6)
+    verbose and print(f"  lookups {lookup}")
+
+    compact = run_tool(["compact", path])
+    compacted = os.path.getsize(f"{path}.compact")
+    verbose and print(f"  compact {compact} to {compacted} bytes")
+
+    return {
+        'entries': entries,
+        'bytes': os.path.getsize(path),
+        'generate': round(generate_time, 6),
+        'index': dict(index, entries_per_second=round(entries / index['wall'])),
+        'append': dict(update, entries=tail),
+        'lookup': lookup,
+        'compact': dict(compact, bytes=compacted),
+    }
+
+
+def report_table(report):
+    lines = [f"{'entries':>9} {'MB':>7} {'index':>8} {'rss MB':>7} {'append':>7} "
+             f"{'ip us':>7} {'mac us':>7} {'cid us':>7} {'compact':>8} {'rss MB':>7} {'out MB':>7}"]
+    for r in report['sizes']:
+        lines.append(f"{r['entries']:>9} {r['bytes'] / 1e6:>7.1f} {r['index']['wall']:>8.2f} "
+                     f"{r['index']['maxrss_kib'] / 1024:>7.1f} {r['append']['wall']:>7.2f} "
+                     f"{r['lookup']['mean_us']['ip']:>7.1f} {r['lookup']['mean_us']['mac']:>7.1f} "
+                     f"{r['lookup']['mean_us']['client_id']:>7.1f} {r['compact']['wall']:>8.2f} "
+                     f"{r['compact']['maxrss_kib'] / 1024:>7.1f} {r['compact']['bytes'] / 1e6:>7.1f}")
+    return "\n".join(lines)
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1 and sys.argv[1] == "generate":
+        parser = argparse.ArgumentParser(prog="leasebench.py generate")
+        parser.add_argument("--entries", type=int, default=1000000)
+        parser.add_argument("--addresses", type=int, default=65536)
+        parser.add_argument("--v6", action=argparse.BooleanOptionalAction, default=False)
+        parser.add_argument("path")
+        opts = parser.parse_args(sys.argv[2:])
+        print(f"{opts.path}: {generate(opts.path, opts.entries, opts.addresses, v6=opts.v6)} bytes")
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="time leases.py on generated lease files")
+    parser.add_argument('--verbose', '-v', action=argparse.BooleanOptionalAction)
+    parser.add_argument("--entries", default="500000,2000000", help="comma separated lease statement counts")
+    parser.add_argument("--addresses", type=int, default=65536, help="distinct addresses the leases are for")
+    parser.add_argument("--v6", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--lookups", type=int, default=2000, help="lookups of each kind")
+    parser.add_argument("--workdir", default=None, help="keep the lease files here")
+    parser.add_argument("--report", default=None, help="write the JSON report to this file")
+    opts = parser.parse_args()
+
+    workdir = opts.workdir or tempfile.mkdtemp(prefix="leasebench-")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        report = {
+            'created': time.time(),
+            'host': {'python': platform.python_version(), 'machine': platform.machine(),
+                     'system': platform.platform(), 'cpus': os.cpu_count()},
+            'parameters': {'addresses': opts.addresses, 'v6': opts.v6, 'lookups': opts.lookups},
+            'sizes': [benchmark_size(workdir, int(entries), opts.addresses, opts.v6, opts.lookups,
+                                     verbose=opts.verbose)
+                      for entries in opts.entries.split(",") if entries],
+        }
+    finally:
+        opts.workdir is None and shutil.rmtree(workdir, ignore_errors=True)
+
+    print(report_table(report))
+    if opts.report is not None:
+        with open(opts.report, "w") as f:
+            json.dump(report, f, indent=1)
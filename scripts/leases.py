@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+"""
+Index, look up and compact ISC dhcpd lease files (dhcpd.leases and
+dhcpd6.leases) from the /var/lib/dhcpd volume of the dhcpd container
+
+* The file is memory mapped and read one top level statement at a time,
+  so parsing takes the same memory for any file size
+* Every lease statement is a new state that replaces the earlier ones
+  for the same address (v4) or IA (v6). The index keeps the latest
+  statement of each, with its byte offset, in an SQLite file.
+* Leases are found by IP address or prefix, MAC address or client id.
+  For v6 the client id is the DUID and the MAC comes from a DUID-LL or
+  DUID-LLT.
+* dhcpd only appends to the file between its own rewrites, so a later
+  index run reads only what was appended. A rewritten file is indexed
+  again from the start.
+* A compacted file holds the leading comments, then the latest of each
+  statement in file order, copied byte for byte
+
+dhcpd must not be running while the file is compacted in place. The
+file is checked before it is replaced, and a file that changed in the
+meantime is left alone.
+
+USAGE:
+    leases.py [--index <file>] index <leases file>
+    leases.py [--index <file>] lookup [--ip <address>] [--mac <mac>] [--client-id <id>] [--raw] <leases file>
+    leases.py [--index <file>] compact [--output <file> | --in-place] <leases file>
+"""
+
+import argparse
+import calendar
+import functools
+import hashlib
+import mmap
+import os
+import re
+import sqlite3
+import sys
+
+import yaml
+
+INDEX_VERSION = 1
+
+# Statements are written to the index in batches of this size
+batch_size = 50000
+
+# The head of the file that must not change for an index to be extended
+head_size = 4096
+
+# Text on one line up to a "{" or ";" outside a quoted string
+_text = rb'[^\n{;"]*(?:"[^"\\\n]*(?:\\.[^"\\\n]*)*"[^\n{;"]*)*'
+
+# A top level block, closed by a "}" at the start of a line, or a one
+# line statement. Blank lines and comments are skipped.
+_statement_re = re.compile(
+    rb"(?P<skip>(?:[ \t]*(?:#[^\n]*)?\n)+)"
+    rb"|(?P<head>[^\s#{};]" + _text + rb")\{[ \t]*(?P<body>\n.*?)^\}[ \t]*\n"
+    rb"|(?P<line>[^\s#{};]" + _text + rb");[ \t]*(?:#[^\n]*)?\n",
+    re.M | re.S)
+
+# The statements of a lease or IA that the index records, one to a line
+# as dhcpd writes them
+_field_re = re.compile(
+    rb"\n[ \t]*(starts|ends|cltt|binding state|hardware ethernet|uid|client-hostname|iaaddr|iaprefix)"
+    rb"[ \t]+(" + _text + rb")")
+
+_block_end_re = re.compile(rb"^\}", re.M)
+
+# One line statements of which only the last counts
+singletons = (b"authoring-byte-order", b"server-duid")
+
+ia_kinds = (b"ia-na", b"ia-ta", b"ia-pd")
+
+
+class LeaseError(Exception):
+    pass
+
+
+# ------------------------------------------------------------------------------
+# Values
+# ------------------------------------------------------------------------------
+def unquote(value):
+    """
+    The bytes of a dhcpd string, "..." with octal escapes, or of
+    colon separated hex
+    """
+    if value.startswith(b'"'):
+        value = value[1:-1]
+        return value.decode("unicode_escape").encode("latin-1") if b"\\" in value else value
+    return bytes.fromhex(value.replace(b":", b"").decode())
+
+
+def colon_hex(data):
+    return data.hex(":")
+
+
+def normalize_id(value):
+    """
+    A MAC address or client id as lower case colon separated hex
+    """
+    digits = re.sub(r"[^0-9a-fA-F]", "", value)
+    if len(digits) % 2:
+        raise LeaseError(f"not a hex identifier: {value}")
+    return colon_hex(bytes.fromhex(digits))
+
+
+@functools.lru_cache(maxsize=4096)
+def _day(date):
+    (year, month, day) = date.split(b"/")
+    return calendar.timegm((int(year), int(month), int(day), 0, 0, 0))
+
+
+def lease_time(value):
+    """
+    Seconds since the epoch of a dhcpd date: "<weekday> yyyy/mm/dd hh:mm:ss"
+    in UTC, "epoch <seconds>" or "never" (None)
+    """
+    parts = value.split()
+    if parts[:1] == [b"epoch"]:
+        return int(parts[1])
+    if len(parts) < 3:
+        return None
+    (hours, minutes, seconds) = parts[2].split(b":")
+    return _day(parts[1]) + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def duid_mac(duid):
+    """
+    The link layer address of an Ethernet DUID-LLT or DUID-LL, or None
+    """
+    if len(duid) < 4 or duid[2:4] != b"\x00\x01":
+        return None
+    kind = duid[0:2]
+    if kind == b"\x00\x01" and len(duid) == 14:
+        return colon_hex(duid[8:])
+    if kind == b"\x00\x03" and len(duid) == 10:
+        return colon_hex(duid[4:])
+    return None
+
+
+# ------------------------------------------------------------------------------
+# Parser
+# ------------------------------------------------------------------------------
+def statements(data, pos=0, path="<leases>"):
+    """
+    Yield each top level statement of a lease file from pos as
+    (key, head, offset, end, body): body is None for a one line
+    statement. A statement cut off at the end of the file, as dhcpd may
+    be in the middle of writing it, ends the iteration.
+    """
+    size = len(data)
+    match = _statement_re.match
+    while pos < size:
+        m = match(data, pos)
+        if m is None:
+            _check_incomplete(data, pos, path)
+            return
+        end = m.end()
+        if m.lastgroup == "skip":
+            pass
+        elif m.lastgroup == "line":
+            line = m.group("line").rstrip()
+            word = line.split(None, 1)[0]
+            yield (word if word in singletons else line, line, pos, end, None)
+        else:
+            head = m.group("head").rstrip()
+            yield (head, head, pos, end, m.group("body"))
+        pos = end
+
+
+def _check_incomplete(data, pos, path):
+    # only the last statement may be unfinished
+    line_end = data.find(b"\n", pos)
+    if line_end == -1 or (data[pos:line_end].rstrip().endswith(b"{") and
+                          _block_end_re.search(data, line_end) is None):
+        return
+    line = data[:pos].count(b"\n") + 1
+    raise LeaseError(f"{path}: line {line}: cannot parse: {data[pos:min(line_end, pos + 80)].decode(errors='replace')}")
+
+
+def leases(head, body):
+    """
+    The lease rows of one block: (address, kind, state, starts, ends,
+    mac, client_id, hostname) for a v4 lease and for each address or
+    prefix of a v6 IA. Other blocks have none.
+    """
+    (kind, _, rest) = head.partition(b" ")
+    if kind == b"lease":
+        values = dict(_field_re.findall(body))
+        uid = values.get(b"uid")
+        mac = values.get(b"hardware ethernet")
+        hostname = values.get(b"client-hostname")
+        return [(rest.decode(), "lease",
+                 (values.get(b"binding state") or b"").decode() or None,
+                 lease_time(values[b"starts"]) if b"starts" in values else None,
+                 lease_time(values[b"ends"]) if b"ends" in values else None,
+                 mac.decode().lower() if mac is not None else None,
+                 colon_hex(unquote(uid)) if uid is not None else None,
+                 unquote(hostname).decode(errors="replace") if hostname is not None else None)]
+
+    if kind in ia_kinds:
+        ia = unquote(rest.strip())
+        duid = ia[4:]
+        (client_id, mac) = (colon_hex(duid), duid_mac(duid))
+        rows = []
+        (cltt, current) = (None, None)
+        for (name, value) in _field_re.findall(body):
+            if name in (b"iaaddr", b"iaprefix"):
+                current = [value.strip().decode(), kind.decode(), None, cltt, None, mac, client_id, None]
+                rows.append(current)
+            elif name == b"cltt":
+                cltt = lease_time(value)
+            elif current is not None and name == b"binding state":
+                current[2] = value.decode()
+            elif current is not None and name == b"ends":
+                current[4] = lease_time(value)
+        return [tuple(row) for row in rows]
+
+    return []
+
+
+# ------------------------------------------------------------------------------
+# Index
+# ------------------------------------------------------------------------------
+class LeaseIndex(object):
+    """
+    The latest statement of each lease, address and client in a lease
+    file, kept in SQLite next to it:
+
+    entries   key -> offset, length     every statement, latest only
+    leases    address -> entry, state, times, mac, client id, hostname
+    meta      the file identity and how far it has been read
+    """
+
+    def __init__(self, path, index_path=None, verbose=False):
+        self._path = path
+        self._index_path = index_path or f"{path}.index"
+        self._verbose = verbose
+        self._db = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def close(self):
+        self._db is not None and self._db.close()
+        self._db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _create(db):
+        db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)")
+        db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                   " key BLOB PRIMARY KEY, kind TEXT, offset INTEGER, length INTEGER) WITHOUT ROWID")
+        db.execute("CREATE TABLE IF NOT EXISTS leases ("
+                   " address TEXT PRIMARY KEY, kind TEXT, key BLOB, state TEXT, starts INTEGER, ends INTEGER,"
+                   " mac TEXT, client_id TEXT, hostname TEXT) WITHOUT ROWID")
+
+    @staticmethod
+    def _create_indexes(db):
+        # built once after a full load rather than kept up row by row
+        db.execute("CREATE INDEX IF NOT EXISTS leases_mac ON leases (mac)")
+        db.execute("CREATE INDEX IF NOT EXISTS leases_client_id ON leases (client_id)")
+
+    def _meta(self, db):
+        try:
+            return dict(db.execute("SELECT name, value FROM meta"))
+        except sqlite3.DatabaseError:
+            return {}
+
+    @staticmethod
+    def _head(data, size):
+        return hashlib.sha256(data[:min(size, head_size)]).hexdigest()
+
+    def update(self):
+        """
+        Bring the index up to date with the lease file: read only what
+        was appended if the file is the one indexed, else start again.
+        Return the number of statements read.
+        """
+        st = os.stat(self._path)
+        self.close()
+
+        with open(self._path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b""
+            try:
+                db = sqlite3.connect(self._index_path) if os.path.exists(self._index_path) else None
+                meta = self._meta(db) if db is not None else {}
+                start = meta.get('parsed', 0)
+                same = meta.get('version') == INDEX_VERSION and \
+                    (meta.get('device'), meta.get('inode')) == (st.st_dev, st.st_ino) and \
+                    start <= st.st_size and meta.get('head') == self._head(data, start)
+                if same and start == st.st_size:
+                    self._db = db
+                    return 0
+
+                if not same:
+                    # a new or rewritten file: build a fresh index beside the old one
+                    db is not None and db.close()
+                    tmp_path = f"{self._index_path}.tmp"
+                    os.path.exists(tmp_path) and os.unlink(tmp_path)
+                    db = sqlite3.connect(tmp_path)
+                    db.execute("PRAGMA journal_mode = OFF")
+                    db.execute("PRAGMA synchronous = OFF")
+                    self._create(db)
+                    (start, meta) = (0, {})
+
+                (count, parsed) = self._read(db, data, start)
+                self._create_indexes(db)
+                db.executemany("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", [
+                    ('version', INDEX_VERSION), ('device', st.st_dev), ('inode', st.st_ino),
+                    ('parsed', parsed), ('head', self._head(data, parsed))])
+                db.commit()
+
+                if not same:
+                    db.close()
+                    os.replace(tmp_path, self._index_path)
+                    db = sqlite3.connect(self._index_path)
+                self._db = db
+                self._verbose and print(f"{self._path}: indexed {count} statements from byte {start} to {parsed}")
+                return count
+            finally:
+                isinstance(data, mmap.mmap) and data.close()
+
+    def _read(self, db, data, start):
+        # the latest statement of a batch for each key and address
+        (entries, rows) = ({}, {})
+        (count, parsed) = (0, start)
+
+        def flush():
+            db.executemany("INSERT OR REPLACE INTO entries (key, kind, offset, length) VALUES (?, ?, ?, ?)",
+                           entries.values())
+            db.executemany("INSERT OR REPLACE INTO leases"
+                           " (address, kind, state, starts, ends, mac, client_id, hostname, key)"
+                           " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows.values())
+            entries.clear()
+            rows.clear()
+            # what has been read is not needed again: keep the resident set flat
+            done = parsed - parsed % mmap.PAGESIZE
+            if isinstance(data, mmap.mmap) and done > 0 and hasattr(mmap, "MADV_DONTNEED"):
+                data.madvise(mmap.MADV_DONTNEED, 0, done)
+
+        for (key, head, offset, end, body) in statements(data, start, self._path):
+            kind = head.split(None, 1)[0].decode()
+            entries[key] = (key, kind, offset, end - offset)
+            if body is not None:
+                for row in leases(head, body):
+                    rows[row[0]] = row + (key,)
+            count += 1
+            parsed = end
+            len(entries) >= batch_size and flush()
+        flush()
+        return (count, parsed)
+
+    def _connection(self):
+        if self._db is None:
+            self.update()
+        return self._db
+
+    def lookup(self, ip=None, mac=None, client_id=None):
+        """
+        The latest lease of an address, or the leases of a MAC address or
+        client id, newest first, as dicts
+        """
+        clauses = []
+        ip is not None and clauses.append(("address = ?", ip))
+        mac is not None and clauses.append(("mac = ?", normalize_id(mac)))
+        client_id is not None and clauses.append(("client_id = ?", normalize_id(client_id)))
+        if not clauses:
+            raise LeaseError("look up by ip, mac or client id")
+
+        names = ("address", "kind", "state", "starts", "ends", "mac", "client_id", "hostname", "key")
+        cursor = self._connection().execute(
+            f"SELECT {', '.join(names)} FROM leases WHERE {' AND '.join(c for (c, v) in clauses)}"
+            " ORDER BY starts DESC, address", [v for (c, v) in clauses])
+        return [dict(zip(names, row)) for row in cursor]
+
+    def text(self, key):
+        """
+        The latest statement for an entry key, as written in the file
+        """
+        row = self._connection().execute("SELECT offset, length FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise LeaseError(f"no entry {key!r}")
+        with open(self._path, "rb") as f:
+            f.seek(row[0])
+            return f.read(row[1]).decode(errors="replace")
+
+    @property
+    def stats(self):
+        db = self._connection()
+        return {
+            'entries': db.execute("SELECT COUNT(*) FROM entries").fetchone()[0],
+            'leases': db.execute("SELECT COUNT(*) FROM leases").fetchone()[0],
+            'bytes': self._meta(db).get('parsed', 0),
+        }
+
+    # --------------------------------------------------------------
+    # Compaction
+    # --------------------------------------------------------------
+    def compact(self, output=None, in_place=False):
+        """
+        Write the leading comments and the latest of each statement in
+        file order, the singletons such as authoring-byte-order first.
+        In place, the old file is kept as <file>~ as dhcpd does.
+        Return {bytes before and after, entries}.
+        """
+        self.update()
+        st = os.stat(self._path)
+        target = self._path if in_place else (output or f"{self._path}.compact")
+        tmp_path = f"{target}.tmp"
+
+        db = self._connection()
+        order = "CASE WHEN kind IN ('authoring-byte-order', 'server-duid') THEN 0 ELSE 1 END, offset"
+        with open(self._path, "rb") as f, open(tmp_path, "wb") as out:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b""
+            try:
+                # the comments dhcpd writes at the top, up to the first statement
+                first = next(statements(data, 0, self._path), None)
+                out.write(data[:first[2] if first is not None else len(data)])
+                entries = 0
+                for (offset, length) in db.execute(f"SELECT offset, length FROM entries ORDER BY {order}"):
+                    out.write(data[offset:offset + length])
+                    entries += 1
+            finally:
+                isinstance(data, mmap.mmap) and data.close()
+
+        now = os.stat(self._path)
+        if (now.st_ino, now.st_size, now.st_mtime_ns) != (st.st_ino, st.st_size, st.st_mtime_ns):
+            os.unlink(tmp_path)
+            raise LeaseError(f"{self._path} changed while it was compacted: stop dhcpd first")
+        if self._meta(db).get('parsed') != st.st_size:
+            os.unlink(tmp_path)
+            raise LeaseError(f"{self._path} ends in an unfinished statement: stop dhcpd first")
+
+        if in_place:
+            os.chmod(tmp_path, st.st_mode & 0o7777)
+            os.path.lexists(f"{self._path}~") and os.unlink(f"{self._path}~")
+            os.link(self._path, f"{self._path}~")
+        os.replace(tmp_path, target)
+        return {'before': st.st_size, 'after': os.path.getsize(target), 'entries': entries}
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="index, look up and compact dhcpd lease files")
+    parser.add_argument('--verbose', '-v', action=argparse.BooleanOptionalAction)
+    parser.add_argument('--index', default=None, metavar="FILE", help="the index file, default <leases file>.index")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = commands.add_parser("index", help="build or extend the index")
+    index_parser.add_argument("leases")
+
+    lookup_parser = commands.add_parser("lookup", help="find the latest leases of an address or client")
+    lookup_parser.add_argument("--ip", default=None)
+    lookup_parser.add_argument("--mac", default=None)
+    lookup_parser.add_argument("--client-id", default=None, help="hex, or the DUID for v6")
+    lookup_parser.add_argument("--raw", action=argparse.BooleanOptionalAction, default=False,
+                               help="print the statements as written in the file")
+    lookup_parser.add_argument("leases")
+
+    compact_parser = commands.add_parser("compact", help="keep only the latest state of each lease")
+    target = compact_parser.add_mutually_exclusive_group()
+    target.add_argument("--output", default=None, help="default <leases file>.compact")
+    target.add_argument("--in-place", action=argparse.BooleanOptionalAction, default=False,
+                        help="replace the lease file, keeping the old one as <leases file>~")
+    compact_parser.add_argument("leases")
+
+    opts = parser.parse_args()
+
+    try:
+        with LeaseIndex(opts.leases, opts.index, verbose=opts.verbose) as index:
+            if opts.command == "index":
+                index.update()
+                print(yaml.dump(index.stats, sort_keys=False), end="")
+            elif opts.command == "lookup":
+                found = index.lookup(ip=opts.ip, mac=opts.mac, client_id=opts.client_id)
+                if opts.raw:
+                    for key in dict.fromkeys(lease['key'] for lease in found):
+                        print(index.text(key), end="")
+                else:
+                    for lease in found:
+                        lease['key'] = lease['key'].decode(errors="replace")
+                    print(yaml.dump(found, sort_keys=False), end="")
+            else:
+                print(yaml.dump(index.compact(opts.output, opts.in_place), sort_keys=False), end="")
+    except (LeaseError, OSError, sqlite3.Error) as e:
+        sys.exit(str(e))
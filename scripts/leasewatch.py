@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+"""
+Pool utilization metrics of a running dhcpd, from its lease file
+
+A sidecar for the dhcpd container: it mounts the same
+/etc/dhcp/dhcpd.conf and /var/lib/dhcpd volume read only and serves
+Prometheus text metrics on /metrics.
+
+* Pools are the ranges of the subnets in dhcpd.conf: each pool or pool6
+  block is a pool, and the ranges given directly in a subnet are one
+  more (its prefix6 ranges another). Leased addresses of a subnet that
+  are in none of its ranges have an empty pool label. include
+  statements are followed.
+* The lease file is read once, then only what dhcpd appends to it. The
+  latest binding state of every address is kept in memory with a count
+  of addresses in each state for each pool.
+* dhcpd rewrites the file under a new name and renames it into place.
+  The rest of the old file is read, then the new one from the start.
+* A grant is a lease that becomes active or is renewed (a new start
+  time). The grants of the rewrite itself are not counted.
+* The metrics text is rendered after each poll, so a scrape only sends
+  it
+
+USAGE:
+    leasewatch.py [--config /etc/dhcp/dhcpd.conf] [--leases /var/lib/dhcpd/dhcpd.leases]
+                  [--listen :9267] [--interval 5] [--window 60] [--once]
+"""
+
+import argparse
+import bisect
+import collections
+import http.server
+import ipaddress
+import os
+import re
+import sys
+import threading
+import time
+
+import leases
+
+# The lease file is read in blocks of this size
+read_size = 1024 * 1024
+
+# Binding states reported for every pool, seen or not
+states = ("active", "free", "backup")
+
+
+class ConfigError(Exception):
+    pass
+
+
+# ------------------------------------------------------------------------------
+# dhcpd.conf
+# ------------------------------------------------------------------------------
+_token_re = re.compile(r'\s+|#[^\n]*|"(?:[^"\\]|\\.)*"|[{};]|[^\s{};"#]+', re.S)
+
+
+def parse_config(text, path="<config>"):
+    """
+    The statements of a dhcpd.conf as a list of (words, children):
+    children is None for a statement that ends with ";"
+    """
+    root = []
+    stack = [root]
+    words = []
+    for token in _token_re.findall(text):
+        if token[0].isspace() or token[0] == "#":
+            continue
+        if token == ";":
+            words and stack[-1].append((words, None))
+            words = []
+        elif token == "{":
+            children = []
+            stack[-1].append((words, children))
+            stack.append(children)
+            words = []
+        elif token == "}":
+            if len(stack) == 1 or words:
+                raise ConfigError(f"{path}: unexpected '}}' after {' '.join(words)}")
+            stack.pop()
+        else:
+            words.append(token[1:-1] if token[0] == '"' else token)
+    if len(stack) != 1 or words:
+        raise ConfigError(f"{path}: unexpected end of file")
+    return root
+
+
+class Pool(object):
+    """
+    Address ranges of a subnet that dhcpd leases from
+    """
+
+    def __init__(self, subnet):
+        self.subnet = subnet
+        self.ranges = []
+        self.names = []
+
+    @property
+    def name(self):
+        return ",".join(self.names)
+
+    @property
+    def size(self):
+        return sum((high - low) // step + 1 for (low, high, step) in self.ranges)
+
+    def add(self, name, low, high, step=1):
+        self.names.append(name)
+        self.ranges.append((int(low), int(high), step))
+        return (int(low), int(high), self)
+
+
+class Pools(object):
+    """
+    The pools of a dhcpd.conf and the pool of any leased address
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pools = []
+        # addresses in a subnet but in none of its ranges
+        self._others = {}
+        self._subnets = []
+        # version -> [(low, high, pool)] by low
+        self._ranges = {4: [], 6: []}
+        self._walk(self._read(path), None, None)
+
+        for ranges in self._ranges.values():
+            ranges.sort(key=lambda r: r[0])
+        self._lows = {version: [r[0] for r in ranges] for (version, ranges) in self._ranges.items()}
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return parse_config(f.read(), path)
+        except OSError as e:
+            raise ConfigError(f"{path}: {e.strerror}")
+
+    def _walk(self, statements, subnet, pool):
+        for (words, children) in statements:
+            keyword = words[0] if words else ""
+            try:
+                if keyword == "include" and len(words) > 1:
+                    self._walk(self._read(words[1]), subnet, pool)
+                elif keyword == "subnet" and children is not None:
+                    network = ipaddress.ip_network(f"{words[1]}/{words[3]}")
+                    self._subnets.append(network)
+                    self._walk(children, network, None)
+                elif keyword == "subnet6" and children is not None:
+                    network = ipaddress.ip_network(words[1])
+                    self._subnets.append(network)
+                    self._walk(children, network, None)
+                elif keyword in ("pool", "pool6") and children is not None:
+                    block = Pool(subnet)
+                    self._walk(children, subnet, block)
+                    block.ranges and self.pools.append(block)
+                elif keyword in ("range", "range6", "prefix6"):
+                    self._range(words, subnet, pool)
+                elif children is not None:
+                    # shared-network, group, class and the like
+                    self._walk(children, subnet, pool)
+            except (IndexError, ValueError) as e:
+                raise ConfigError(f"{self.path}: {' '.join(words)}: {e}")
+
+    def _range(self, words, subnet, pool):
+        if pool is None:
+            # addresses and delegated prefixes are leased apart
+            kind = "prefix" if words[0] == "prefix6" else "range"
+            pool = self._others.get((kind, subnet))
+            if pool is None:
+                pool = self._others[(kind, subnet)] = Pool(subnet)
+                self.pools.append(pool)
+
+        args = [word for word in words[1:] if word not in ("dynamic-bootp", "temporary")]
+        if words[0] == "prefix6":
+            # prefix6 low high /length: the delegated prefixes between two
+            (low, high) = (ipaddress.ip_address(args[0]), ipaddress.ip_address(args[1]))
+            length = int(args[2].lstrip("/"))
+            added = pool.add(f"{low}-{high}/{length}", low, high, 2 ** (128 - length))
+        elif "/" in args[0]:
+            network = ipaddress.ip_network(args[0], strict=False)
+            (low, high) = (network.network_address, network.broadcast_address)
+            added = pool.add(args[0], low, high)
+        else:
+            low = ipaddress.ip_address(args[0])
+            high = ipaddress.ip_address(args[1]) if len(args) > 1 else low
+            added = pool.add(f"{low}-{high}", low, high)
+        self._ranges[low.version].append(added)
+
+    def find(self, address):
+        """
+        The pool of a leased address or prefix, the subnet's addresses
+        outside its ranges, or None
+        """
+        try:
+            ip = ipaddress.ip_network(address, strict=False).network_address if "/" in address \
+                else ipaddress.ip_address(address)
+        except ValueError:
+            return None
+        (n, ranges) = (int(ip), self._ranges[ip.version])
+        # dhcpd does not allow ranges to overlap
+        i = bisect.bisect_right(self._lows[ip.version], n) - 1
+        if i >= 0 and n <= ranges[i][1]:
+            return ranges[i][2]
+        for subnet in self._subnets:
+            if ip.version == subnet.version and ip in subnet:
+                pool = self._others.get(("other", subnet))
+                if pool is None:
+                    pool = self._others[("other", subnet)] = Pool(subnet)
+                return pool
+        return None
+
+
+# ------------------------------------------------------------------------------
+# Lease file
+# ------------------------------------------------------------------------------
+class LeaseTail(object):
+    """
+    The latest state of each address in a lease file that dhcpd is
+    writing, brought up to date by poll()
+    """
+
+    def __init__(self, path, pools, verbose=False):
+        self._path = path
+        self._pools = pools
+        self._verbose = verbose
+        self._file = None
+        self._identity = None
+        self._offset = 0
+        self._pending = b""
+
+        # address -> (pool, state, starts)
+        self._leases = {}
+        # pool -> state -> addresses
+        self._counts = collections.defaultdict(collections.Counter)
+        self.grants = collections.Counter()
+        self._counting = False
+        self._previous = {}
+
+        self.rewrites = 0
+        self.errors = 0
+        self.updated = None
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @property
+    def counts(self):
+        return self._counts
+
+    def close(self):
+        self._file is not None and self._file.close()
+        self._file = None
+
+    def set_pools(self, pools):
+        """
+        Count every address again against a new set of pools
+        """
+        self._pools = pools
+        self._counts = collections.defaultdict(collections.Counter)
+        for (address, (pool, state, starts)) in self._leases.items():
+            pool = pools.find(address)
+            self._leases[address] = (pool, state, starts)
+            self._counts[pool][state] += 1
+
+    def poll(self):
+        """
+        Read what was appended since the last poll, or the new file
+        after a rewrite. Return the number of bytes read.
+        """
+        try:
+            f = open(self._path, "rb")
+        except FileNotFoundError:
+            # between dhcpd's renames
+            return 0
+        st = os.fstat(f.fileno())
+        identity = (st.st_dev, st.st_ino)
+
+        if self._file is not None and identity == self._identity and st.st_size >= self._offset:
+            f.close()
+            return self._read()
+
+        read = 0
+        if self._file is not None:
+            # finish the file dhcpd replaced, then start on the new one
+            identity != self._identity and self._read()
+            self.close()
+            self.rewrites += 1
+            self._verbose and print(f"{self._path}: rewritten, reading it again")
+        (self._previous, self._leases) = (self._leases, {})
+        self._counts = collections.defaultdict(collections.Counter)
+        (self._file, self._identity, self._offset, self._pending) = (f, identity, 0, b"")
+        try:
+            read += self._load()
+        finally:
+            # grants are counted from the first read on, and not again for
+            # the leases a rewrite carries over
+            self._previous = {}
+            self._counting = True
+        return read
+
+    def _load(self):
+        # most statements of a whole file are replaced by later ones: find
+        # the latest of each first and parse only those, in file order
+        latest = {}
+
+        def keep(key, head, offset, end, body):
+            if body is not None:
+                latest.pop(key, None)
+                latest[key] = (offset, end - offset)
+
+        read = self._read(keep)
+        for (offset, length) in latest.values():
+            for (key, head, _, _, body) in leases.statements(os.pread(self._file.fileno(), length, offset)):
+                self._apply(key, head, offset, offset + length, body)
+        return read
+
+    def _read(self, apply=None):
+        apply = apply or self._apply
+        start = self._offset + len(self._pending)
+        self._file.seek(start)
+        read = 0
+        for block in iter(lambda: self._file.read(read_size), b""):
+            read += len(block)
+            data = self._pending + block
+            # parse only whole lines: the rest waits for the next block
+            end = data.rfind(b"\n") + 1
+            used = self._parse(data[:end], apply)
+            self._pending = data[used:]
+            self._offset += used
+        read and self._verbose and print(f"{self._path}: read {read} bytes to {self._offset}")
+        self.updated = time.time()
+        return read
+
+    def _parse(self, data, apply):
+        pos = 0
+        while True:
+            try:
+                for (key, head, offset, end, body) in leases.statements(data, pos, self._path):
+                    apply(key, head, self._offset + offset, self._offset + end, body)
+                    pos = end
+                return pos
+            except leases.LeaseError:
+                self.errors += 1
+                self._verbose and print(f"{self._path}: skipped a line that cannot be parsed at byte {self._offset + pos}")
+                pos = data.index(b"\n", pos) + 1
+
+    def _apply(self, key, head, offset, end, body):
+        if body is not None:
+            for row in leases.leases(head, body):
+                self._update(row[0], row[2] or "free", row[3])
+
+    def _update(self, address, state, starts):
+        old = self._leases.get(address)
+        if old is None:
+            prior = self._previous.get(address)
+            pool = prior[0] if prior is not None else self._pools.find(address)
+        else:
+            (prior, pool) = (old, old[0])
+            self._counts[pool][old[1]] -= 1
+        self._counts[pool][state] += 1
+        self._leases[address] = (pool, state, starts)
+
+        if self._counting and state == "active" and (prior is None or prior[1] != "active" or prior[2] != starts):
+            self.grants[pool] += 1
+
+
+# ------------------------------------------------------------------------------
+# Metrics
+# ------------------------------------------------------------------------------
+def _labels(pool, **extra):
+    labels = {'subnet': str(pool.subnet) if pool.subnet is not None else "", 'pool': pool.name}
+    labels.update(extra)
+    return "{" + ",".join(f'{name}="{value}"' for (name, value) in labels.items()) + "}"
+
+
+class Metrics(object):
+    """
+    Prometheus text of a LeaseTail, with grants per second over the
+    last window seconds
+    """
+
+    def __init__(self, tail, window=60):
+        self._tail = tail
+        self._window = window
+        self._samples = collections.deque()
+        self.text = b""
+
+    def update(self, pools):
+        tail = self._tail
+        now = time.monotonic()
+        self._samples.append((now, tail.grants.copy()))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self._window:
+            self._samples.popleft()
+        (then, earlier) = self._samples[0]
+
+        configured = set(pools.pools)
+        known = pools.pools + [pool for pool in tail.counts if pool is not None and pool not in configured]
+        lines = [
+            "# HELP dhcpd_pool_addresses Addresses or prefixes in the ranges of a pool",
+            "# TYPE dhcpd_pool_addresses gauge",
+        ]
+        lines.extend(f"dhcpd_pool_addresses{_labels(pool)} {pool.size}" for pool in known)
+
+        lines.append("# HELP dhcpd_pool_leases Leases of a pool by binding state")
+        lines.append("# TYPE dhcpd_pool_leases gauge")
+        for pool in known:
+            counts = tail.counts.get(pool, {})
+            for state in states + tuple(sorted(s for s in counts if s not in states and counts[s])):
+                lines.append(f"dhcpd_pool_leases{_labels(pool, state=state)} {counts.get(state, 0)}")
+
+        lines.append("# HELP dhcpd_pool_utilization Active leases over the addresses of a pool")
+        lines.append("# TYPE dhcpd_pool_utilization gauge")
+        for pool in known:
+            size = pool.size
+            active = tail.counts.get(pool, {}).get("active", 0)
+            size and lines.append(f"dhcpd_pool_utilization{_labels(pool)} {active / size:.6g}")
+
+        lines.append("# HELP dhcpd_pool_grants_total Leases granted or renewed since the sidecar started")
+        lines.append("# TYPE dhcpd_pool_grants_total counter")
+        lines.extend(f"dhcpd_pool_grants_total{_labels(pool)} {tail.grants[pool]}" for pool in known)
+
+        lines.append(f"# HELP dhcpd_pool_grants_per_second Leases granted or renewed a second over {self._window}s")
+        lines.append("# TYPE dhcpd_pool_grants_per_second gauge")
+        for pool in known:
+            rate = (tail.grants[pool] - earlier[pool]) / (now - then) if now > then else 0.0
+            lines.append(f"dhcpd_pool_grants_per_second{_labels(pool)} {rate:.6g}")
+
+        unmatched = sum(count for (state, count) in tail.counts.get(None, {}).items())
+        lines.extend([
+            "# HELP dhcpd_leases_unmatched Leased addresses in no subnet of the configuration",
+            "# TYPE dhcpd_leases_unmatched gauge",
+            f"dhcpd_leases_unmatched {unmatched}",
+            "# HELP dhcpd_leases_read_bytes How far the lease file has been read",
+            "# TYPE dhcpd_leases_read_bytes gauge",
+            f"dhcpd_leases_read_bytes {tail.offset}",
+            "# HELP dhcpd_leases_rewrites_total Rewrites of the lease file by dhcpd",
+            "# TYPE dhcpd_leases_rewrites_total counter",
+            f"dhcpd_leases_rewrites_total {tail.rewrites}",
+            "# HELP dhcpd_leases_parse_errors_total Lines of the lease file that could not be parsed",
+            "# TYPE dhcpd_leases_parse_errors_total counter",
+            f"dhcpd_leases_parse_errors_total {tail.errors}",
+        ])
+        if tail.updated is not None:
+            lines.extend([
+                "# HELP dhcpd_leases_updated_seconds When the lease file was last read",
+                "# TYPE dhcpd_leases_updated_seconds gauge",
+                f"dhcpd_leases_updated_seconds {tail.updated:.3f}",
+            ])
+        self.text = ("\n".join(lines) + "\n").encode()
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Send the last rendered metrics
+    """
+
+    def __init__(self, *args, metrics=None, **kwargs):
+        self._metrics = metrics
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        text = self._metrics.text
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+
+def serve(metrics, listen):
+    """
+    Serve the metrics from a thread. Return the server.
+    """
+    (host, _, port) = listen.rpartition(":")
+    server = http.server.ThreadingHTTPServer(
+        (host.strip("[]"), int(port)), lambda *args: _MetricsHandler(*args, metrics=metrics))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="serve dhcpd pool utilization from the lease file")
+    parser.add_argument('--verbose', '-v', action=argparse.BooleanOptionalAction)
+    parser.add_argument("--config", default="/etc/dhcp/dhcpd.conf")
+    parser.add_argument("--leases", default="/var/lib/dhcpd/dhcpd.leases")
+    parser.add_argument("--listen", default=":9267", help="[host]:port of the metrics endpoint")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between reads of the lease file")
+    parser.add_argument("--window", type=float, default=60, help="seconds the grant rate is measured over")
+    parser.add_argument("--once", action=argparse.BooleanOptionalAction, default=False,
+                        help="print the metrics once and exit")
+    opts = parser.parse_args()
+
+    try:
+        pools = Pools(opts.config)
+        config_mtime = os.stat(opts.config).st_mtime
+        tail = LeaseTail(opts.leases, pools, verbose=opts.verbose)
+        metrics = Metrics(tail, window=opts.window)
+        tail.poll()
+        metrics.update(pools)
+        if opts.once:
+            sys.stdout.write(metrics.text.decode())
+            sys.exit(0)
+
+        server = serve(metrics, opts.listen)
+        opts.verbose and print(f"serving metrics on {opts.listen}")
+        while True:
+            time.sleep(opts.interval)
+            try:
+                if os.stat(opts.config).st_mtime != config_mtime:
+                    config_mtime = os.stat(opts.config).st_mtime
+                    pools = Pools(opts.config)
+                    tail.set_pools(pools)
+                    opts.verbose and print(f"{opts.config}: reloaded, {len(pools.pools)} pools")
+            except (ConfigError, OSError) as e:
+                # keep the pools that were read last
+                print(e, file=sys.stderr)
+            tail.poll()
+            metrics.update(pools)
+    except (ConfigError, OSError) as e:
+        sys.exit(str(e))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Lockfiles for create-model-tree.py
+
+A lockfile pins everything a model tree was built from:
+
+* every RPM, by NEVRA, URL and sha256
+* every placed file, with the package and release it came from and its
+  sha256 and mode, or its symlink target
+* the daemon, its package release and extra files, and the manifest
+
+A model can be built again from the lockfile alone: no dnf queries and
+no dependency resolution, only parallel downloads that are checked
+against the pinned sha256 before anything is placed.
+
+The lockfile is YAML with sorted keys and no timestamps, so the same
+build always writes the same lockfile.
+
+USAGE:
+    lockfile.py [--verify <package dir>] <lockfile>
+"""
+
+import argparse
+import os
+import sys
+
+import yaml
+
+import store
+
+LOCK_VERSION = 1
+
+
+class LockError(Exception):
+    pass
+
+
+def rpm_entry(rpm, url, sha256):
+    """
+    The pinned record of one RPM from its header
+    """
+    epoch = f"{rpm.epoch}:" if rpm.epoch else ""
+    return {
+        'nevra': f"{rpm.name}-{epoch}{rpm.version}-{rpm.release}.{rpm.arch}",
+        'url': url,
+        'sha256': sha256,
+    }
+
+
+def write(path, images):
+    """
+    Write a lockfile for a list of image entries
+    """
+    lock = {
+        'lockVersion': LOCK_VERSION,
+        'images': sorted(images, key=lambda i: (i['name'], i.get('arch') or "")),
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        yaml.safe_dump(lock, f, sort_keys=True, default_flow_style=False)
+    os.replace(f"{path}.tmp", path)
+
+
+def read(path):
+    """
+    Read and check a lockfile. Return the list of image entries.
+    """
+    with open(path) as f:
+        lock = yaml.safe_load(f)
+
+    if not isinstance(lock, dict) or lock.get('lockVersion') != LOCK_VERSION:
+        raise LockError(f"not a version {LOCK_VERSION} lockfile: {path}")
+
+    for image in lock.get('images', []):
+        for key in ('name', 'path', 'package', 'rpms', 'files'):
+            if key not in image:
+                raise LockError(f"{path}: image {image.get('name')} has no {key}")
+        releases = {rpm['url'].split("/")[-1][:-len(".rpm")] for rpm in image['rpms']}
+        for (file_path, entry) in image['files'].items():
+            if entry['release'] not in releases:
+                raise LockError(f"{path}: {file_path} comes from {entry['release']} which is not pinned")
+    return lock['images']
+
+
+def verify_rpms(rpms, package_dir, remove=False):
+    """
+    Check each pinned RPM in package_dir against its sha256.
+    Raise LockError naming every one that is missing or different.
+    With remove, a different file is deleted so the next build fetches
+    it again.
+    """
+    problems = []
+    for rpm in {rpm['url']: rpm for rpm in rpms}.values():
+        path = os.path.join(package_dir, rpm['url'].split("/")[-1])
+        if not os.path.exists(path):
+            problems.append(f"missing: {path}")
+            continue
+        actual = store.file_digest(path)
+        if actual != rpm['sha256']:
+            problems.append(f"checksum mismatch for {path}: {actual} != {rpm['sha256']}")
+            remove and os.unlink(path)
+    if problems:
+        raise LockError("\n".join(problems))
+
+
+def verify_files(root, files, paths=None):
+    """
+    Check placed regular files against their pinned sha256.
+    Raise LockError naming every one that is different.
+    """
+    problems = []
+    for path in sorted(paths if paths is not None else files):
+        entry = files[path]
+        if entry.get('sha256') and not os.path.islink(f"{root}{path}"):
+            actual = store.file_digest(f"{root}{path}")
+            if actual != entry['sha256']:
+                problems.append(f"checksum mismatch for {root}{path}: {actual} != {entry['sha256']}")
+    if problems:
+        raise LockError("\n".join(problems))
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="show or check a create-model-tree.py lockfile")
+    parser.add_argument("--verify", default=None, metavar="PACKAGE_DIR",
+                        help="check the pinned RPMs in this directory")
+    parser.add_argument("lockfile")
+    opts = parser.parse_args()
+
+    try:
+        images = read(opts.lockfile)
+        for image in images:
+            arch = f" ({image['arch']})" if image.get('arch') else ""
+            print(f"{image['name']}{arch}: {image['path']} from {image['release']}, "
+                  f"{len(image['rpms'])} rpms, {len(image['files'])} files")
+            opts.verify is not None and verify_rpms(image['rpms'], opts.verify)
+    except (LockError, OSError) as e:
+        sys.exit(str(e))
@@ -0,0 +1,119 @@
+"""
+Persistent cache of package metadata queries for create-model-tree.py
+
+The output of each dnf query is stored in an SQLite database keyed by
+the query. Entries are dropped when the repository metadata changes
+(the revision and checksum of the cached repomd.xml files) or when they
+are older than a configurable TTL.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+# Where dnf (4 and 5) keep their copies of each repo's repomd.xml
+default_repomd_globs = [
+    "/var/cache/dnf/*/repodata/repomd.xml",
+    "/var/cache/libdnf5/*/repodata/repomd.xml",
+]
+
+REPOMD_NS = "{http://linux.duke.edu/metadata/repo}"
+
+
+def repo_revision(patterns=None):
+    """
+    Return a digest of the revision and checksums of every repomd.xml
+    found, or None if there are none to compare.
+    """
+    paths = sorted(p for pattern in (patterns or default_repomd_globs) for p in glob.glob(pattern))
+    if not paths:
+        return None
+
+    digest = hashlib.sha256()
+    for path in paths:
+        try:
+            root = ET.parse(path).getroot()
+        except (ET.ParseError, OSError):
+            continue
+        revision = root.findtext(f"{REPOMD_NS}revision") or ""
+        digest.update(f"{path}\0{revision}\0".encode())
+        for data in root.iter(f"{REPOMD_NS}data"):
+            digest.update(f"{data.get('type')}\0{data.findtext(f'{REPOMD_NS}checksum')}\0".encode())
+
+    return digest.hexdigest()
+
+
+class MetadataCache(object):
+    """
+    An SQLite table of query -> result with hit and miss counters
+    """
+
+    def __init__(self, path, ttl=None, revision=None, refresh=False):
+        self._path = path
+        self._ttl = ttl
+        self._revision = revision
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # builds sharing the cache wait for each other's writes
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS queries ("
+            " query TEXT PRIMARY KEY,"
+            " result TEXT NOT NULL,"
+            " revision TEXT,"
+            " created REAL NOT NULL)")
+        if refresh:
+            self._db.execute("DELETE FROM queries")
+        self._db.commit()
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @property
+    def stats(self):
+        return {'hits': self._hits, 'misses': self._misses}
+
+    def get(self, query):
+        """
+        Return the stored result of a query or None if there is no
+        current entry
+        """
+        key = json.dumps(query)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result, revision, created FROM queries WHERE query = ?", (key,)).fetchone()
+
+            if row is not None:
+                (result, revision, created) = row
+                stale = (self._revision is not None and revision != self._revision) or \
+                    (self._ttl is not None and time.time() - created > self._ttl)
+                if not stale:
+                    self._hits += 1
+                    return json.loads(result)
+
+            self._misses += 1
+            return None
+
+    def put(self, query, result):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO queries (query, result, revision, created) VALUES (?, ?, ?, ?)",
+                (json.dumps(query), json.dumps(result), self._revision, time.time()))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
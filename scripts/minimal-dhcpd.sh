@@ -6,13 +6,17 @@
 # To tag and publish the image
 # buildah tag localhost/dhcpd quay.io/markllama/dhcpd
 # buildah push quay.io/markllama/dhcpd
+#
+# With -o <dir> the model tree is written straight into an OCI image
+# layout instead, with no buildah container, mount or copy:
+# skopeo copy oci:<dir>:dhcpd containers-storage:quay.io/markllama/dhcpd
 
 # Stop on any error 
 set -o errexit
 
 SCRIPT=$0
 
-OPT_SPEC='a:b:c:s:r:'
+OPT_SPEC='a:b:c:s:r:o:'
 
 DEFAULT_SERVICE="dhcpd"
 DEFAULT_SOURCE_ROOT="workdir/model"
@@ -28,6 +32,11 @@ function main() {
 
     parse_args $*
 
+    if [ -n "${OCI_LAYOUT}" ] ; then
+	write_oci_layout ${SOURCE_ROOT} ${OCI_LAYOUT}
+	return
+    fi
+
     if [ -z "${BUILDAH_ISOLATION}" -o -z "${CONTAINER_ID}" ] ; then
 	# Create a container
 	local container=$(buildah from --name $SERVICE scratch)
@@ -69,6 +78,25 @@ function main() {
     fi
 }
 
+function write_oci_layout() {
+    local source_root=$1
+    local layout=$2
+
+    # The same settings as the buildah config calls above
+    python3 $(dirname ${SCRIPT})/ocilayout.py \
+	    --tree ${source_root} \
+	    --ref ${SERVICE}:latest \
+	    --mkdir /etc/dhcp --mkdir /var/lib/dhcpd \
+	    --volume /etc/dhcp/dhcpd.conf --volume /var/lib/dhcpd \
+	    --port 68/udp --port 69/udp \
+	    --cmd "/usr/sbin/dhcpd -d --no-pid" \
+	    --author "${AUTHOR}" \
+	    --created-by "${BUILDER}" \
+	    --annotation description="ISC DHCPD 4.4.3" \
+	    --annotation license="MPL-2.0" \
+	    ${layout}
+}
+
 function copy_model_tree() {
     local source_root=$1
     local container_id=$2
@@ -79,7 +107,8 @@ function copy_model_tree() {
     # Create the model directory tree
     (cd ${source_root} ; find * -type d) | xargs -I{} mkdir -p ${mountpoint}/{}
     [ -z "${DEBUG}" ] || ls -R ${mountpoint}
-    cp -r ${source_root}/* ${mountpoint}
+    # Keep symlinks and modes; share file extents where the file system allows
+    cp -a --reflink=auto ${source_root}/* ${mountpoint}
     
     # Create volume mount points
     mkdir -p ${mountpoint}/etc/dhcp
@@ -111,6 +140,9 @@ function parse_args() {
 	    r)
 		ROOT=${OPTARG}
 		;;
+	    o)
+		OCI_LAYOUT=${OPTARG}
+		;;
 	esac
     done
 }
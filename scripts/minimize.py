@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+"""
+Make a model tree smaller once it is built
+
+* Strip the sections a program does not load (symbol tables, debug info,
+  .gnu_debuglink, .comment) from ELF files in Python, rewriting the
+  section header table
+* Follow every symlink to the end of its chain and report the ones that
+  lead nowhere
+* Collapse regular files with the same content and mode into one file
+  and relative symlinks to it
+* Report the size of every file and package and check them against a
+  size budget
+
+Files are replaced, never changed in place: a model tree can share
+inodes with the content store and with other model trees.
+
+USAGE:
+    minimize.py [--no-strip] [--no-dedupe] [--state <state.json>] [--budget [PKG=]SIZE]... <model tree>
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import stat
+import struct
+import sys
+import tempfile
+
+import elffile
+import units
+
+# sh_type and sh_flags values
+SHT_RELA = 4
+SHT_NOBITS = 8
+SHT_REL = 9
+SHF_ALLOC = 0x2
+SHF_INFO_LINK = 0x40
+SHN_LORESERVE = 0xff00
+
+_shdr_format = {
+    # sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info, sh_addralign, sh_entsize
+    elffile.ELFCLASS32: "IIIIIIIIII",
+    elffile.ELFCLASS64: "IIQQQQIIQQ",
+}
+
+# The owner of files that no package put in the tree
+UNOWNED = "(model)"
+
+
+class MinimizeError(Exception):
+    pass
+
+
+def parse_budget(settings):
+    """
+    Read [package=]size settings. The total budget has the key None.
+    """
+    budget = {}
+    for setting in settings or []:
+        (name, sep, size) = setting.rpartition("=")
+        budget[name if sep else None] = units.parse_size(size)
+    return budget
+
+
+def _replace(path, data, mode):
+    """
+    Write data to a new file and put it in place of path
+    """
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".minimize-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.path.exists(tmp_path) and os.unlink(tmp_path)
+        raise
+
+
+# ------------------------------------------------------------------------------
+# Strip
+# ------------------------------------------------------------------------------
+def strip_data(data):
+    """
+    Return an ELF image without its unloaded sections, or None if there
+    is nothing to remove or the layout is not one this can rewrite.
+
+    Sections without SHF_ALLOC are dropped and a new section name table
+    and section header table are written after the loaded content. Only
+    files whose dropped sections all come after the loaded ones in the
+    section table are handled, so every kept section keeps its index and
+    the symbols that refer to them stay correct.
+    """
+    if len(data) < 64 or data[:4] != elffile.ELFMAG:
+        return None
+    elf_class = data[4]
+    byteorder = {elffile.ELFDATA2LSB: "<", elffile.ELFDATA2MSB: ">"}.get(data[5])
+    if elf_class not in _shdr_format or byteorder is None:
+        return None
+
+    header_format = byteorder + elffile._header_format[elf_class]
+    header = list(struct.unpack_from(header_format, data, 16))
+    (e_type, _, _, _, phoff, shoff, _, ehsize, phentsize, phnum, shentsize, shnum, shstrndx) = header
+    if e_type not in (elffile.ET_EXEC, elffile.ET_DYN):
+        return None
+    if shoff == 0 or shnum == 0 or shstrndx == 0 or shstrndx >= SHN_LORESERVE:
+        return None
+
+    shdr = struct.Struct(byteorder + _shdr_format[elf_class])
+    if shentsize != shdr.size or shoff + shnum * shentsize > len(data):
+        return None
+    sections = [list(shdr.unpack_from(data, shoff + i * shentsize)) for i in range(shnum)]
+
+    removed = [i for i in range(1, shnum) if not sections[i][2] & SHF_ALLOC and i != shstrndx]
+    if not removed:
+        return None
+    kept = [i for i in range(shnum) if i not in removed and i != shstrndx]
+    if max(kept) > min(removed):
+        return None
+
+    phdr = struct.Struct(byteorder + elffile._phdr_format[elf_class])
+    end = max(ehsize, phoff + phnum * phentsize)
+    for i in range(phnum):
+        fields = phdr.unpack_from(data, phoff + i * phentsize)
+        (p_offset, p_filesz) = (fields[2], fields[5]) if elf_class == elffile.ELFCLASS64 else (fields[1], fields[4])
+        end = max(end, p_offset + p_filesz)
+    for i in kept[1:]:
+        if sections[i][1] != SHT_NOBITS:
+            end = max(end, sections[i][4] + sections[i][5])
+
+    # a new name table with only the kept names
+    (name_offset, name_size) = (sections[shstrndx][4], sections[shstrndx][5])
+    names = bytearray(b"\0")
+    for i in kept[1:] + [shstrndx]:
+        name = elffile._cstring(data, name_offset + sections[i][0], name_offset + name_size)
+        sections[i][0] = len(names)
+        names += name.encode() + b"\0"
+
+    out = bytearray(data[:end])
+    sections[shstrndx][4] = len(out)
+    sections[shstrndx][5] = len(names)
+    sections[shstrndx][3] = 0
+    sections[shstrndx][6] = sections[shstrndx][7] = 0
+    out += names
+
+    # kept sections keep their index, the name table moves to the end
+    order = kept + [shstrndx]
+    index = {old: new for (new, old) in enumerate(order)}
+    for i in kept[1:]:
+        section = sections[i]
+        section[6] = index.get(section[6], 0)
+        if section[1] in (SHT_REL, SHT_RELA) or section[2] & SHF_INFO_LINK:
+            section[7] = index.get(section[7], 0)
+
+    align = 8 if elf_class == elffile.ELFCLASS64 else 4
+    out += b"\0" * (-len(out) % align)
+    header[5] = len(out)
+    header[11] = len(order)
+    header[12] = index[shstrndx]
+    struct.pack_into(header_format, out, 16, *header)
+    for i in order:
+        out += shdr.pack(*sections[i])
+
+    return bytes(out)
+
+
+def strip(path):
+    """
+    Strip an ELF file, replacing it. Return the bytes saved.
+    """
+    st = os.stat(path)
+    with open(path, "rb") as f:
+        data = f.read()
+    stripped = strip_data(data)
+    if stripped is None or len(stripped) >= len(data):
+        return 0
+
+    # the dynamic linking records must read back the same
+    before = elffile.ElfFile(path)
+    _replace(path, stripped, st.st_mode & 0o7777)
+    after = elffile.ElfFile(path)
+    if (before.interp, before.needed, before.soname, before.runpath) != \
+            (after.interp, after.needed, after.soname, after.runpath):
+        _replace(path, data, st.st_mode & 0o7777)
+        raise MinimizeError(f"stripping changed the dynamic section: {path}")
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return len(data) - len(stripped)
+
+
+# ------------------------------------------------------------------------------
+# Tree passes
+# ------------------------------------------------------------------------------
+def _walk(root):
+    """
+    Yield (path inside the tree, local path, lstat) for every entry
+    """
+    root = root.rstrip("/")
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            local = os.path.join(dirpath, name)
+            yield (local[len(root):], local, os.lstat(local))
+
+
+def dangling_links(root):
+    """
+    Follow every symlink in the tree to the end of its chain.
+    Return {link: where it ends} for links that end at nothing.
+    """
+    dangling = {}
+    for (path, local, st) in _walk(root):
+        if stat.S_ISLNK(st.st_mode):
+            try:
+                final = elffile.tree_realpath(root, path)
+            except elffile.ElfError:
+                final = None
+            if final is None or not os.path.lexists(root.rstrip("/") + final):
+                dangling[path] = final
+    return dangling
+
+
+def dedupe(root, verbose=False):
+    """
+    Replace regular files that have the same content and mode as another
+    with a relative symlink to it. The file kept is one that symlinks
+    already lead to if there is one, otherwise the first by path.
+    Return {duplicate: kept path}.
+    """
+    by_size = {}
+    linked = set()
+    for (path, local, st) in _walk(root):
+        if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+            by_size.setdefault((st.st_size, st.st_mode), []).append((path, local))
+        elif stat.S_ISLNK(st.st_mode):
+            try:
+                linked.add(elffile.tree_realpath(root, path))
+            except elffile.ElfError:
+                pass
+
+    collapsed = {}
+    for candidates in by_size.values():
+        if len(candidates) < 2:
+            continue
+        first = {}
+        for (path, local) in sorted(candidates, key=lambda c: (c[0] not in linked, c[0])):
+            digest = hashlib.sha256()
+            with open(local, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+            digest = digest.hexdigest()
+            if digest not in first:
+                first[digest] = path
+                continue
+            kept = first[digest]
+            target = os.path.relpath(kept, os.path.dirname(path))
+            verbose and print(f"dedupe: {path} -> {target}")
+            tmp_path = f"{local}.minimize"
+            os.symlink(target, tmp_path)
+            os.replace(tmp_path, local)
+            collapsed[path] = kept
+    return collapsed
+
+
+def size_report(root, owners=None):
+    """
+    The size of every file in the tree and the total for each package.
+    owners maps paths in the tree to the package that put them there.
+    """
+    owners = owners or {}
+    files = {}
+    packages = {}
+    total = 0
+    for (path, local, st) in _walk(root):
+        if stat.S_ISDIR(st.st_mode):
+            continue
+        size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+        owner = owners.get(path, UNOWNED)
+        files[path] = {'size': size, 'package': owner}
+        packages[owner] = packages.get(owner, 0) + size
+        total += size
+    return {
+        'total': total,
+        'packages': dict(sorted(packages.items(), key=lambda kv: -kv[1])),
+        'files': files,
+    }
+
+
+def check(report, budget=None):
+    """
+    Return a message for each dangling link and for each package, and
+    the total, over its budget
+    """
+    found = [f"{link}: symlink leads to nothing ({final})" for (link, final) in report['dangling'].items()]
+    for (name, limit) in (budget or {}).items():
+        size = report['total'] if name is None else report['packages'].get(name, 0)
+        if size > limit:
+            found.append(f"{name or 'total'}: {size} bytes is over the budget of {limit} bytes")
+    return found
+
+
+def minimize(root, owners=None, strip_files=True, dedupe_files=True, verbose=False):
+    """
+    Run the passes over a model tree. Return the size report, which also
+    names every stripped, collapsed and dangling file.
+    """
+    before = size_report(root, owners)
+
+    stripped = {}
+    if strip_files:
+        for (path, kind) in elffile.scan(root).items():
+            if kind in (elffile.DYNAMIC, elffile.PIE, elffile.SHARED, elffile.STATIC):
+                saved = strip(root.rstrip("/") + path)
+                saved and stripped.setdefault(path, saved)
+                verbose and saved and print(f"strip: {path} -{saved}")
+
+    collapsed = dedupe(root, verbose=verbose) if dedupe_files else {}
+    dangling = dangling_links(root)
+
+    report = size_report(root, owners)
+    report['before'] = before['total']
+    report['stripped'] = stripped
+    report['collapsed'] = collapsed
+    report['dangling'] = dangling
+    return report
+
+
+def report_table(report, top=10):
+    lines = [f"{'package':<40} {'bytes':>12}"]
+    for (name, size) in report['packages'].items():
+        lines.append(f"{name:<40} {size:>12}")
+    lines.append(f"{'total':<40} {report['total']:>12}")
+    if 'before' in report:
+        lines.append(f"{'before':<40} {report['before']:>12}")
+    lines.append("")
+    lines.append(f"{'largest files':<60} {'bytes':>12}")
+    largest = sorted(report['files'].items(), key=lambda kv: -kv[1]['size'])[:top]
+    for (path, entry) in largest:
+        lines.append(f"{path:<60} {entry['size']:>12}")
+    return "\n".join(lines)
+
+
+def state_owners(state_path):
+    """
+    The package of each path from a model state file
+    """
+    with open(state_path) as f:
+        return {path: entry['package'] for (path, entry) in json.load(f).get('files', {}).items()}
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="make a model tree smaller and report its size")
+    parser.add_argument('--verbose', '-v', action=argparse.BooleanOptionalAction)
+    parser.add_argument('--strip', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--dedupe', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--state', default=None, help="model state file naming the package of each file")
+    parser.add_argument('--budget', action='append', default=[], metavar="[PACKAGE=]SIZE")
+    parser.add_argument('--report', default=None, help="write the JSON report to this file")
+    parser.add_argument("tree")
+    opts = parser.parse_args()
+
+    try:
+        owners = state_owners(opts.state) if opts.state is not None else None
+        budget = parse_budget(opts.budget)
+        report = minimize(opts.tree, owners, opts.strip, opts.dedupe, opts.verbose)
+    except (MinimizeError, elffile.ElfError, ValueError) as e:
+        sys.exit(str(e))
+
+    print(report_table(report))
+    if opts.report is not None:
+        with open(opts.report, "w") as f:
+            json.dump(report, f, indent=1)
+
+    failures = check(report, budget)
+    failures and sys.exit("\n".join(failures))
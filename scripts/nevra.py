@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""
+Package names and version ordering for create-model-tree.py
+
+* Nevra: a package name split once into name, epoch, version, release
+  and arch, with a sort key that orders versions the way rpm does
+* rpmvercmp: rpm's own pairwise version comparison
+* select: keep the releases built for some arches or a distro
+
+The sort key turns each version into a tuple of tokens so that sorting a
+list of k releases parses each name once and compares plain tuples,
+instead of parsing both names again for every one of the k log k
+comparisons.
+
+USAGE:
+    nevra.py [--bench COUNT] [name...]
+"""
+
+import argparse
+import functools
+import os
+import random
+import re
+import sys
+import time
+
+# Tokens of a version sort key. A tilde sorts before the end of the string,
+# a caret after the end but before anything else and numbers after letters.
+_TILDE = (0,)
+_END = (1,)
+_CARET = (2,)
+_ALPHA = 3
+_NUMBER = 4
+
+_segment_re = re.compile(r"~|\^|[0-9]+|[a-zA-Z]+")
+
+
+def rpmvercmp(a, b):
+    """
+    Compare two version or release strings the way rpm does.
+    Return -1, 0 or 1.
+    """
+    if a == b:
+        return 0
+
+    def alnum(c):
+        return c.isascii() and c.isalnum()
+
+    i = j = 0
+    while True:
+        while i < len(a) and not alnum(a[i]) and a[i] not in "~^":
+            i += 1
+        while j < len(b) and not alnum(b[j]) and b[j] not in "~^":
+            j += 1
+
+        # a tilde sorts before anything, even the end of the string
+        a_tilde = i < len(a) and a[i] == "~"
+        b_tilde = j < len(b) and b[j] == "~"
+        if a_tilde or b_tilde:
+            if not a_tilde:
+                return 1
+            if not b_tilde:
+                return -1
+            i += 1
+            j += 1
+            continue
+
+        # a caret sorts after the end of the string but before anything else
+        if (i < len(a) and a[i] == "^") or (j < len(b) and b[j] == "^"):
+            if i >= len(a):
+                return -1
+            if j >= len(b):
+                return 1
+            if a[i] != "^":
+                return 1
+            if b[j] != "^":
+                return -1
+            i += 1
+            j += 1
+            continue
+
+        if i >= len(a) or j >= len(b):
+            break
+
+        isnum = a[i].isdigit()
+        test = str.isdigit if isnum else str.isalpha
+        start1 = i
+        while i < len(a) and a[i].isascii() and test(a[i]):
+            i += 1
+        start2 = j
+        while j < len(b) and b[j].isascii() and test(b[j]):
+            j += 1
+        seg1 = a[start1:i]
+        seg2 = b[start2:j]
+
+        # numeric segments are newer than alpha segments
+        if not seg2:
+            return 1 if isnum else -1
+
+        if isnum:
+            seg1 = seg1.lstrip("0")
+            seg2 = seg2.lstrip("0")
+            if len(seg1) != len(seg2):
+                return 1 if len(seg1) > len(seg2) else -1
+
+        if seg1 != seg2:
+            return 1 if seg1 > seg2 else -1
+
+    if i >= len(a) and j >= len(b):
+        return 0
+    return -1 if i >= len(a) else 1
+
+
+@functools.lru_cache(maxsize=65536)
+def version_key(version):
+    """
+    A tuple that sorts version strings in the same order as rpmvercmp
+    """
+    key = []
+    for segment in _segment_re.findall(version):
+        if segment == "~":
+            key.append(_TILDE)
+        elif segment == "^":
+            key.append(_CARET)
+        elif segment.isdigit():
+            key.append((_NUMBER, int(segment)))
+        else:
+            key.append((_ALPHA, segment))
+    key.append(_END)
+    return tuple(key)
+
+
+def evr_key(epoch, version, release):
+    """
+    The sort key of an epoch, version and release
+    """
+    return (int(epoch or 0), version_key(version), version_key(release or ""))
+
+
+def host_arches():
+    """
+    The arches a package built for this host may have
+    """
+    return (os.uname().machine, "noarch")
+
+
+class Nevra(object):
+    """
+    A package name split into its parts. The parts are read only and the
+    sort key is computed once when the name is parsed.
+    """
+
+    __slots__ = ("name", "epoch", "version", "release", "arch", "key")
+
+    def __init__(self, name, epoch, version, release, arch):
+        self.name = name
+        self.epoch = int(epoch or 0)
+        self.version = version
+        self.release = release
+        self.arch = arch
+        self.key = evr_key(self.epoch, version, release)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=65536)
+    def parse(fullname):
+        """
+        Split name-[epoch:]version-release.arch. An epoch may also lead
+        the whole name (epoch:name-version-release.arch).
+        Return None if the string is not a package name.
+        """
+        (rest, dot, arch) = fullname.rpartition(".")
+        parts = rest.rsplit("-", 2)
+        if not dot or len(parts) != 3 or not all(parts):
+            return None
+
+        (name, version, release) = parts
+        epoch = None
+        if ":" in version:
+            (epoch, version) = version.split(":", 1)
+        elif ":" in name:
+            (epoch, name) = name.split(":", 1)
+        if epoch is not None and not epoch.isdigit():
+            return None
+
+        return Nevra(name, epoch, version, release, arch)
+
+    @property
+    def distro(self):
+        """
+        The distribution tag at the end of the release, e.g. fc40, or None
+        """
+        (build, dot, distro) = self.release.rpartition(".")
+        return distro if dot else None
+
+    @property
+    def evr(self):
+        epoch = f"{self.epoch}:" if self.epoch else ""
+        return f"{epoch}{self.version}-{self.release}"
+
+    def __str__(self):
+        return f"{self.name}-{self.evr}.{self.arch}"
+
+    def __repr__(self):
+        return f"Nevra({str(self)!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, Nevra) and \
+            (self.name, self.key, self.arch) == (other.name, other.key, other.arch)
+
+    def __hash__(self):
+        return hash((self.name, self.key, self.arch))
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+def select(releases, arches=None, distro=None):
+    """
+    Keep the releases built for one of the arches and for the distro.
+    Anything with arch and distro attributes will do.
+    """
+    return [
+        r for r in releases
+        if (arches is None or r.arch in arches) and (distro is None or r.distro == distro)
+    ]
+
+
+# ------------------------------------------------------------------------------
+# Benchmark
+# ------------------------------------------------------------------------------
+def synthetic_names(count, seed=0):
+    """
+    Package names like those in dnf provides output for a multi-arch,
+    multi-distro repo set
+    """
+    rand = random.Random(seed)
+    names = []
+    for n in range(count):
+        version = ".".join(str(rand.randint(0, 40)) for _ in range(rand.randint(1, 4)))
+        rand.random() < 0.1 and (version := version + rand.choice(["~rc1", "^git1", "a", "~beta2"]))
+        release = f"{rand.randint(1, 30)}.{rand.choice(['fc39', 'fc40', 'fc41', 'el9'])}"
+        epoch = f"{rand.randint(1, 3)}:" if rand.random() < 0.2 else ""
+        arch = rand.choice(["x86_64", "i686", "aarch64", "noarch"])
+        names.append(f"pkg-{n % 50}-{epoch}{version}-{release}.{arch}")
+    return names
+
+
+def _pairwise(a, b):
+    return (a.epoch > b.epoch) - (a.epoch < b.epoch) or \
+        rpmvercmp(a.version, b.version) or rpmvercmp(a.release, b.release)
+
+
+def benchmark(count, repeat=5):
+    """
+    Time sorting package names by pairwise rpmvercmp and by sort key.
+    Return a dict of the best time of each in seconds.
+    """
+    names = synthetic_names(count)
+
+    def timed(run):
+        best = None
+        for _ in range(repeat):
+            version_key.cache_clear()
+            Nevra.parse.cache_clear()
+            start = time.perf_counter()
+            result = run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return (best, result)
+
+    # parse inside every comparison, as a cmp_to_key sort over names does
+    (pairwise, by_cmp) = timed(lambda: sorted(
+        names, key=functools.cmp_to_key(lambda a, b: _pairwise(Nevra.parse.__wrapped__(a), Nevra.parse.__wrapped__(b)))))
+    (keyed, by_key) = timed(lambda: [str(r) for r in sorted(Nevra.parse(n) for n in names)])
+
+    # equal versions may sit in either order, so compare the keys
+    if [Nevra.parse(n).key for n in by_cmp] != [Nevra.parse(n).key for n in by_key]:
+        raise AssertionError("sort key and rpmvercmp disagree")
+
+    return {'count': count, 'pairwise': pairwise, 'keyed': keyed}
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="parse and sort package names")
+    parser.add_argument("--bench", type=int, default=None, metavar="COUNT",
+                        help="time sorting COUNT synthetic names")
+    parser.add_argument("--arch", dest="arches", action="append", default=None,
+                        help="keep only names for this arch, may be repeated")
+    parser.add_argument("--distro", default=None)
+    parser.add_argument("names", nargs="*")
+    opts = parser.parse_args()
+
+    if opts.bench is not None:
+        result = benchmark(opts.bench)
+        print(f"{result['count']} names: pairwise {result['pairwise']:.4f}s "
+              f"keyed {result['keyed']:.4f}s ({result['pairwise'] / result['keyed']:.1f}x)")
+        sys.exit(0)
+
+    releases = [Nevra.parse(n) for n in opts.names]
+    for (name, r) in zip(opts.names, releases):
+        r is None and print(f"not a package name: {name}", file=sys.stderr)
+    for r in sorted(select([r for r in releases if r is not None], opts.arches, opts.distro), reverse=True):
+        print(r)
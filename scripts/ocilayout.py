@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+"""
+Write a model tree straight into an OCI image layout
+
+* One tar layer, or ordered layers of chosen paths, with entries in
+  sorted order, every mtime clamped to SOURCE_DATE_EPOCH, uid and gid
+  fixed and no user or group names. The same files give the same layer
+  digest in every image, so a registry stores and serves it once.
+* The layer is compressed (gzip or zstd) and hashed as it is written, so
+  the tree is read once and nothing is staged on disk
+* The image config and manifest are built from the same settings that
+  minimal-dhcpd.sh passes to `buildah config` (cmd, volumes, ports,
+  author, created-by, annotations)
+* JSON is written with sorted keys so identical inputs give identical
+  digests for the layer, config and manifest
+
+This needs no container runtime, root or user namespace. The result can
+be read with `podman pull oci:<dir>:<name>` or `skopeo copy oci:<dir>:<name> ...`.
+
+USAGE:
+    ocilayout.py --tree <model tree> --ref <name:tag> [image settings] <layout dir>
+"""
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import shlex
+import stat
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+compressions = ("gzip", "zstd", "none")
+
+MEDIA_TYPE_INDEX = "application/vnd.oci.image.index.v1+json"
+MEDIA_TYPE_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+MEDIA_TYPE_CONFIG = "application/vnd.oci.image.config.v1+json"
+MEDIA_TYPE_LAYER = {
+    'gzip': "application/vnd.oci.image.layer.v1.tar+gzip",
+    'zstd': "application/vnd.oci.image.layer.v1.tar+zstd",
+    'none': "application/vnd.oci.image.layer.v1.tar",
+}
+
+ANNOTATION_REF_NAME = "org.opencontainers.image.ref.name"
+
+# OCI names for the machine names os.uname() reports
+oci_architectures = {
+    'x86_64': "amd64",
+    'aarch64': "arm64",
+    'i686': "386",
+    'armv7hl': "arm",
+    'ppc64le': "ppc64le",
+    's390x': "s390x",
+}
+
+default_env = ["PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"]
+
+# Read and write in chunks of this size
+chunk_size = 1024 * 1024
+
+
+class OciError(Exception):
+    pass
+
+
+def source_date_epoch(default=0):
+    """
+    The time every entry is clamped to: SOURCE_DATE_EPOCH if it is set
+    """
+    value = os.environ.get("SOURCE_DATE_EPOCH")
+    if value is None or value == "":
+        return default
+    if not value.isdigit():
+        raise OciError(f"SOURCE_DATE_EPOCH is not a number of seconds: {value}")
+    return int(value)
+
+
+def _canonical(data):
+    return json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+
+
+def _timestamp(epoch):
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+# ------------------------------------------------------------------------------
+# Streams
+# ------------------------------------------------------------------------------
+class _HashWriter(object):
+    """
+    Pass data on to another writer, counting and hashing it
+    """
+
+    def __init__(self, output):
+        self._output = output
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self._output.write(data)
+
+    def flush(self):
+        pass
+
+
+class _ZstdPipe(object):
+    """
+    Compress through the zstd command when the zstandard module is missing
+    """
+
+    def __init__(self, output, level):
+        self._process = subprocess.Popen(["zstd", f"-{level}", "-q", "-c"],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._error = None
+        self._thread = threading.Thread(target=self._drain, args=(output,), daemon=True)
+        self._thread.start()
+
+    def _drain(self, output):
+        try:
+            for block in iter(lambda: self._process.stdout.read(chunk_size), b""):
+                output.write(block)
+        except BaseException as e:
+            self._error = e
+
+    def write(self, data):
+        self._process.stdin.write(data)
+        return len(data)
+
+    def close(self):
+        self._process.stdin.close()
+        self._thread.join()
+        if self._process.wait() != 0:
+            raise OciError(f"zstd failed with status {self._process.returncode}")
+        if self._error is not None:
+            raise self._error
+
+
+def _compressor(output, compression, level=None):
+    if compression == "gzip":
+        # no file name and a zero mtime in the gzip header
+        return gzip.GzipFile(filename="", mode="wb", fileobj=output, mtime=0,
+                             compresslevel=level if level is not None else 6)
+    if compression == "zstd":
+        level = level if level is not None else 3
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=level, write_checksum=True).stream_writer(output, closefd=False)
+        return _ZstdPipe(output, level)
+    if compression == "none":
+        return None
+    raise OciError(f"unknown compression: {compression}")
+
+
+# ------------------------------------------------------------------------------
+# Layer
+# ------------------------------------------------------------------------------
+def tree_entries(tree, paths=None, extra_dirs=()):
+    """
+    Return the sorted relative paths of a tree, or of the given paths and
+    their parent directories, plus extra directories
+    """
+    tree = tree.rstrip("/")
+    found = set()
+    if paths is None:
+        for (dirpath, dirnames, filenames) in os.walk(tree):
+            for name in dirnames + filenames:
+                found.add(os.path.relpath(os.path.join(dirpath, name), tree))
+    else:
+        for path in paths:
+            relative = path.strip("/")
+            while relative:
+                found.add(relative)
+                relative = os.path.dirname(relative)
+
+    for path in extra_dirs:
+        relative = path.strip("/")
+        while relative:
+            found.add(relative)
+            relative = os.path.dirname(relative)
+
+    return sorted(found, key=lambda p: p.encode())
+
+
+def _tarinfo(tree, relative, mtime, uid, gid):
+    """
+    The tar header for one path. Returns (TarInfo, local path or None).
+    """
+    local = os.path.join(tree, relative)
+    info = tarfile.TarInfo(relative)
+    info.uid = uid
+    info.gid = gid
+    info.uname = ""
+    info.gname = ""
+
+    try:
+        st = os.lstat(local)
+    except FileNotFoundError:
+        # an extra directory that is not in the tree
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        info.mtime = mtime
+        return (info, None)
+
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.mtime = min(int(st.st_mtime), mtime)
+    if stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+        return (info, None)
+    if stat.S_ISLNK(st.st_mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(local)
+        return (info, None)
+    if stat.S_ISREG(st.st_mode):
+        # hard links in the tree depend on how files were placed, so
+        # every file is stored in full
+        info.type = tarfile.REGTYPE
+        info.size = st.st_size
+        return (info, local)
+    raise OciError(f"unsupported file type in model tree: {local}")
+
+
+def write_layer(layout_dir, tree, compression="gzip", mtime=0, uid=0, gid=0,
+                paths=None, extra_dirs=(), level=None):
+    """
+    Write a tree (or the listed paths of it) as a layer blob.
+    Return (descriptor, diff_id).
+    """
+    blobs = os.path.join(layout_dir, "blobs", "sha256")
+    os.makedirs(blobs, exist_ok=True)
+
+    (fd, tmp_path) = tempfile.mkstemp(dir=blobs, prefix=".layer-")
+    try:
+        with os.fdopen(fd, "wb") as blob:
+            compressed = _HashWriter(blob)
+            compressor = _compressor(compressed, compression, level)
+            uncompressed = _HashWriter(compressor if compressor is not None else compressed)
+
+            with tarfile.open(fileobj=uncompressed, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                for relative in tree_entries(tree, paths, extra_dirs):
+                    (info, local) = _tarinfo(tree, relative, mtime, uid, gid)
+                    if local is None:
+                        tar.addfile(info)
+                    else:
+                        with open(local, "rb") as f:
+                            tar.addfile(info, f)
+            compressor is not None and compressor.close()
+
+        digest = compressed.digest.hexdigest()
+        os.replace(tmp_path, os.path.join(blobs, digest))
+    except BaseException:
+        os.path.exists(tmp_path) and os.unlink(tmp_path)
+        raise
+
+    descriptor = {
+        'mediaType': MEDIA_TYPE_LAYER[compression],
+        'digest': f"sha256:{digest}",
+        'size': compressed.size,
+    }
+    return (descriptor, f"sha256:{uncompressed.digest.hexdigest()}")
+
+
+# ------------------------------------------------------------------------------
+# Image
+# ------------------------------------------------------------------------------
+def add_image_arguments(parser):
+    """
+    Image settings, named as for `buildah config`
+    """
+    parser.add_argument("--cmd", default=None, help="default command, a JSON array or shell words")
+    parser.add_argument("--entrypoint", default=None, help="entrypoint, a JSON array or shell words")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE")
+    parser.add_argument("--port", dest="ports", action="append", default=[], metavar="PORT[/PROTO]")
+    parser.add_argument("--volume", dest="volumes", action="append", default=[], metavar="PATH")
+    parser.add_argument("--label", dest="labels", action="append", default=[], metavar="NAME=VALUE")
+    parser.add_argument("--annotation", dest="annotations", action="append", default=[], metavar="NAME=VALUE")
+    parser.add_argument("--author", default=None)
+    parser.add_argument("--created-by", default=None)
+    parser.add_argument("--workingdir", default=None)
+    parser.add_argument("--mkdir", dest="dirs", action="append", default=[], metavar="PATH",
+                        help="empty directory to create in the layer, e.g. a volume mount point")
+    parser.add_argument("--compression", choices=compressions, default="gzip")
+    parser.add_argument("--source-date-epoch", type=int, default=None,
+                        help="clamp every time to this, default $SOURCE_DATE_EPOCH or 0")
+
+
+def _words(value):
+    if value is None:
+        return None
+    if value.lstrip().startswith("["):
+        return json.loads(value)
+    return shlex.split(value)
+
+
+def _pairs(values, what):
+    pairs = {}
+    for value in values:
+        (name, sep, setting) = value.partition("=")
+        if not sep:
+            raise OciError(f"{what} is not NAME=VALUE: {value}")
+        pairs[name] = setting
+    return pairs
+
+
+def image_settings(opts):
+    """
+    The image settings from parsed add_image_arguments() options
+    """
+    return {
+        'cmd': _words(opts.cmd),
+        'entrypoint': _words(opts.entrypoint),
+        'env': default_env + list(opts.env),
+        'ports': list(opts.ports),
+        'volumes': list(opts.volumes),
+        'labels': _pairs(opts.labels, "label"),
+        'annotations': _pairs(opts.annotations, "annotation"),
+        'author': opts.author,
+        'created_by': opts.created_by,
+        'workingdir': opts.workingdir,
+        'dirs': list(opts.dirs),
+        'compression': opts.compression,
+        'epoch': opts.source_date_epoch if opts.source_date_epoch is not None else source_date_epoch(),
+    }
+
+
+def image_config(diff_ids, settings, architecture=None):
+    """
+    The OCI image config for a list of layer diff ids
+    """
+    created = _timestamp(settings['epoch'])
+    config = {'Env': settings['env']}
+    settings['cmd'] is not None and config.setdefault('Cmd', settings['cmd'])
+    settings['entrypoint'] is not None and config.setdefault('Entrypoint', settings['entrypoint'])
+    settings['workingdir'] and config.setdefault('WorkingDir', settings['workingdir'])
+    settings['labels'] and config.setdefault('Labels', settings['labels'])
+    if settings['ports']:
+        config['ExposedPorts'] = {p if "/" in p else f"{p}/tcp": {} for p in settings['ports']}
+    if settings['volumes']:
+        config['Volumes'] = {v: {} for v in settings['volumes']}
+
+    history = {'created': created}
+    settings['created_by'] and history.setdefault('created_by', settings['created_by'])
+    settings['author'] and history.setdefault('author', settings['author'])
+
+    image = {
+        'created': created,
+        'architecture': oci_architectures.get(architecture or os.uname().machine, architecture),
+        'os': "linux",
+        'config': config,
+        'rootfs': {'type': "layers", 'diff_ids': list(diff_ids)},
+        'history': [dict(history) for _ in diff_ids],
+    }
+    settings['author'] and image.setdefault('author', settings['author'])
+    return image
+
+
+class ImageLayout(object):
+    """
+    An OCI image layout directory: oci-layout, index.json and blobs/sha256
+    """
+
+    def __init__(self, path):
+        self._path = path
+        os.makedirs(os.path.join(path, "blobs", "sha256"), exist_ok=True)
+        layout = os.path.join(path, "oci-layout")
+        if not os.path.exists(layout):
+            self._write(layout, _canonical({'imageLayoutVersion': "1.0.0"}))
+
+    @property
+    def path(self):
+        return self._path
+
+    @staticmethod
+    def _write(path, data):
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    def add_blob(self, data, media_type):
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self._path, "blobs", "sha256", digest)
+        os.path.exists(path) or self._write(path, data)
+        return {'mediaType': media_type, 'digest': f"sha256:{digest}", 'size': len(data)}
+
+    def add_layer(self, tree, settings, paths=None, extra_dirs=()):
+        return write_layer(self._path, tree, compression=settings['compression'], mtime=settings['epoch'],
+                           paths=paths, extra_dirs=extra_dirs)
+
+    def add_image(self, ref, layers, diff_ids, settings, architecture=None):
+        """
+        Write the config and manifest for a list of layers and, if ref is
+        given, name the manifest ref in index.json. Return the manifest
+        descriptor with the platform of the image.
+        """
+        image = image_config(diff_ids, settings, architecture)
+        config = self.add_blob(_canonical(image), MEDIA_TYPE_CONFIG)
+        manifest = {
+            'schemaVersion': 2,
+            'mediaType': MEDIA_TYPE_MANIFEST,
+            'config': config,
+            'layers': list(layers),
+        }
+        settings['annotations'] and manifest.setdefault('annotations', settings['annotations'])
+        descriptor = self.add_blob(_canonical(manifest), MEDIA_TYPE_MANIFEST)
+        descriptor['platform'] = {'architecture': image['architecture'], 'os': image['os']}
+        ref is not None and self.name(ref, descriptor)
+        return descriptor
+
+    def add_index(self, ref, manifests):
+        """
+        Write an image index of manifests for several platforms and name
+        it ref in index.json. Return the index descriptor.
+        """
+        index = {
+            'schemaVersion': 2,
+            'mediaType': MEDIA_TYPE_INDEX,
+            'manifests': sorted(manifests, key=lambda m: (m['platform']['architecture'], m['digest'])),
+        }
+        descriptor = self.add_blob(_canonical(index), MEDIA_TYPE_INDEX)
+        self.name(ref, descriptor)
+        return descriptor
+
+    def name(self, ref, descriptor):
+        """
+        Name a manifest or index ref in index.json, replacing any other of
+        that name
+        """
+        descriptor = dict(descriptor, annotations={ANNOTATION_REF_NAME: ref})
+        index_path = os.path.join(self._path, "index.json")
+        index = {'schemaVersion': 2, 'mediaType': MEDIA_TYPE_INDEX, 'manifests': []}
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+        manifests = [m for m in index.get('manifests', [])
+                     if m.get('annotations', {}).get(ANNOTATION_REF_NAME) != ref]
+        manifests.append(descriptor)
+        # entries without a name are valid and have no annotations at all
+        index['manifests'] = sorted(manifests, key=lambda m: (m.get('annotations', {}).get(ANNOTATION_REF_NAME, ""),
+                                                              m['digest']))
+        self._write(index_path, _canonical(index))
+
+
+def _add_layers(layout, tree, settings, layers=None):
+    """
+    Write a tree as one layer, or as a layer for each list of paths in
+    layers, bottom first. Extra directories go in the top layer.
+    Return (descriptors, diff_ids).
+    """
+    layers = layers if layers is not None else [None]
+    written = [layout.add_layer(tree, settings, paths=paths,
+                                extra_dirs=settings['dirs'] if n == len(layers) - 1 else ())
+               for (n, paths) in enumerate(layers)]
+    return ([layer for (layer, diff_id) in written], [diff_id for (layer, diff_id) in written])
+
+
+def write_image(layout_dir, tree, ref, settings, architecture=None, layers=None):
+    """
+    Write a model tree as an image, in a single layer or split into
+    layers of paths. Return the manifest descriptor.
+    """
+    layout = ImageLayout(layout_dir)
+    (descriptors, diff_ids) = _add_layers(layout, tree, settings, layers)
+    return layout.add_image(ref, descriptors, diff_ids, settings, architecture)
+
+
+def write_index(layout_dir, trees, ref, settings, layers=None):
+    """
+    Write an image for each {arch: model tree} and an image index for
+    all of them named ref. layers, if given, splits each tree as
+    {arch: [paths, ...]}. Return the index descriptor.
+    """
+    layout = ImageLayout(layout_dir)
+    manifests = []
+    for (arch, tree) in sorted(trees.items()):
+        (descriptors, diff_ids) = _add_layers(layout, tree, settings, layers[arch] if layers is not None else None)
+        manifests.append(layout.add_image(None, descriptors, diff_ids, settings, arch))
+    return layout.add_index(ref, manifests)
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="write a model tree into an OCI image layout")
+    parser.add_argument('--verbose', '-v', action=argparse.BooleanOptionalAction)
+    parser.add_argument("--tree", required=True, help="model tree to put in the image")
+    parser.add_argument("--ref", required=True, help="name of the image in the layout, e.g. dhcpd:latest")
+    parser.add_argument("--arch", default=None, help="machine name of the image, default the host")
+    add_image_arguments(parser)
+    parser.add_argument("layout_dir")
+    opts = parser.parse_args()
+
+    try:
+        descriptor = write_image(opts.layout_dir, opts.tree, opts.ref, image_settings(opts), opts.arch)
+    except (OciError, OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    opts.verbose and print(f"{opts.ref}: {descriptor['digest']}")
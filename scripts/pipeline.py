@@ -0,0 +1,122 @@
+"""
+Staged asyncio pipeline for create-model-tree.py
+
+* Work is split into named stages (resolve, fetch, unpack, place)
+* Each stage has its own bound on concurrent work and its own threads
+* Blocking work (dnf queries, downloads, RPM extraction) runs in the
+  stage's threads so the event loop keeps every other item moving
+* An item moves on to its next stage as soon as its own inputs are done,
+  so one library can unpack while another downloads and a third is
+  still being resolved
+* Work shared by several items (one package for many libraries) is run
+  once and awaited by all of them
+"""
+
+import asyncio
+import concurrent.futures
+import time
+
+import profiler
+
+# Concurrent calls allowed in each stage unless set otherwise
+default_concurrency = {
+    'resolve': 4,
+    'fetch': 8,
+    'unpack': 4,
+    'place': 2,
+}
+
+
+def parse_concurrency(settings):
+    """
+    Read stage=count settings into a dict
+    """
+    concurrency = {}
+    for setting in settings or []:
+        (stage, sep, count) = setting.partition("=")
+        if not sep or not count.isdigit() or int(count) < 1:
+            raise ValueError(f"expected <stage>=<count>: {setting}")
+        concurrency[stage] = int(count)
+    return concurrency
+
+
+class _Stage(object):
+    """
+    The threads, counters and bound of one stage
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=f"stage-{name}")
+        self.semaphore = asyncio.Semaphore(workers)
+        self.calls = 0
+        self.busy = 0.0
+        self.active = 0
+        self.max_active = 0
+
+
+class Pipeline(object):
+    """
+    Run blocking calls in named stages from asyncio tasks
+    """
+
+    def __init__(self, concurrency=None, verbose=False):
+        self._concurrency = dict(default_concurrency, **(concurrency or {}))
+        self._verbose = verbose
+        self._stages = {}
+        self._shared = {}
+
+    def _stage(self, name):
+        if name not in self._stages:
+            self._stages[name] = _Stage(name, self._concurrency.get(name, 4))
+        return self._stages[name]
+
+    async def run(self, stage, func, *args, **kwargs):
+        """
+        Call func in a thread of the stage once the stage has room.
+        Return its result.
+        """
+        stage = self._stage(stage)
+        async with stage.semaphore:
+            stage.active += 1
+            stage.max_active = max(stage.max_active, stage.active)
+            start = time.perf_counter()
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(stage.executor, self._call, stage.name, func, args, kwargs)
+            finally:
+                stage.busy += time.perf_counter() - start
+                stage.calls += 1
+                stage.active -= 1
+
+    @staticmethod
+    def _call(stage, func, args, kwargs):
+        with profiler.span(f"stage.{stage}", function=getattr(func, "__qualname__", repr(func))):
+            return func(*args, **kwargs)
+
+    def once(self, key, factory):
+        """
+        Return the task for key, starting factory() as a task the first
+        time the key is asked for
+        """
+        if key not in self._shared:
+            self._shared[key] = asyncio.ensure_future(factory())
+        return self._shared[key]
+
+    @property
+    def stats(self):
+        return {
+            name: {
+                'workers': stage.workers,
+                'calls': stage.calls,
+                'busy': round(stage.busy, 3),
+                'max_active': stage.max_active,
+            }
+            for (name, stage) in self._stages.items()
+        }
+
+    def close(self):
+        for stage in self._stages.values():
+            stage.executor.shutdown(wait=True)
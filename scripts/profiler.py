@@ -0,0 +1,230 @@
+"""
+Stage profiler for create-model-tree.py
+
+* Spans record the wall time of a named step, on the thread that ran it
+* Counters (subprocesses, bytes downloaded, bytes written) are added to
+  every span open on the thread, so each span's counts include the work
+  done inside it
+* Work handed to another thread can be attached to the spans that handed
+  it over, so a download counts toward the retrieve that asked for it
+* The result is written as a JSON summary per span name and per item
+  (package or executable) and as a Chrome trace that Perfetto or
+  chrome://tracing can open
+
+Nothing is recorded unless a profiler has been enabled, and the
+module-level helpers then cost one global lookup.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+counters = ("subprocesses", "bytes_downloaded", "bytes_written")
+
+_active = None
+
+
+class _Span(object):
+
+    __slots__ = ("name", "item", "args", "start", "end", "tid", "counters", "nested")
+
+    def __init__(self, name, item, args, start, tid, nested):
+        self.name = name
+        self.item = item
+        self.args = args
+        self.start = start
+        self.end = None
+        self.tid = tid
+        self.counters = {}
+        self.nested = nested
+
+
+class Profiler(object):
+    """
+    A record of spans and counters for one run
+    """
+
+    def __init__(self):
+        self._origin = time.perf_counter()
+        self._started = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._spans = []
+        self._totals = dict.fromkeys(counters, 0)
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextlib.contextmanager
+    def span(self, name, item=None, **args):
+        stack = self._stack()
+        # a span inside another for the same item adds no time to the item
+        nested = item is not None and any(s.item == item for s in stack)
+        span = _Span(name, item, args, time.perf_counter() - self._origin,
+                     threading.get_ident(), nested)
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.end = time.perf_counter() - self._origin
+            stack.remove(span)
+            with self._lock:
+                self._spans.append(span)
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self._totals[counter] = self._totals.get(counter, 0) + n
+            for span in self._stack():
+                span.counters[counter] = span.counters.get(counter, 0) + n
+
+    def context(self):
+        """
+        The spans open on this thread, to attach to work on another
+        """
+        return list(self._stack())
+
+    @contextlib.contextmanager
+    def attach(self, context):
+        """
+        Count work on this thread toward spans opened on another
+        """
+        stack = self._stack()
+        borrowed = [span for span in context if span not in stack]
+        stack[0:0] = borrowed
+        try:
+            yield
+        finally:
+            for span in borrowed:
+                stack.remove(span)
+
+    def summary(self):
+        """
+        Totals per span name and per item. Times are in seconds.
+        """
+        with self._lock:
+            spans = list(self._spans)
+            totals = dict(self._totals)
+
+        by_name = {}
+        by_item = {}
+        for span in spans:
+            duration = span.end - span.start
+            entry = by_name.setdefault(span.name, dict({'count': 0, 'total': 0.0, 'max': 0.0},
+                                                       **dict.fromkeys(counters, 0)))
+            entry['count'] += 1
+            entry['total'] += duration
+            entry['max'] = max(entry['max'], duration)
+            for (counter, n) in span.counters.items():
+                entry[counter] = entry.get(counter, 0) + n
+
+            if span.item is not None:
+                item = by_item.setdefault(span.item, {'total': 0.0, 'spans': {}})
+                span.nested or item.__setitem__('total', item['total'] + duration)
+                item['spans'][span.name] = item['spans'].get(span.name, 0.0) + duration
+
+        for entry in by_name.values():
+            entry['total'] = round(entry['total'], 6)
+            entry['max'] = round(entry['max'], 6)
+        for item in by_item.values():
+            item['total'] = round(item['total'], 6)
+            item['spans'] = {name: round(t, 6) for (name, t) in item['spans'].items()}
+
+        return {
+            'started': self._started,
+            'wall': round(time.perf_counter() - self._origin, 6),
+            'counters': totals,
+            'spans': dict(sorted(by_name.items(), key=lambda kv: -kv[1]['total'])),
+            'items': dict(sorted(by_item.items(), key=lambda kv: -kv[1]['total'])),
+        }
+
+    def trace(self):
+        """
+        The spans as Chrome trace events
+        """
+        with self._lock:
+            spans = list(self._spans)
+
+        pid = os.getpid()
+        events = []
+        for span in sorted(spans, key=lambda s: s.start):
+            args = dict(span.args, **span.counters)
+            span.item is not None and args.setdefault('item', span.item)
+            events.append({
+                'name': span.name,
+                'cat': span.name.split(".")[0],
+                'ph': "X",
+                'ts': round(span.start * 1e6, 3),
+                'dur': round((span.end - span.start) * 1e6, 3),
+                'pid': pid,
+                'tid': span.tid,
+                'args': args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': "ms"}
+
+    def write(self, prefix):
+        """
+        Write <prefix>.json and <prefix>.trace.json. Return both paths.
+        """
+        os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+        paths = (f"{prefix}.json", f"{prefix}.trace.json")
+        for (path, data) in zip(paths, (self.summary(), self.trace())):
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(data, f, indent=1)
+            os.replace(f"{path}.tmp", path)
+        return paths
+
+
+# ------------------------------------------------------------------------------
+# Module level helpers, no-ops until a profiler is enabled
+# ------------------------------------------------------------------------------
+def enable():
+    global _active
+    if _active is None:
+        _active = Profiler()
+    return _active
+
+
+def active():
+    return _active
+
+
+def span(name, item=None, **args):
+    if _active is None:
+        return contextlib.nullcontext()
+    return _active.span(name, item, **args)
+
+
+def count(counter, n=1):
+    _active is not None and _active.count(counter, n)
+
+
+def context():
+    return _active.context() if _active is not None else None
+
+
+def attach(context):
+    if _active is None or not context:
+        return contextlib.nullcontext()
+    return _active.attach(context)
+
+
+def traced(name, item=None):
+    """
+    Run a function or method in a span. item(self) names the package or
+    executable a method call is for.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            with _active.span(name, item(args[0]) if item is not None else None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+"""
+Build and query an offline index of yum repository metadata.
+
+* Read repomd.xml from a repo (a mirrored directory or a URL)
+* Stream-parse primary.xml and filelists.xml with iterparse so that memory
+  use stays bounded even for the full Fedora file lists
+* Write a compact index file: file path -> package, capability -> package,
+  package name -> package, and for each package its NEVRA, location,
+  checksum and requirements
+* Open the index with mmap and look up entries by binary search
+
+This lets create-model-tree.py resolve packages without dnf.
+
+USAGE:
+    repodata.py build --repo <dir or URL> [--repo ...] --index <file>
+    repodata.py query --index <file> [--name] <path or name>...
+"""
+
+import argparse
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+import fetch
+import rpmfile
+from nevra import evr_key
+
+REPO_NS = "{http://linux.duke.edu/metadata/repo}"
+COMMON_NS = "{http://linux.duke.edu/metadata/common}"
+RPM_NS = "{http://linux.duke.edu/metadata/rpm}"
+FILELISTS_NS = "{http://linux.duke.edu/metadata/filelists}"
+
+INDEX_MAGIC = b"RPMIDX\x00\x01"
+
+# magic, then offset and count of the packages, paths, provides and names tables
+_index_header = struct.Struct("<8s8Q")
+
+# package table: offset and length of a JSON record
+_package_record = struct.Struct("<QI")
+
+# key tables: offset and length of the key string, package number
+_key_record = struct.Struct("<QII")
+
+# Only files in these directories are indexed unless all files are asked for.
+# They are where executables and shared libraries live.
+default_path_filter = r"^(/usr)?/(lib|lib64|bin|sbin|libexec)/"
+
+# Number of keys sorted in memory at once while building the index
+sort_run_size = 500000
+
+
+class RepoError(Exception):
+    pass
+
+
+def evrcmp(pkg1, pkg2):
+    """
+    Compare the epoch, version and release of two package records
+    """
+    key1 = evr_key(pkg1.get('epoch'), pkg1['version'], pkg1['release'])
+    key2 = evr_key(pkg2.get('epoch'), pkg2['version'], pkg2['release'])
+    return (key1 > key2) - (key1 < key2)
+
+
+def nevra(pkg):
+    """
+    The package name in the form used by dnf: name-[epoch:]version-release.arch
+    """
+    epoch = f"{pkg['epoch']}:" if pkg.get('epoch') not in (None, "", "0") else ""
+    return f"{pkg['name']}-{epoch}{pkg['version']}-{pkg['release']}.{pkg['arch']}"
+
+
+# the shared library requirements rpm generates from ELF files:
+# libc.so.6, libc.so.6()(64bit), libc.so.6(GLIBC_2.34)(64bit)
+_library_capability_re = re.compile(r"^([^\s/()]+\.so(?:\.[^\s()]*)?)(\([^)]*\))?(\(64bit\))?")
+
+
+def library_capability(requirement):
+    """
+    The shared library a requirement names, as the capability its
+    package provides, without any symbol version. None if the requirement
+    is not a shared library.
+    """
+    match = _library_capability_re.match(requirement)
+    if match is None:
+        return None
+    (soname, version, bits) = match.groups()
+    return f"{soname}()(64bit)" if bits else soname
+
+
+# ------------------------------------------------------------------------------
+# Repository metadata
+# ------------------------------------------------------------------------------
+class Repository(object):
+    """
+    The metadata files of one yum repository
+    """
+
+    def __init__(self, base, name=None, workdir=None):
+        self._base = base if "://" in base else "file://" + os.path.abspath(base)
+        self._base = self._base.rstrip("/") + "/"
+        self._name = name or base.rstrip("/").split("/")[-1]
+        self._workdir = workdir
+        self._files = None
+
+    @property
+    def base(self):
+        return self._base
+
+    @property
+    def name(self):
+        return self._name
+
+    def _local(self, href):
+        """
+        Return a local path for a file in the repo, downloading it if needed
+        """
+        url = urllib.parse.urljoin(self._base, href)
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme == "file":
+            return urllib.parse.unquote(parts.path)
+
+        if self._workdir is None:
+            self._workdir = tempfile.mkdtemp(prefix="repodata-")
+        path = os.path.join(self._workdir, self._name, href.replace("/", "_"))
+        fetch.shared_pool().fetch([(url, path)])
+        return path
+
+    def files(self):
+        """
+        Return {type: (href, checksum type, checksum)} from repomd.xml
+        """
+        if self._files is None:
+            root = ET.parse(self._local("repodata/repomd.xml")).getroot()
+            self._revision = root.findtext(f"{REPO_NS}revision")
+            self._files = {}
+            for data in root.iter(f"{REPO_NS}data"):
+                location = data.find(f"{REPO_NS}location")
+                checksum = data.find(f"{REPO_NS}checksum")
+                self._files[data.get("type")] = (
+                    location.get("href"),
+                    checksum.get("type") if checksum is not None else None,
+                    checksum.text if checksum is not None else None,
+                )
+        return self._files
+
+    @property
+    def revision(self):
+        self.files()
+        return self._revision
+
+    def open(self, type):
+        """
+        Return a decompressing file object for a metadata file, checked
+        against its checksum in repomd.xml
+        """
+        files = self.files()
+        if type not in files:
+            raise RepoError(f"repo {self._name} has no {type} metadata")
+
+        (href, sum_type, sum_value) = files[type]
+        path = self._local(href)
+
+        if sum_type is not None:
+            digest = hashlib.new("sha1" if sum_type == "sha" else sum_type)
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+            if digest.hexdigest() != sum_value:
+                raise RepoError(f"{type} metadata checksum mismatch in repo {self._name}")
+
+        suffix = href.rsplit(".", 1)[-1] if href.endswith((".gz", ".xz", ".bz2", ".zst")) else ""
+        return rpmfile.decompress(open(path, "rb"), suffix)
+
+
+def _iterparse(stream, tag):
+    """
+    Yield each complete element with the given tag and free it afterwards
+    """
+    context = ET.iterparse(stream, events=("start", "end"))
+    (_, root) = next(context)
+    for (event, elem) in context:
+        if event == "end" and elem.tag == tag:
+            yield elem
+            # drop the finished element so memory use stays flat
+            elem.clear()
+            root.clear()
+
+
+def parse_primary(stream):
+    """
+    Yield a record dict and a list of file paths for each package in primary.xml
+    """
+    for elem in _iterparse(stream, f"{COMMON_NS}package"):
+        if elem.get("type") != "rpm":
+            continue
+
+        version = elem.find(f"{COMMON_NS}version")
+        checksum = elem.find(f"{COMMON_NS}checksum")
+        location = elem.find(f"{COMMON_NS}location")
+        size = elem.find(f"{COMMON_NS}size")
+        fmt = elem.find(f"{COMMON_NS}format")
+
+        provides = []
+        requires = []
+        files = []
+        if fmt is not None:
+            provides = [e.get("name") for e in fmt.iterfind(f"{RPM_NS}provides/{RPM_NS}entry")]
+            requires = [e.get("name") for e in fmt.iterfind(f"{RPM_NS}requires/{RPM_NS}entry")]
+            files = [f.text for f in fmt.iterfind(f"{COMMON_NS}file") if f.text]
+
+        record = {
+            'name': elem.findtext(f"{COMMON_NS}name"),
+            'arch': elem.findtext(f"{COMMON_NS}arch"),
+            'epoch': version.get("epoch"),
+            'version': version.get("ver"),
+            'release': version.get("rel"),
+            'summary': elem.findtext(f"{COMMON_NS}summary"),
+            'location': location.get("href"),
+            'base': location.get("{http://www.w3.org/XML/1998/namespace}base"),
+            'checksum_type': checksum.get("type") if checksum is not None else None,
+            'checksum': checksum.text if checksum is not None else None,
+            'size': int(size.get("package")) if size is not None else None,
+            'requires': sorted(set(requires)),
+        }
+        yield (record, provides, files)
+
+
+def parse_filelists(stream):
+    """
+    Yield the package id and list of file paths for each package in filelists.xml
+    """
+    for elem in _iterparse(stream, f"{FILELISTS_NS}package"):
+        files = [f.text for f in elem.iterfind(f"{FILELISTS_NS}file")
+                 if f.text and f.get("type") != "dir"]
+        yield (elem.get("pkgid"), files)
+
+
+# ------------------------------------------------------------------------------
+# Index building
+# ------------------------------------------------------------------------------
+class _KeySorter(object):
+    """
+    Sort (key, package number) pairs in bounded memory by writing sorted
+    runs to temp files and merging them.
+    """
+
+    def __init__(self, tmpdir):
+        self._tmpdir = tmpdir
+        self._buffer = []
+        self._runs = []
+
+    def add(self, key, number):
+        # keys are stored one per line
+        if "\n" in key or "\t" in key:
+            return
+        self._buffer.append(f"{key}\t{number}\n".encode("utf-8", errors="surrogateescape"))
+        len(self._buffer) >= sort_run_size and self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        self._buffer.sort()
+        (fd, path) = tempfile.mkstemp(dir=self._tmpdir, suffix=".run")
+        with os.fdopen(fd, "wb") as f:
+            f.writelines(self._buffer)
+        self._runs.append(path)
+        self._buffer = []
+
+    def sorted(self):
+        self._flush()
+        files = [open(path, "rb") for path in self._runs]
+        try:
+            previous = None
+            for line in heapq.merge(*files):
+                if line == previous:
+                    continue
+                previous = line
+                (key, number) = line[:-1].rsplit(b"\t", 1)
+                yield (key, int(number))
+        finally:
+            for f in files:
+                f.close()
+
+
+def build_index(repos, index_path, all_files=False, verbose=False):
+    """
+    Parse the metadata of a list of repositories into one index file
+    """
+    path_filter = None if all_files else re.compile(default_path_filter)
+
+    tmpdir = tempfile.mkdtemp(prefix="repoindex-", dir=os.path.dirname(os.path.abspath(index_path)))
+    try:
+        records = open(os.path.join(tmpdir, "records"), "wb")
+        package_table = []
+        paths = _KeySorter(tmpdir)
+        provides = _KeySorter(tmpdir)
+        names = _KeySorter(tmpdir)
+
+        offset = _index_header.size
+        for repo in repos:
+            verbose and print(f"reading primary metadata: {repo.name}")
+            pkgids = {}
+            with repo.open("primary") as stream:
+                for (record, capabilities, files) in parse_primary(stream):
+                    number = len(package_table)
+                    record['repo'] = repo.name
+                    record['base'] = record['base'] or repo.base
+                    data = json.dumps(record, separators=(",", ":")).encode()
+                    records.write(data)
+                    package_table.append((offset, len(data)))
+                    offset += len(data)
+
+                    pkgids[record['checksum']] = number
+                    names.add(record['name'], number)
+                    for capability in capabilities:
+                        provides.add(capability, number)
+                    for path in files:
+                        paths.add(path, number)
+
+            if "filelists" in repo.files():
+                verbose and print(f"reading file lists: {repo.name}")
+                with repo.open("filelists") as stream:
+                    for (pkgid, files) in parse_filelists(stream):
+                        number = pkgids.get(pkgid)
+                        if number is None:
+                            continue
+                        for path in files:
+                            if path_filter is None or path_filter.match(path):
+                                paths.add(path, number)
+
+        records.close()
+
+        # the keys go into the string area after the package records,
+        # then the fixed size tables follow
+        index_tmp = os.path.join(tmpdir, "index")
+        with open(index_tmp, "wb") as index:
+            index.write(b"\0" * _index_header.size)
+            with open(os.path.join(tmpdir, "records"), "rb") as f:
+                shutil.copyfileobj(f, index)
+
+            tables = []
+            for sorter in (paths, provides, names):
+                table = open(os.path.join(tmpdir, f"table-{len(tables)}"), "w+b")
+                count = 0
+                for (key, number) in sorter.sorted():
+                    table.write(_key_record.pack(index.tell(), len(key), number))
+                    index.write(key)
+                    count += 1
+                tables.append((table, count))
+
+            offsets = []
+            index.write(b"\0" * (-index.tell() % 8))
+            offsets.append((index.tell(), len(package_table)))
+            for (start, length) in package_table:
+                index.write(_package_record.pack(start, length))
+            for (table, count) in tables:
+                offsets.append((index.tell(), count))
+                table.seek(0)
+                shutil.copyfileobj(table, index)
+                table.close()
+
+            index.seek(0)
+            index.write(_index_header.pack(INDEX_MAGIC, *[v for pair in offsets for v in pair]))
+
+        os.replace(index_tmp, index_path)
+        verbose and print(f"indexed {len(package_table)} packages into {index_path}")
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+# ------------------------------------------------------------------------------
+# Index lookup
+# ------------------------------------------------------------------------------
+class RepoIndex(object):
+    """
+    A read-only, memory mapped repository index
+    """
+
+    def __init__(self, path, arch=None):
+        self._path = path
+        self._arch = arch or os.uname().machine
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        fields = _index_header.unpack_from(self._map, 0)
+        if fields[0] != INDEX_MAGIC:
+            raise RepoError(f"not a repo index: {path}")
+        (self._packages, self._paths, self._provides, self._names) = \
+            [(fields[i], fields[i + 1]) for i in (1, 3, 5, 7)]
+        self._records = {}
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return self._packages[1]
+
+    def package(self, number):
+        """
+        Return the record of a package by number
+        """
+        record = self._records.get(number)
+        if record is None:
+            (start, length) = _package_record.unpack_from(
+                self._map, self._packages[0] + number * _package_record.size)
+            record = json.loads(self._map[start:start + length])
+            record['nevra'] = nevra(record)
+            self._records[number] = record
+        return record
+
+    def _lookup(self, table, key):
+        (table_offset, count) = table
+        target = key.encode("utf-8", errors="surrogateescape")
+
+        def key_at(i):
+            (start, length, number) = _key_record.unpack_from(self._map, table_offset + i * _key_record.size)
+            return (self._map[start:start + length], number)
+
+        # lower bound binary search
+        (lo, hi) = (0, count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key_at(mid)[0] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        numbers = []
+        while lo < count:
+            (found, number) = key_at(lo)
+            if found != target:
+                break
+            numbers.append(number)
+            lo += 1
+        return numbers
+
+    def whatprovides_file(self, path):
+        return [self.package(n) for n in self._lookup(self._paths, path)]
+
+    def whatprovides(self, capability):
+        """
+        Return the packages that provide a capability or a file path
+        """
+        numbers = self._lookup(self._provides, capability)
+        # some packages also list file paths as explicit provides
+        if capability.startswith("/"):
+            numbers = self._lookup(self._paths, capability) + numbers
+        return [self.package(n) for n in dict.fromkeys(numbers)]
+
+    def by_name(self, name):
+        return [self.package(n) for n in self._lookup(self._names, name)]
+
+    def url(self, pkg):
+        return urllib.parse.urljoin(pkg['base'], pkg['location'])
+
+    def best(self, packages, arch=None):
+        """
+        Pick the latest of a list of packages built for the given arch
+        (the host arch by default), preferring it to noarch. Packages for
+        any other arch are never picked.
+        """
+        arch = arch or self._arch
+
+        def rank(pkg):
+            return 2 if pkg['arch'] == arch else 1
+
+        best = None
+        for pkg in packages:
+            if pkg['arch'] not in (arch, "noarch"):
+                continue
+            if best is None or rank(pkg) > rank(best) or \
+                    (rank(pkg) == rank(best) and evrcmp(pkg, best) > 0):
+                best = pkg
+        return best
+
+    def closure(self, pkg, arch=None):
+        """
+        Return the package and every package it requires, recursively.
+        Requirements are met for the arch the package was built for, or
+        for the given arch when the package is noarch.
+        """
+        if pkg['arch'] != "noarch":
+            arch = pkg['arch']
+        found = {pkg['nevra']: pkg}
+        queue = [pkg]
+        while queue:
+            current = queue.pop(0)
+            for requirement in current['requires']:
+                # rpmlib features and rich dependencies are not packages
+                if requirement.startswith(("rpmlib(", "(")):
+                    continue
+                provider = self.best(self.whatprovides(requirement), arch=arch)
+                if provider is not None and provider['nevra'] not in found:
+                    found[provider['nevra']] = provider
+                    queue.append(provider)
+        return list(found.values())
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="build or query an offline repo metadata index")
+    parser.add_argument('--verbose', '-v', action=argparse.BooleanOptionalAction)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build")
+    build.add_argument("--repo", dest="repos", action="append", required=True,
+                       help="repo base directory or URL, may be repeated")
+    build.add_argument("--index", required=True)
+    build.add_argument("--all-files", action=argparse.BooleanOptionalAction, default=False,
+                       help="index every file, not only binary and library directories")
+
+    query = commands.add_parser("query")
+    query.add_argument("--index", required=True)
+    query.add_argument("--name", action=argparse.BooleanOptionalAction, default=False,
+                       help="look up package names instead of files or capabilities")
+    query.add_argument("keys", nargs="+")
+
+    opts = parser.parse_args()
+
+    if opts.command == "build":
+        build_index([Repository(r) for r in opts.repos], opts.index,
+                    all_files=opts.all_files, verbose=opts.verbose)
+        sys.exit(0)
+
+    index = RepoIndex(opts.index)
+    for key in opts.keys:
+        packages = index.by_name(key) if opts.name else index.whatprovides(key)
+        for pkg in packages:
+            print(f"{key}: {pkg['nevra']} {index.url(pkg)}")
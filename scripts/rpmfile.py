@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+"""
+Read RPM package files and extract their contents without rpm2cpio or cpio
+
+* Parse the lead, the signature header and the main header
+* Stream-decompress the payload (gzip, bzip2, xz/lzma or zstd)
+* Walk the cpio (newc) archive and write all files or only a selected
+  set of paths and the targets of any symlinks among them
+
+Extraction of selected files stops reading the payload as soon as the
+last wanted file has been written.
+
+USAGE: rpmfile.py [--list] <rpm file> [<destdir> [<path>...]]
+"""
+
+import argparse
+import bz2
+import gzip
+import lzma
+import os
+import posixpath
+import shutil
+import struct
+import subprocess
+import sys
+
+import profiler
+
+# zstd is the default payload compression on Fedora. The python binding
+# is optional, without it the zstd CLI decompresses the payload.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+RPM_LEAD_MAGIC = b"\xed\xab\xee\xdb"
+RPM_LEAD_SIZE = 96
+RPM_HEADER_MAGIC = b"\x8e\xad\xe8\x01"
+
+# header tags
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_EPOCH = 1003
+RPMTAG_ARCH = 1022
+RPMTAG_FILESIZES = 1028
+RPMTAG_FILEMODES = 1030
+RPMTAG_FILEDIGESTS = 1035
+RPMTAG_FILELINKTOS = 1036
+RPMTAG_DIRINDEXES = 1116
+RPMTAG_BASENAMES = 1117
+RPMTAG_DIRNAMES = 1118
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+RPMTAG_FILEDIGESTALGO = 5011
+
+# RPMTAG_FILEDIGESTALGO values
+PGPHASHALGO_MD5 = 1
+PGPHASHALGO_SHA256 = 8
+
+# header value types
+RPM_CHAR_TYPE = 1
+RPM_INT8_TYPE = 2
+RPM_INT16_TYPE = 3
+RPM_INT32_TYPE = 4
+RPM_INT64_TYPE = 5
+RPM_STRING_TYPE = 6
+RPM_BIN_TYPE = 7
+RPM_STRING_ARRAY_TYPE = 8
+RPM_I18NSTRING_TYPE = 9
+
+_int_formats = {
+    RPM_CHAR_TYPE: "B",
+    RPM_INT8_TYPE: "B",
+    RPM_INT16_TYPE: "H",
+    RPM_INT32_TYPE: "I",
+    RPM_INT64_TYPE: "Q",
+}
+
+CPIO_NEWC_MAGIC = (b"070701", b"070702")
+CPIO_HEADER_SIZE = 110
+CPIO_TRAILER = "TRAILER!!!"
+
+chunk_size = 1024 * 1024
+
+
+class RpmError(Exception):
+    pass
+
+
+class RpmHeader(object):
+    """
+    An RPM header structure: an index of tagged entries and a data store.
+    Values are decoded when they are asked for.
+    """
+
+    def __init__(self, index, store):
+        self._index = index
+        self._store = store
+
+    @staticmethod
+    def read(f, pad=False):
+        intro = f.read(16)
+        if len(intro) != 16 or intro[0:4] != RPM_HEADER_MAGIC:
+            raise RpmError("bad RPM header magic")
+        (nindex, hsize) = struct.unpack(">II", intro[8:16])
+
+        raw = f.read(nindex * 16)
+        index = {}
+        for i in range(nindex):
+            (tag, type, offset, count) = struct.unpack_from(">IIII", raw, i * 16)
+            index[tag] = (type, offset, count)
+
+        store = f.read(hsize)
+        if len(store) != hsize:
+            raise RpmError("truncated RPM header")
+
+        # the signature header is padded to a multiple of 8 bytes
+        if pad and hsize % 8:
+            f.read(8 - hsize % 8)
+
+        return RpmHeader(index, store)
+
+    def __contains__(self, tag):
+        return tag in self._index
+
+    def get(self, tag, default=None):
+        if tag not in self._index:
+            return default
+
+        (type, offset, count) = self._index[tag]
+        if type in _int_formats:
+            values = struct.unpack_from(f">{count}{_int_formats[type]}", self._store, offset)
+            return list(values)
+        if type == RPM_BIN_TYPE:
+            return self._store[offset:offset + count]
+        if type in (RPM_STRING_TYPE, RPM_STRING_ARRAY_TYPE, RPM_I18NSTRING_TYPE):
+            strings = []
+            pos = offset
+            for _ in range(count if type != RPM_STRING_TYPE else 1):
+                end = self._store.index(b"\0", pos)
+                strings.append(self._store[pos:end].decode("utf-8", errors="surrogateescape"))
+                pos = end + 1
+            return strings[0] if type == RPM_STRING_TYPE else strings
+        raise RpmError(f"unsupported header type {type} for tag {tag}")
+
+
+class CpioEntry(object):
+    """
+    A single member of a cpio newc archive
+    """
+
+    def __init__(self, name, ino, mode, mtime, nlink, size):
+        self.name = name
+        self.ino = ino
+        self.mode = mode
+        self.mtime = mtime
+        self.nlink = nlink
+        self.size = size
+        self.linkname = None
+
+
+class RpmFile(object):
+    """
+    An RPM package file on disk
+    """
+
+    def __init__(self, path):
+        self._path = path
+        with open(path, "rb") as f:
+            lead = f.read(RPM_LEAD_SIZE)
+            if len(lead) != RPM_LEAD_SIZE or lead[0:4] != RPM_LEAD_MAGIC:
+                raise RpmError(f"not an RPM file: {path}")
+            self._signature = RpmHeader.read(f, pad=True)
+            self._header = RpmHeader.read(f)
+            self._payload_offset = f.tell()
+        self._files = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def header(self):
+        return self._header
+
+    @property
+    def signature(self):
+        return self._signature
+
+    @property
+    def name(self):
+        return self._header.get(RPMTAG_NAME)
+
+    @property
+    def version(self):
+        return self._header.get(RPMTAG_VERSION)
+
+    @property
+    def release(self):
+        return self._header.get(RPMTAG_RELEASE)
+
+    @property
+    def epoch(self):
+        epoch = self._header.get(RPMTAG_EPOCH)
+        return epoch[0] if epoch else None
+
+    @property
+    def arch(self):
+        return self._header.get(RPMTAG_ARCH)
+
+    @property
+    def compressor(self):
+        return self._header.get(RPMTAG_PAYLOADCOMPRESSOR, "gzip")
+
+    @property
+    def files(self):
+        """
+        A dict of every file path in the package: (mode, symlink target)
+        """
+        if self._files is None:
+            basenames = self._header.get(RPMTAG_BASENAMES, [])
+            dirnames = self._header.get(RPMTAG_DIRNAMES, [])
+            dirindexes = self._header.get(RPMTAG_DIRINDEXES, [])
+            modes = self._header.get(RPMTAG_FILEMODES, [0] * len(basenames))
+            links = self._header.get(RPMTAG_FILELINKTOS, [""] * len(basenames))
+            self._files = {
+                dirnames[d] + b: (m, l or None)
+                for (b, d, m, l) in zip(basenames, dirindexes, modes, links)
+            }
+        return self._files
+
+    @property
+    def digests(self):
+        """
+        A dict of the sha256 of each regular file, empty if the package
+        uses another digest algorithm
+        """
+        algo = self._header.get(RPMTAG_FILEDIGESTALGO, [PGPHASHALGO_MD5])[0]
+        if algo != PGPHASHALGO_SHA256:
+            return {}
+        basenames = self._header.get(RPMTAG_BASENAMES, [])
+        dirnames = self._header.get(RPMTAG_DIRNAMES, [])
+        dirindexes = self._header.get(RPMTAG_DIRINDEXES, [])
+        digests = self._header.get(RPMTAG_FILEDIGESTS, [""] * len(basenames))
+        return {
+            dirnames[d] + b: (digest or None)
+            for (b, d, digest) in zip(basenames, dirindexes, digests)
+        }
+
+    def closure(self, paths):
+        """
+        Return the set of package paths needed to place the given paths:
+        the paths themselves and every symlink target along the way.
+        A path that is not in the package but is with a /usr prefix is
+        taken from /usr.
+        """
+        files = self.files
+        wanted = set()
+        pending = list(paths)
+        while pending:
+            path = posixpath.normpath(pending.pop())
+            if path not in files and "/usr" + path in files:
+                path = "/usr" + path
+            if path in wanted or path not in files:
+                continue
+            wanted.add(path)
+
+            # leading directories may be symlinks too
+            head = path
+            while head != "/":
+                head = posixpath.dirname(head)
+                if head in files and files[head][1] is not None:
+                    pending.append(head)
+
+            link = files[path][1]
+            if link is not None:
+                pending.append(posixpath.join(posixpath.dirname(path), link))
+
+        return wanted
+
+    def payload(self):
+        """
+        Return a file object reading the decompressed cpio payload
+        """
+        f = open(self._path, "rb")
+        f.seek(self._payload_offset)
+        try:
+            return decompress(f, self.compressor)
+        except RpmError:
+            f.close()
+            raise
+
+    def entries(self, stream):
+        """
+        Iterate the members of the cpio payload. The caller must read or
+        skip the data of each member, with its padding, before moving on.
+        """
+        while True:
+            header = _read_exact(stream, CPIO_HEADER_SIZE)
+            if header[0:6] not in CPIO_NEWC_MAGIC:
+                raise RpmError(f"bad cpio header in payload: {self._path}")
+
+            fields = [int(header[i:i + 8], 16) for i in range(6, CPIO_HEADER_SIZE, 8)]
+            (ino, mode, _, _, nlink, mtime, size, _, _, _, _, namesize, _) = fields
+
+            name = _read_exact(stream, namesize)[:-1].decode("utf-8", errors="surrogateescape")
+            _read_exact(stream, _pad4(CPIO_HEADER_SIZE + namesize))
+
+            if name == CPIO_TRAILER:
+                return
+
+            # rpm archives store names as ./usr/...
+            if name.startswith("./"):
+                name = name[1:]
+            elif not name.startswith("/"):
+                name = "/" + name
+            yield CpioEntry(posixpath.normpath(name), ino, mode, mtime, nlink, size)
+
+    def extract(self, destdir, paths=None, store=None):
+        """
+        Write the package files into destdir. If paths is given, only those
+        files and their symlink targets are written.
+        With a content store, file data is written to the store and
+        placed from there.
+        Return the list of package paths that were written.
+        """
+        wanted = None if paths is None else self.closure(paths)
+        if wanted is not None and len(wanted) == 0:
+            return []
+
+        written = []
+        remaining = set(wanted) if wanted is not None else None
+        # hard link sets carry the data on the last member only
+        hardlinks = {}
+
+        with self.payload() as stream:
+            for entry in self.entries(stream):
+                take = wanted is None or entry.name in wanted
+                fmt = entry.mode & 0o170000
+
+                if fmt == 0o100000 and entry.nlink > 1 and entry.size == 0:
+                    take and hardlinks.setdefault(entry.ino, []).append(entry.name)
+                    _skip(stream, 0)
+                    continue
+
+                targets = hardlinks.pop(entry.ino, []) if fmt == 0o100000 and entry.nlink > 1 else []
+                if take:
+                    targets.insert(0, entry.name)
+
+                if not targets:
+                    _skip(stream, entry.size)
+                    continue
+
+                local = local_path(destdir, targets[0], follow=(fmt == 0o040000))
+                os.makedirs(os.path.dirname(local), exist_ok=True)
+
+                if fmt == 0o040000:
+                    os.makedirs(local, exist_ok=True)
+                    # keep the tree writable so later members can be placed
+                    os.chmod(local, entry.mode & 0o7777 | 0o700)
+                    _skip(stream, entry.size)
+                elif fmt == 0o120000:
+                    entry.linkname = _read_exact(stream, entry.size).decode("utf-8", errors="surrogateescape")
+                    _read_exact(stream, _pad4(entry.size))
+                    _remove(local)
+                    os.symlink(entry.linkname, local)
+                elif fmt == 0o100000 and store is not None:
+                    with store.writer() as output:
+                        _copy(stream, output, entry.size)
+                        digest = output.commit(entry.mode & 0o7777, entry.mtime)
+                    for name in targets:
+                        store.place(digest, entry.mode & 0o7777, local_path(destdir, name))
+                elif fmt == 0o100000:
+                    _remove(local)
+                    with open(local, "wb") as output:
+                        _copy(stream, output, entry.size)
+                    os.chmod(local, entry.mode & 0o7777)
+                    os.utime(local, (entry.mtime, entry.mtime))
+                    for other in targets[1:]:
+                        other_local = local_path(destdir, other)
+                        os.makedirs(os.path.dirname(other_local), exist_ok=True)
+                        _remove(other_local)
+                        try:
+                            os.link(local, other_local)
+                        except OSError:
+                            shutil.copy2(local, other_local)
+                else:
+                    # device nodes and fifos are not placed in model trees
+                    _skip(stream, entry.size)
+                    continue
+
+                written.extend(targets)
+                if remaining is not None:
+                    remaining.difference_update(targets)
+                    if not remaining:
+                        break
+
+        # hard linked empty files never get a member with data
+        for names in hardlinks.values():
+            for name in names:
+                local = local_path(destdir, name)
+                os.makedirs(os.path.dirname(local), exist_ok=True)
+                open(local, "wb").close()
+                written.append(name)
+
+        return written
+
+
+def decompress(f, compressor):
+    """
+    Wrap a binary file object with a streaming decompressor.
+    compressor is an RPM payload compressor name or a file suffix.
+    Closing the result closes f as well.
+    """
+    if compressor in ("gzip", "gz"):
+        return _ClosingReader(gzip.GzipFile(fileobj=f), f)
+    if compressor in ("xz", "lzma"):
+        return _ClosingReader(lzma.LZMAFile(f), f)
+    if compressor in ("bzip2", "bz2"):
+        return _ClosingReader(bz2.BZ2File(f), f)
+    if compressor in ("zstd", "zst"):
+        if zstandard is not None:
+            return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+        return _PipeReader(["zstd", "-dc"], f)
+    if compressor in ("identity", "none", ""):
+        return f
+
+    raise RpmError(f"unsupported compression: {compressor}")
+
+
+class _ClosingReader(object):
+    """
+    Read from a decompressor and close the file under it with it
+    """
+
+    def __init__(self, reader, source):
+        self._reader = reader
+        self._source = source
+        self.read = reader.read
+
+    def close(self):
+        try:
+            self._reader.close()
+        finally:
+            self._source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _PipeReader(object):
+    """
+    Read the output of a filter command fed from a file object
+    """
+
+    def __init__(self, command, source):
+        self._source = source
+        profiler.count("subprocesses")
+        self._process = subprocess.Popen(command, stdin=source, stdout=subprocess.PIPE)
+
+    def read(self, size=-1):
+        return self._process.stdout.read(size)
+
+    def close(self):
+        self._process.stdout.close()
+        self._process.kill()
+        self._process.wait()
+        self._source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _pad4(size):
+    return (4 - size % 4) % 4
+
+
+def _read_exact(stream, size):
+    data = b""
+    while len(data) < size:
+        block = stream.read(size - len(data))
+        if not block:
+            raise RpmError("truncated cpio payload")
+        data += block
+    return data
+
+
+def _copy(stream, output, size):
+    remaining = size
+    while remaining > 0:
+        block = stream.read(min(chunk_size, remaining))
+        if not block:
+            raise RpmError("truncated cpio payload")
+        output.write(block)
+        profiler.count("bytes_written", len(block))
+        remaining -= len(block)
+    _read_exact(stream, _pad4(size))
+
+
+def _skip(stream, size):
+    remaining = size + _pad4(size)
+    while remaining > 0:
+        block = stream.read(min(chunk_size, remaining))
+        if not block:
+            raise RpmError("truncated cpio payload")
+        remaining -= len(block)
+
+
+def _remove(path):
+    if os.path.lexists(path) and not os.path.isdir(path) or os.path.islink(path):
+        os.unlink(path)
+
+
+def local_path(destdir, path, follow=False):
+    """
+    Map a package path into destdir. Symlinks already in destdir must not
+    lead the path out of it; with follow that includes the last component,
+    for directories that are written through.
+    """
+    local = destdir.rstrip("/") + posixpath.normpath("/" + path)
+    root = os.path.realpath(destdir)
+    real = os.path.realpath(local if follow else os.path.dirname(local))
+    if real != root and not real.startswith(root + "/"):
+        raise RpmError(f"unsafe path in payload: {path} leads to {real}")
+    return local
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="list or extract the files of an RPM")
+    parser.add_argument("--list", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("rpm")
+    parser.add_argument("destdir", nargs="?")
+    parser.add_argument("paths", nargs="*")
+    opts = parser.parse_args()
+
+    rpm = RpmFile(opts.rpm)
+    if opts.list or opts.destdir is None:
+        for (path, (mode, link)) in sorted(rpm.files.items()):
+            print(path if link is None else f"{path} -> {link}")
+        sys.exit(0)
+
+    for path in rpm.extract(opts.destdir, opts.paths or None):
+        print(path)
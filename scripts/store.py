@@ -0,0 +1,276 @@
+"""
+Content addressed store of package files for create-model-tree.py
+
+* RPMs are kept by their sha256 and checked against the repo checksum
+* Extracted files are kept by the sha256 of their content and mode
+* Files are placed into model trees as hard links or reflinks, falling
+  back to a copy across file systems
+
+RPM headers carry the sha256 of every file in the package, so a file that
+is already in the store is placed without reading the RPM payload at all.
+
+Placed files share their data with the store. Anything that changes a file
+in a model tree must write a new file and rename it into place rather than
+modify it.
+"""
+
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+import profiler
+import rpmfile
+
+# ioctl request number to clone a file's extents (linux/fs.h)
+FICLONE = 0x40049409
+
+placements = ("auto", "link", "reflink", "copy")
+
+
+class StoreError(Exception):
+    pass
+
+
+def file_digest(path, algorithm="sha256"):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _ObjectWriter(object):
+    """
+    A file being written into the store. The digest is computed as the
+    data is written and the file is renamed to its object path on commit.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        (fd, self._tmp_path) = tempfile.mkstemp(dir=store.tmp_dir)
+        self._file = os.fdopen(fd, "wb")
+        self._digest = hashlib.sha256()
+
+    def write(self, data):
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self._file.close()
+        if exc_type is not None and os.path.exists(self._tmp_path):
+            os.unlink(self._tmp_path)
+
+    def commit(self, mode, mtime=None):
+        self._file.close()
+        digest = self._digest.hexdigest()
+        path = self._store.object_path(digest, mode)
+        if os.path.exists(path):
+            os.unlink(self._tmp_path)
+        else:
+            os.chmod(self._tmp_path, mode)
+            mtime is not None and os.utime(self._tmp_path, (mtime, mtime))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self._tmp_path, path)
+        return digest
+
+
+class ContentStore(object):
+    """
+    A directory of files named by their content hash:
+
+    <root>/objects/<aa>/<sha256>-<mode>   extracted files
+    <root>/rpms/<sha256>.rpm              package files
+    <root>/tmp/                           files being written
+    """
+
+    def __init__(self, root, placement="auto", verbose=False):
+        if placement not in placements:
+            raise StoreError(f"unknown placement method: {placement}")
+        self._root = root
+        self._placement = placement
+        self._verbose = verbose
+        self._rpm_digests = {}
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "rpms"), exist_ok=True)
+
+    @property
+    def root(self):
+        return self._root
+
+    def object_path(self, digest, mode):
+        return os.path.join(self._root, "objects", digest[:2], f"{digest}-{mode:04o}")
+
+    def rpm_path(self, digest):
+        return os.path.join(self._root, "rpms", f"{digest}.rpm")
+
+    def writer(self):
+        return _ObjectWriter(self)
+
+    def has(self, digest, mode):
+        return os.path.exists(self.object_path(digest, mode))
+
+    # --------------------------------------------------------------
+    # RPM files
+    # --------------------------------------------------------------
+    def find_rpm(self, checksum_type, checksum):
+        """
+        Return the stored RPM with a repo checksum, or None
+        """
+        if checksum_type != "sha256" or checksum is None:
+            return None
+        path = self.rpm_path(checksum)
+        return path if os.path.exists(path) else None
+
+    def add_rpm(self, path, checksum_type=None, checksum=None, verified=False):
+        """
+        Check a downloaded RPM against its repo checksum and keep it.
+        verified skips the check for a file the download already checked.
+        Return its sha256.
+        """
+        if checksum is not None and not verified:
+            actual = file_digest(path, "sha1" if checksum_type == "sha" else checksum_type)
+            if actual != checksum:
+                raise StoreError(f"checksum mismatch for {path}: {actual} != {checksum}")
+
+        digest = checksum if checksum_type == "sha256" and checksum is not None else file_digest(path)
+        stored = self.rpm_path(digest)
+        if not os.path.exists(stored):
+            # linked or copied aside first, so no build sees part of it
+            tmp_path = os.path.join(self.tmp_dir, f"{digest}.{os.getpid()}.{threading.get_ident()}.rpm")
+            os.path.lexists(tmp_path) and os.unlink(tmp_path)
+            self._link_or_copy(path, tmp_path)
+            os.replace(tmp_path, stored)
+        return digest
+
+    def link_rpm(self, checksum_type, checksum, path):
+        """
+        Place a stored RPM at path. Return False if it is not in the store.
+        """
+        stored = self.find_rpm(checksum_type, checksum)
+        if stored is None:
+            return False
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        try:
+            self._link_or_copy(stored, path)
+        except FileExistsError:
+            # placed by another build at the same time
+            pass
+        return True
+
+    # --------------------------------------------------------------
+    # Files
+    # --------------------------------------------------------------
+    def add_file(self, path):
+        """
+        Copy a file into the store. Return (digest, mode).
+        """
+        st = os.stat(path)
+        mode = st.st_mode & 0o7777
+        with self.writer() as w:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, w, 1024 * 1024)
+            profiler.count("bytes_written", st.st_size)
+            digest = w.commit(mode, st.st_mtime)
+        return (digest, mode)
+
+    def place(self, digest, mode, dst):
+        """
+        Put a stored file at dst
+        """
+        src = self.object_path(digest, mode)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        self._link_or_copy(src, dst)
+
+    def _link_or_copy(self, src, dst):
+        methods = {
+            "auto": (self._hardlink, self._reflink, self._copy),
+            "link": (self._hardlink, self._copy),
+            "reflink": (self._reflink, self._copy),
+            "copy": (self._copy,),
+        }[self._placement]
+
+        for method in methods:
+            if method(src, dst):
+                return
+
+    @staticmethod
+    def _hardlink(src, dst):
+        try:
+            os.link(src, dst)
+            return True
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                return False
+            raise
+
+    @staticmethod
+    def _reflink(src, dst):
+        with open(src, "rb") as s:
+            with open(dst, "wb") as d:
+                try:
+                    fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                except OSError:
+                    cloned = False
+                else:
+                    cloned = True
+        if not cloned:
+            os.unlink(dst)
+            return False
+        shutil.copystat(src, dst)
+        return True
+
+    @staticmethod
+    def _copy(src, dst):
+        shutil.copy2(src, dst)
+        profiler.count("bytes_written", os.path.getsize(dst))
+        return True
+
+    # --------------------------------------------------------------
+    # Package extraction
+    # --------------------------------------------------------------
+    def extract(self, rpm_path, destdir, paths):
+        """
+        Place files from an RPM into destdir through the store.
+        Files whose content is already stored are placed without reading
+        the payload. Return the package paths that were placed.
+        """
+        rpm = rpmfile.RpmFile(rpm_path)
+        wanted = rpm.closure(paths)
+        files = rpm.files
+        digests = rpm.digests
+
+        placed = []
+        missing = []
+        for path in sorted(wanted):
+            (mode, link) = files[path]
+            local = rpmfile.local_path(destdir, path, follow=(link is None and mode & 0o170000 == 0o040000))
+            if link is not None:
+                os.makedirs(os.path.dirname(local), exist_ok=True)
+                os.path.lexists(local) and os.unlink(local)
+                os.symlink(link, local)
+                placed.append(path)
+            elif mode & 0o170000 == 0o040000:
+                os.makedirs(local, exist_ok=True)
+                placed.append(path)
+            elif digests.get(path) is not None and self.has(digests[path], mode & 0o7777):
+                self.place(digests[path], mode & 0o7777, local)
+                placed.append(path)
+            else:
+                missing.append(path)
+
+        if missing:
+            self._verbose and print(f"extracting into store from {rpm_path}: {missing}")
+            placed.extend(rpm.extract(destdir, missing, store=self))
+
+        return placed
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""
+Generate a synthetic yum repository for benchmarks of create-model-tree.py
+
+* Stub ELF shared objects with DT_SONAME and a chosen set of DT_NEEDED
+  entries, and a stub daemon executable with PT_INTERP
+* RPM files (lead, signature and main header, gzip cpio payload) with the
+  file names, modes, link targets and sha256 digests rpmfile.py reads
+* primary.xml, filelists.xml and repomd.xml with provides and requires
+
+The library graph is layered: the daemon needs every library in the
+first layer and each library needs `fanout` libraries of the next layer,
+so every library is reachable and the depth of the graph is fixed.
+
+USAGE:
+    synthrepo.py [--libraries N] [--fanout K] [--depth D] [--arch ARCH] <repo dir>
+"""
+
+import argparse
+import gzip
+import hashlib
+import os
+import random
+import struct
+import xml.etree.ElementTree as ET
+
+# e_machine and loader of the generated ELF files of each arch, and
+# their library directory
+EM_X86_64 = 62
+EM_AARCH64 = 183
+machines = {
+    'x86_64': (EM_X86_64, "/lib64/ld-linux-x86-64.so.2"),
+    'aarch64': (EM_AARCH64, "/lib/ld-linux-aarch64.so.1"),
+}
+loader = machines['x86_64'][1]
+libdir = "/usr/lib64"
+
+# RPM header tags and types written by rpm_header()
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_SUMMARY = 1004
+RPMTAG_ARCH = 1022
+RPMTAG_FILESIZES = 1028
+RPMTAG_FILEMODES = 1030
+RPMTAG_FILEDIGESTS = 1035
+RPMTAG_FILELINKTOS = 1036
+RPMTAG_DIRINDEXES = 1116
+RPMTAG_BASENAMES = 1117
+RPMTAG_DIRNAMES = 1118
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+RPMTAG_FILEDIGESTALGO = 5011
+
+RPM_INT16 = 3
+RPM_INT32 = 4
+RPM_STRING = 6
+RPM_STRING_ARRAY = 8
+
+PGPHASHALGO_SHA256 = 8
+
+# cpio mtime of every file, so that generated repos are reproducible
+mtime = 1700000000
+
+REPO_NS = "http://linux.duke.edu/metadata/repo"
+COMMON_NS = "http://linux.duke.edu/metadata/common"
+RPM_NS = "http://linux.duke.edu/metadata/rpm"
+FILELISTS_NS = "http://linux.duke.edu/metadata/filelists"
+
+
+# ------------------------------------------------------------------------------
+# ELF
+# ------------------------------------------------------------------------------
+def stub_elf(needed=(), soname=None, interp=None, padding=0, runpath=None, machine=EM_X86_64):
+    """
+    A little endian 64 bit ET_DYN file, x86_64 unless machine is given, with one PT_LOAD covering the
+    whole file, a PT_DYNAMIC and, if interp is given, a PT_INTERP.
+    padding adds that many zero bytes to reach a realistic file size.
+    """
+    strtab = b"\0"
+    offsets = {}
+    for name in [soname, interp, runpath] + list(needed):
+        if name is not None and name not in offsets:
+            offsets[name] = len(strtab)
+            strtab += name.encode() + b"\0"
+
+    dynamic = [(1, offsets[name]) for name in needed]
+    soname is not None and dynamic.append((14, offsets[soname]))
+    runpath is not None and dynamic.append((29, offsets[runpath]))
+    phnum = 3 if interp is not None else 2
+
+    strtab_offset = 64 + phnum * 56
+    dynamic_offset = strtab_offset + len(strtab) + (8 - len(strtab) % 8) % 8
+    dynamic += [(5, strtab_offset), (10, len(strtab)), (0, 0)]
+    dynamic_size = len(dynamic) * 16
+    size = dynamic_offset + dynamic_size + padding
+
+    header = b"\x7fELF" + bytes([2, 1, 1, 0]) + b"\0" * 8
+    header += struct.pack("<HHIQQQIHHHHHH", 3, machine, 1, 0, 64, 0, 0, 64, 56, phnum, 64, 0, 0)
+
+    phdrs = struct.pack("<IIQQQQQQ", 1, 5, 0, 0, 0, size, size, 0x1000)
+    phdrs += struct.pack("<IIQQQQQQ", 2, 6, dynamic_offset, dynamic_offset, dynamic_offset,
+                         dynamic_size, dynamic_size, 8)
+    if interp is not None:
+        offset = strtab_offset + offsets[interp]
+        phdrs += struct.pack("<IIQQQQQQ", 3, 4, offset, offset, offset, len(interp) + 1, len(interp) + 1, 1)
+
+    data = header + phdrs + strtab
+    data += b"\0" * (dynamic_offset - len(data))
+    data += b"".join(struct.pack("<qQ", tag, value) for (tag, value) in dynamic)
+    return data + b"\0" * padding
+
+
+# ------------------------------------------------------------------------------
+# RPM
+# ------------------------------------------------------------------------------
+def rpm_header(entries):
+    """
+    An RPM header structure from a list of (tag, type, value)
+    """
+    index = b""
+    store = b""
+    for (tag, kind, value) in sorted(entries):
+        if kind == RPM_STRING:
+            data = value.encode() + b"\0"
+            count = 1
+        elif kind == RPM_STRING_ARRAY:
+            data = b"".join(v.encode() + b"\0" for v in value)
+            count = len(value)
+        elif kind == RPM_INT32:
+            store += b"\0" * ((4 - len(store) % 4) % 4)
+            data = struct.pack(f">{len(value)}I", *value)
+            count = len(value)
+        elif kind == RPM_INT16:
+            store += b"\0" * ((2 - len(store) % 2) % 2)
+            data = struct.pack(f">{len(value)}H", *value)
+            count = len(value)
+        else:
+            raise ValueError(f"unsupported header type {kind}")
+        index += struct.pack(">IIII", tag, kind, len(store), count)
+        store += data
+    return b"\x8e\xad\xe8\x01\0\0\0\0" + struct.pack(">II", len(entries), len(store)) + index + store
+
+
+def cpio_archive(files):
+    """
+    A newc cpio archive of (path, mode, data) entries
+    """
+    out = []
+    for (ino, (path, mode, data)) in enumerate(list(files) + [("TRAILER!!!", 0, b"")], 1):
+        name = (path if path == "TRAILER!!!" else "." + path).encode() + b"\0"
+        fields = [ino, mode, 0, 0, 1, mtime, len(data), 0, 0, 0, 0, len(name), 0]
+        head = b"070701" + b"".join(b"%08x" % v for v in fields) + name
+        out.append(head + b"\0" * ((4 - len(head) % 4) % 4))
+        out.append(data + b"\0" * ((4 - len(data) % 4) % 4))
+    return b"".join(out)
+
+
+def write_rpm(path, name, version, release, arch, files, summary=""):
+    """
+    Write an RPM. files is a list of (path, mode, content) where content
+    is the data of a regular file or the target of a symlink.
+    """
+    files = [(p, m, c.encode() if isinstance(c, str) else c) for (p, m, c) in files]
+    dirnames = sorted({os.path.dirname(p) + "/" for (p, m, c) in files})
+    regular = [m & 0o170000 == 0o100000 for (p, m, c) in files]
+
+    entries = [
+        (RPMTAG_NAME, RPM_STRING, name),
+        (RPMTAG_VERSION, RPM_STRING, version),
+        (RPMTAG_RELEASE, RPM_STRING, release),
+        (RPMTAG_SUMMARY, RPM_STRING, summary or name),
+        (RPMTAG_ARCH, RPM_STRING, arch),
+        (RPMTAG_FILESIZES, RPM_INT32, [len(c) if r else 0 for ((p, m, c), r) in zip(files, regular)]),
+        (RPMTAG_FILEMODES, RPM_INT16, [m for (p, m, c) in files]),
+        (RPMTAG_FILEDIGESTS, RPM_STRING_ARRAY,
+         [hashlib.sha256(c).hexdigest() if r else "" for ((p, m, c), r) in zip(files, regular)]),
+        (RPMTAG_FILELINKTOS, RPM_STRING_ARRAY,
+         [c.decode() if m & 0o170000 == 0o120000 else "" for (p, m, c) in files]),
+        (RPMTAG_DIRINDEXES, RPM_INT32, [dirnames.index(os.path.dirname(p) + "/") for (p, m, c) in files]),
+        (RPMTAG_BASENAMES, RPM_STRING_ARRAY, [os.path.basename(p) for (p, m, c) in files]),
+        (RPMTAG_DIRNAMES, RPM_STRING_ARRAY, dirnames),
+        (RPMTAG_PAYLOADFORMAT, RPM_STRING, "cpio"),
+        (RPMTAG_PAYLOADCOMPRESSOR, RPM_STRING, "gzip"),
+        (RPMTAG_FILEDIGESTALGO, RPM_INT32, [PGPHASHALGO_SHA256]),
+    ]
+
+    lead = b"\xed\xab\xee\xdb\x03\x00" + struct.pack(">HH", 0, 1)
+    lead += name.encode()[:65].ljust(66, b"\0") + struct.pack(">HH", 1, 5) + b"\0" * 16
+    payload = gzip.compress(cpio_archive(files), compresslevel=1, mtime=0)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(lead + rpm_header([]) + rpm_header(entries) + payload)
+
+
+# ------------------------------------------------------------------------------
+# Repository metadata
+# ------------------------------------------------------------------------------
+def _write_xml(path, root):
+    data = gzip.compress(ET.tostring(root, xml_declaration=True, encoding="utf-8"), mtime=0)
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_repo(repo_dir, packages):
+    """
+    Write the RPMs and repodata for a list of packages. Each package is
+    a dict of name, version, release, arch, files and lists of provides
+    and requires.
+    """
+    ET.register_namespace("", COMMON_NS)
+    ET.register_namespace("rpm", RPM_NS)
+
+    primary = ET.Element(f"{{{COMMON_NS}}}metadata", packages=str(len(packages)))
+    filelists = ET.Element(f"{{{FILELISTS_NS}}}filelists", packages=str(len(packages)))
+
+    for pkg in packages:
+        filename = f"{pkg['name']}-{pkg['version']}-{pkg['release']}.{pkg['arch']}.rpm"
+        location = f"Packages/{filename}"
+        path = os.path.join(repo_dir, location)
+        write_rpm(path, pkg['name'], pkg['version'], pkg['release'], pkg['arch'], pkg['files'],
+                  summary=pkg.get('summary', ""))
+        with open(path, "rb") as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+
+        entry = ET.SubElement(primary, f"{{{COMMON_NS}}}package", type="rpm")
+        ET.SubElement(entry, f"{{{COMMON_NS}}}name").text = pkg['name']
+        ET.SubElement(entry, f"{{{COMMON_NS}}}arch").text = pkg['arch']
+        ET.SubElement(entry, f"{{{COMMON_NS}}}version", epoch="0", ver=pkg['version'], rel=pkg['release'])
+        ET.SubElement(entry, f"{{{COMMON_NS}}}checksum", type="sha256", pkgid="YES").text = checksum
+        ET.SubElement(entry, f"{{{COMMON_NS}}}summary").text = pkg.get('summary') or pkg['name']
+        ET.SubElement(entry, f"{{{COMMON_NS}}}size", package=str(os.path.getsize(path)))
+        ET.SubElement(entry, f"{{{COMMON_NS}}}location", href=location)
+        form = ET.SubElement(entry, f"{{{COMMON_NS}}}format")
+        for (kind, names) in (("provides", pkg.get('provides', [])), ("requires", pkg.get('requires', []))):
+            element = ET.SubElement(form, f"{{{RPM_NS}}}{kind}")
+            for name in names:
+                ET.SubElement(element, f"{{{RPM_NS}}}entry", name=name)
+
+        files = ET.SubElement(filelists, f"{{{FILELISTS_NS}}}package", pkgid=checksum,
+                              name=pkg['name'], arch=pkg['arch'])
+        ET.SubElement(files, f"{{{FILELISTS_NS}}}version", epoch="0", ver=pkg['version'], rel=pkg['release'])
+        for (file_path, mode, content) in pkg['files']:
+            ET.SubElement(files, f"{{{FILELISTS_NS}}}file").text = file_path
+
+    os.makedirs(os.path.join(repo_dir, "repodata"), exist_ok=True)
+    repomd = ET.Element(f"{{{REPO_NS}}}repomd")
+    ET.SubElement(repomd, f"{{{REPO_NS}}}revision").text = str(mtime)
+    for (kind, root) in (("primary", primary), ("filelists", filelists)):
+        location = f"repodata/{kind}.xml.gz"
+        checksum = _write_xml(os.path.join(repo_dir, location), root)
+        data = ET.SubElement(repomd, f"{{{REPO_NS}}}data", type=kind)
+        ET.SubElement(data, f"{{{REPO_NS}}}checksum", type="sha256").text = checksum
+        ET.SubElement(data, f"{{{REPO_NS}}}location", href=location)
+
+    ET.register_namespace("", REPO_NS)
+    with open(os.path.join(repo_dir, "repodata", "repomd.xml"), "wb") as f:
+        f.write(ET.tostring(repomd, xml_declaration=True, encoding="utf-8"))
+
+
+# ------------------------------------------------------------------------------
+# Library graph
+# ------------------------------------------------------------------------------
+def _soname(n):
+    return f"libbench{n}.so.1"
+
+
+def _arch_packages(arch, libraries, needs, first_layer, padding, legacy):
+    """
+    The loader, library and daemon packages of one arch
+    """
+    (machine, loader) = machines[arch]
+    packages = [{
+        'name': "bench-loader", 'version': "1.0", 'release': "1.bench", 'arch': arch,
+        'files': [("/usr" + loader, 0o100755, stub_elf(soname=os.path.basename(loader), machine=machine))],
+        'provides': [os.path.basename(loader) + "()(64bit)"],
+    }]
+
+    for n in range(libraries):
+        needed = [_soname(m) for m in sorted(needs[n])]
+        elf = stub_elf(needed, _soname(n), padding=padding, machine=machine)
+        directory = libdir.replace("/usr", "", 1) if n < legacy else libdir
+        packages.append({
+            'name': f"bench-lib{n}", 'version': "1.0", 'release': "1.bench", 'arch': arch,
+            'files': [
+                (f"{directory}/{_soname(n)}", 0o120777, f"{_soname(n)}.0"),
+                (f"{directory}/{_soname(n)}.0", 0o100755, elf),
+            ],
+            'provides': [f"{_soname(n)}()(64bit)"],
+            'requires': [f"{name}()(64bit)" for name in needed],
+        })
+
+    needed = [_soname(n) for n in first_layer]
+    packages.append({
+        'name': "bench-daemon", 'version': "1.0", 'release': "1.bench", 'arch': arch,
+        'files': [
+            ("/usr/sbin/benchd", 0o100755, stub_elf(needed, interp=loader, padding=padding, machine=machine)),
+            ("/etc/benchd.conf", 0o100644, b"# benchd\n"),
+            # two identical files for the minimizer to collapse
+            ("/etc/benchd/a.conf", 0o100644, b"# benchd defaults\n"),
+            ("/etc/benchd/b.conf", 0o100644, b"# benchd defaults\n"),
+        ],
+        'requires': [f"{name}()(64bit)" for name in needed] + [os.path.basename(loader) + "()(64bit)"],
+    })
+
+    return packages
+
+
+def generate(repo_dir, libraries=100, fanout=3, depth=4, padding=0, seed=0, legacy=0, arches=("x86_64",)):
+    """
+    Write a repo with a daemon package, a loader package and one package
+    per library, for each arch. Return the names of the daemon package
+    and executable. The first legacy libraries are packaged under /lib64
+    instead of /usr/lib64, as on a system without the merged /usr.
+    """
+    rand = random.Random(seed)
+    depth = max(1, min(depth, libraries))
+    layers = [list(range(n, libraries, depth)) for n in range(depth)]
+
+    # every library in a layer is needed by at least one in the layer above
+    needs = {n: set() for n in range(libraries)}
+    for (upper, lower) in zip(layers, layers[1:]):
+        for (i, n) in enumerate(lower):
+            needs[upper[i % len(upper)]].add(n)
+        for n in upper:
+            extra = rand.sample(lower, min(fanout, len(lower)))
+            needs[n].update(extra[:max(0, fanout - len(needs[n]))])
+
+    packages = []
+    for arch in arches:
+        packages += _arch_packages(arch, libraries, needs, layers[0], padding, legacy)
+
+    write_repo(repo_dir, packages)
+    return ("bench-daemon", "benchd")
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="generate a synthetic repo of stub libraries")
+    parser.add_argument("--libraries", type=int, default=100)
+    parser.add_argument("--fanout", type=int, default=3, help="DT_NEEDED entries per library")
+    parser.add_argument("--depth", type=int, default=4, help="layers in the library graph")
+    parser.add_argument("--padding", type=int, default=0, help="extra bytes in each ELF file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--legacy", type=int, default=0, help="libraries packaged under /lib64")
+    parser.add_argument("--arch", dest="arches", action="append", default=None, choices=sorted(machines),
+                        help="arch of the packages, may be repeated, default x86_64")
+    parser.add_argument("repo_dir")
+    opts = parser.parse_args()
+
+    generate(opts.repo_dir, opts.libraries, opts.fanout, opts.depth, opts.padding, opts.seed, opts.legacy,
+             opts.arches or ("x86_64",))
@@ -0,0 +1,21 @@
+"""
+Sizes given on the command lines of create-model-tree.py and its tools
+
+* parse_size: read a byte count written as 4096, 512K, 1.5M or 2GiB
+"""
+
+# Size suffixes in powers of 1024
+_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    """
+    Read a size such as 4096, 512K or 1.5M as bytes.
+    Raise ValueError if it is not one.
+    """
+    text = text.strip().upper().removesuffix("B").removesuffix("I")
+    unit = text[-1:] if text[-1:] in _units else ''
+    try:
+        return int(float(text[:len(text) - len(unit)]) * _units[unit])
+    except ValueError:
+        raise ValueError(f"not a size: {text}")
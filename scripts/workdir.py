@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+"""
+Process-safe shared work directories for create-model-tree.py
+
+Builds running at the same time on one host can share the package and
+unpack directories instead of each downloading and unpacking everything
+again:
+
+* every entry, an RPM file or an unpacked package tree, has an fcntl
+  lock file .<name>.lock beside it. Only the build holding it writes the
+  entry
+* an entry is complete only once its marker .<name>.done exists. The
+  marker holds the sha256 of the RPM, and for a tree of the RPM it was
+  unpacked from, so a tree of an older release is never taken for current
+* trees are unpacked into a temporary directory and renamed into place,
+  or their files renamed in one at a time, so no build reads a half
+  written file
+* each build lists the entries it uses in a session file that it keeps
+  locked while it runs. When the directories are over a size cap the
+  entries used longest ago are removed, except those a running build
+  has listed
+
+USAGE:
+    workdir.py [--evict SIZE] <dir>...
+"""
+
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import store
+import units
+
+# where each build lists the entries it uses
+SESSION_DIR = ".sessions"
+
+
+class WorkdirError(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def locked(path, shared=False, block=True):
+    """
+    Hold an fcntl lock on a file, created if needed. Yield True once the
+    lock is held, or False at once without block if another holds it.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if block else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
+
+
+def tree_size(path):
+    """
+    The bytes in a file or a file tree, not following symlinks
+    """
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in dirnames + filenames:
+            total += os.lstat(os.path.join(dirpath, name)).st_size
+    return total
+
+
+class Workdir(object):
+    """
+    A directory of RPM files or unpacked trees shared by concurrent builds
+    """
+
+    def __init__(self, root):
+        self._root = root
+        self._session = None
+        self._used = set()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @property
+    def root(self):
+        return self._root
+
+    def path(self, name):
+        return os.path.join(self._root, name)
+
+    def _meta(self, name, kind):
+        return os.path.join(self._root, f".{name}.{kind}")
+
+    def lock(self, name, shared=False, block=True):
+        return locked(self._meta(name, "lock"), shared=shared, block=block)
+
+    # --------------------------------------------------------------
+    # sessions
+    # --------------------------------------------------------------
+    def use(self, name):
+        """
+        List an entry in this build's session so that it is not evicted
+        while the build runs
+        """
+        with self._lock:
+            if name in self._used:
+                return
+            if self._session is None:
+                # locked before it is named as a session, so that no
+                # eviction can take it for the file of a finished build
+                session_dir = os.path.join(self._root, SESSION_DIR)
+                os.makedirs(session_dir, exist_ok=True)
+                (fd, tmp_path) = tempfile.mkstemp(dir=session_dir, prefix=f".{os.getpid()}-")
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                path = os.path.join(session_dir, f"{os.path.basename(tmp_path)[1:]}.session")
+                os.rename(tmp_path, path)
+                self._session = (fd, path)
+            os.write(self._session[0], f"{name}\n".encode())
+            self._used.add(name)
+
+    def close(self):
+        """
+        End this build's session
+        """
+        with self._lock:
+            if self._session is not None:
+                (fd, path) = self._session
+                os.unlink(path)
+                os.close(fd)
+                self._session = None
+                self._used = set()
+
+    def in_use(self):
+        """
+        The entries listed by running builds. Sessions of builds that
+        have ended are removed.
+        """
+        names = set()
+        session_dir = os.path.join(self._root, SESSION_DIR)
+        for filename in os.listdir(session_dir) if os.path.isdir(session_dir) else []:
+            if not filename.endswith(".session"):
+                continue
+            path = os.path.join(session_dir, filename)
+            with locked(path, shared=True, block=False) as ended:
+                if ended:
+                    os.path.exists(path) and os.unlink(path)
+                    continue
+                with open(path) as f:
+                    names.update(line.strip() for line in f)
+        return names
+
+    # --------------------------------------------------------------
+    # markers
+    # --------------------------------------------------------------
+    def marker(self, name):
+        """
+        The marker of a complete entry, or None
+        """
+        try:
+            with open(self._meta(name, "done")) as f:
+                marker = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return marker if os.path.lexists(self.path(name)) else None
+
+    def finish(self, name, sha256, **details):
+        """
+        Mark an entry complete. The caller holds its lock.
+        """
+        done = self._meta(name, "done")
+        with open(f"{done}.tmp", "w") as f:
+            json.dump(dict(details, sha256=sha256), f, sort_keys=True)
+        os.replace(f"{done}.tmp", done)
+
+    def touch(self, name):
+        """
+        Record a use of an entry for eviction
+        """
+        try:
+            os.utime(self._meta(name, "done"))
+        except FileNotFoundError:
+            pass
+
+    def discard(self, name):
+        """
+        Remove an entry and its marker. The caller holds its lock.
+        """
+        done = self._meta(name, "done")
+        os.path.exists(done) and os.unlink(done)
+        path = self.path(name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.unlink(path)
+
+    # --------------------------------------------------------------
+    # RPM files
+    # --------------------------------------------------------------
+    @staticmethod
+    def _verify(path, checksum):
+        """
+        The sha256 of a file if it matches the repo checksum, (type,
+        value) or None, else None
+        """
+        digest = store.file_digest(path)
+        if checksum is None or checksum[1] is None:
+            return digest
+        (checksum_type, value) = checksum
+        actual = digest if checksum_type == "sha256" else \
+            store.file_digest(path, "sha1" if checksum_type == "sha" else checksum_type)
+        return digest if actual == value else None
+
+    def _current(self, name, checksum):
+        marker = self.marker(name)
+        if marker is None:
+            return False
+        if checksum is not None and checksum[0] == "sha256" and marker['sha256'] != checksum[1]:
+            return False
+        self.touch(name)
+        return True
+
+    def fetch(self, wanted, fetch):
+        """
+        Make the RPM files in wanted, {path: (url, checksum)}, complete.
+        fetch(subset of wanted) downloads files and may return the sha256
+        of the ones it already checked, {path: sha256}. A file another
+        build is fetching is waited for rather than fetched again, and
+        every other file is checked against its repo checksum before it
+        is marked.
+        """
+        names = {os.path.basename(path): path for path in wanted}
+        for name in names:
+            self.use(name)
+
+        def prepare(name):
+            # a file with no marker is left from a build that did not finish:
+            # keep it only if it can be checked against its repo checksum
+            path = names[name]
+            checksum = wanted[path][1]
+            if os.path.exists(path) and (checksum is None or checksum[1] is None or
+                                         self._verify(path, checksum) is None):
+                os.unlink(path)
+            return path
+
+        def complete(paths):
+            checked = fetch({path: wanted[path] for path in paths}) or {}
+            problems = []
+            for path in paths:
+                digest = checked.get(path) or self._verify(path, wanted[path][1])
+                if digest is None:
+                    os.unlink(path)
+                    problems.append(f"checksum mismatch for {path}: expected {wanted[path][1][1]}")
+                else:
+                    self.finish(os.path.basename(path), digest)
+            if problems:
+                raise WorkdirError("\n".join(problems))
+
+        # fetch everything no other build is working on at once
+        waiting = []
+        with contextlib.ExitStack() as held:
+            mine = []
+            for name in sorted(names):
+                if self._current(name, wanted[names[name]][1]):
+                    continue
+                if not held.enter_context(self.lock(name, block=False)):
+                    waiting.append(name)
+                elif not self._current(name, wanted[names[name]][1]):
+                    mine.append(prepare(name))
+            mine and complete(mine)
+
+        # then take the rest one at a time as the other builds finish
+        for name in waiting:
+            with self.lock(name):
+                self._current(name, wanted[names[name]][1]) or complete([prepare(name)])
+
+    def digest(self, name, checksum=None):
+        """
+        The sha256 of a complete RPM file, from its marker or its repo
+        checksum, (type, value), before reading the file
+        """
+        marker = self.marker(name)
+        if marker is not None:
+            return marker['sha256']
+        if checksum is not None and checksum[0] == "sha256":
+            return checksum[1]
+        return store.file_digest(self.path(name))
+
+    # --------------------------------------------------------------
+    # unpacked trees
+    # --------------------------------------------------------------
+    def unpack(self, name, sha256, extract, paths=None, force=False):
+        """
+        Make the tree name hold the files of an RPM with the given sha256,
+        or only the files in paths. extract(destdir, paths) writes them.
+        """
+        self.use(name)
+        dest = self.path(name)
+
+        def done():
+            marker = self.marker(name)
+            if marker is None or marker['sha256'] != sha256:
+                return False
+            if paths is None:
+                return marker.get('complete', False)
+            return all(os.path.lexists(f"{dest}{path}") for path in paths)
+
+        if not force and done():
+            self.touch(name)
+            return
+
+        with self.lock(name):
+            if force or not done():
+                staged = tempfile.mkdtemp(dir=self._root, prefix=f".{name}.tmp-")
+                try:
+                    extract(staged, paths)
+                    self._commit_tree(name, staged, sha256, complete=paths is None)
+                finally:
+                    os.path.isdir(staged) and shutil.rmtree(staged)
+
+    def _commit_tree(self, name, staged, sha256, complete):
+        """
+        Move an unpacked tree into place and mark it. A tree unpacked from
+        the same RPM gains the new files one rename at a time, regular
+        files before the symlinks that point at them. Any other tree is
+        replaced whole.
+        """
+        dest = self.path(name)
+        marker = self.marker(name)
+
+        if marker is not None and marker['sha256'] == sha256 and os.path.isdir(dest):
+            staged_files = []
+            for (dirpath, dirnames, filenames) in os.walk(staged):
+                local = os.path.join(dest, os.path.relpath(dirpath, staged))
+                os.makedirs(local, exist_ok=True)
+                staged_files += [(os.path.join(dirpath, f), os.path.join(local, f))
+                                 for f in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]]
+            for (src, dst) in sorted(staged_files, key=lambda pair: os.path.islink(pair[0])):
+                os.replace(src, dst)
+            complete = complete or marker.get('complete', False)
+        else:
+            old = None
+            if os.path.lexists(dest):
+                old = f"{staged}.old"
+                os.rename(dest, old)
+            os.rename(staged, dest)
+            old is not None and shutil.rmtree(old)
+
+        self.finish(name, sha256, complete=complete)
+
+    # --------------------------------------------------------------
+    # eviction
+    # --------------------------------------------------------------
+    def entries(self):
+        """
+        (name, bytes, last use) of every complete entry
+        """
+        found = []
+        for filename in os.listdir(self._root):
+            if not (filename.startswith(".") and filename.endswith(".done")):
+                continue
+            name = filename[1:-len(".done")]
+            try:
+                last_use = os.stat(os.path.join(self._root, filename)).st_mtime
+                found.append((name, tree_size(self.path(name)), last_use))
+            except FileNotFoundError:
+                continue
+        return found
+
+
+class Workdirs(object):
+    """
+    The shared directories a build uses, so that they can be capped
+    together and their sessions ended at once
+    """
+
+    def __init__(self, verbose=False):
+        self._verbose = verbose
+        self._workdirs = {}
+        self._lock = threading.Lock()
+
+    def get(self, root):
+        with self._lock:
+            key = os.path.realpath(root)
+            if key not in self._workdirs:
+                self._workdirs[key] = Workdir(root)
+            return self._workdirs[key]
+
+    def size(self):
+        return sum(size for workdir in self._workdirs.values() for (name, size, used) in workdir.entries())
+
+    def evict(self, max_bytes):
+        """
+        Remove the entries used longest ago until the directories hold no
+        more than max_bytes. Entries a running build uses are kept.
+        Return the removed (directory, name, bytes).
+        """
+        entries = sorted(((used, workdir, name, size) for workdir in self._workdirs.values()
+                          for (name, size, used) in workdir.entries()), key=lambda e: e[0])
+        total = sum(size for (used, workdir, name, size) in entries)
+
+        removed = []
+        for (used, workdir, name, size) in entries:
+            if total <= max_bytes:
+                break
+            with workdir.lock(name, block=False) as held:
+                if not held or name in workdir.in_use():
+                    continue
+                self._verbose and print(f"evicting: {workdir.path(name)} ({size} bytes)")
+                workdir.discard(name)
+            total -= size
+            removed.append((workdir.root, name, size))
+        return removed
+
+    def close(self):
+        for workdir in self._workdirs.values():
+            workdir.close()
+
+
+# ===============================
+# MAIN
+# ===============================
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="show or cap the shared create-model-tree.py work directories")
+    parser.add_argument('--verbose', '-v', action=argparse.BooleanOptionalAction)
+    parser.add_argument("--evict", default=None, metavar="SIZE",
+                        help="remove the entries used longest ago until the directories hold no more than this")
+    parser.add_argument("dirs", metavar="dir", nargs="+")
+    opts = parser.parse_args()
+
+    workdirs = Workdirs(verbose=opts.verbose)
+    try:
+        for root in opts.dirs:
+            entries = workdirs.get(root).entries()
+            print(f"{root}: {len(entries)} entries, {sum(size for (name, size, used) in entries)} bytes")
+        if opts.evict is not None:
+            removed = workdirs.evict(units.parse_size(opts.evict))
+            print(f"evicted {len(removed)} entries, {sum(size for (root, name, size) in removed)} bytes")
+    except (ValueError, OSError) as e:
+        sys.exit(str(e))
@@ -0,0 +1,102 @@
+"""
+Shared fixtures: a synthetic repo served over HTTP with a stub dnf on
+PATH that answers from its index, as benchmark.py sets it up.
+"""
+
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+script_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+sys.path.insert(0, script_dir)
+
+import benchmark  # noqa: E402
+import repodata  # noqa: E402
+import synthrepo  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def model_tree():
+    """
+    create-model-tree.py loaded as a module
+    """
+    spec = importlib.util.spec_from_file_location("create_model_tree", os.path.join(script_dir, "create-model-tree.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Fixture(object):
+    """
+    A served synthetic repo, its index and a stub dnf that logs each
+    command line it is run with.
+    """
+
+    def __init__(self, base, url, package, daemon):
+        self.base = base
+        self.url = url
+        self.package = package
+        self.daemon = daemon
+        self.index = os.path.join(base, "repo.idx")
+        self.log = os.path.join(base, "dnf.log")
+        self.env = dict(os.environ)
+        self.env['PATH'] = os.path.join(base, "bin") + os.pathsep + os.environ['PATH']
+        self.env[benchmark.LOG_ENV] = self.log
+
+    def build(self, run_dir, *args, check=True):
+        """
+        Run create-model-tree.py for the daemon in run_dir with extra
+        arguments. Return the CompletedProcess.
+        """
+        os.makedirs(run_dir, exist_ok=True)
+        command = [sys.executable, os.path.join(script_dir, "create-model-tree.py"), "--no-manifest",
+                   "--daemon-file", self.daemon, *args, self.package]
+        result = subprocess.run(command, cwd=run_dir, env=self.env, capture_output=True, text=True)
+        if check and result.returncode != 0:
+            pytest.fail(f"build failed ({result.returncode}): {result.stderr}")
+        return result
+
+    def dnf_calls(self):
+        """
+        The command lines the stub dnf has been run with, and reset the log
+        """
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            calls = [json.loads(line) for line in f]
+        os.unlink(self.log)
+        return calls
+
+
+def _served(base, **generate):
+    repo_dir = os.path.join(base, "repo")
+    (package, daemon) = synthrepo.generate(repo_dir, **generate)
+
+    with benchmark.RepoServer(repo_dir) as server:
+        repodata.build_index([repodata.Repository(server.url, workdir=os.path.join(base, "repocache"))],
+                             os.path.join(base, "repo.idx"))
+        benchmark.write_stub_dnf(os.path.join(base, "bin"), os.path.join(base, "repo.idx"))
+        yield Fixture(base, server.url, package, daemon)
+
+
+@pytest.fixture(scope="session")
+def synthetic(tmp_path_factory):
+    """
+    A repo of 6 libraries all needed by the daemon, two of them packaged
+    under /lib64
+    """
+    yield from _served(str(tmp_path_factory.mktemp("synthetic")), libraries=6, fanout=1, depth=1, legacy=2)
+
+
+@pytest.fixture(scope="session")
+def multiarch(tmp_path_factory):
+    """
+    A repo of 3 libraries needed by the daemon, built for x86_64 and for
+    aarch64
+    """
+    yield from _served(str(tmp_path_factory.mktemp("multiarch")), libraries=3, fanout=1, depth=1,
+                       arches=("x86_64", "aarch64"))
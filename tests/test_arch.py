@@ -0,0 +1,37 @@
+import json
+import os
+
+import elffile
+import synthrepo
+
+
+def blob(layout, digest):
+    with open(os.path.join(layout, "blobs", *digest.split(":"))) as f:
+        return json.load(f)
+
+
+def test_each_arch_is_built_from_its_own_packages(multiarch, tmp_path):
+    """
+    One run for two arches resolves the foreign one with dnf
+    --forcearch, places each arch's files in its own model tree and
+    writes an image index with an image for each
+    """
+    multiarch.dnf_calls()
+    multiarch.build(str(tmp_path), "--arch", "x86_64,aarch64", "--oci-layout", "image")
+    forced = {word for call in multiarch.dnf_calls() for word in call if word.startswith("--forcearch=")}
+    assert forced == {f"--forcearch={arch}" for arch in synthrepo.machines if arch != os.uname().machine}
+
+    paths = {}
+    for (arch, (machine, loader)) in synthrepo.machines.items():
+        model = tmp_path / "workdir" / "model" / arch / multiarch.daemon
+        for path in ["usr/sbin/benchd", "usr" + loader] + [f"usr/lib64/libbench{n}.so.1.0" for n in range(3)]:
+            assert elffile.ElfFile(str(model / path)).machine == machine
+        paths[arch] = {os.path.relpath(os.path.join(d, f), model) for (d, _, files) in os.walk(model) for f in files}
+    assert paths['x86_64'] - paths['aarch64'] == {"usr/lib64/ld-linux-x86-64.so.2"}
+    assert paths['aarch64'] - paths['x86_64'] == {"usr/lib/ld-linux-aarch64.so.1"}
+
+    layout = str(tmp_path / "image")
+    with open(os.path.join(layout, "index.json")) as f:
+        [entry] = json.load(f)['manifests']
+    platforms = [m['platform'] for m in blob(layout, entry['digest'])['manifests']]
+    assert sorted(p['architecture'] for p in platforms) == ["amd64", "arm64"]
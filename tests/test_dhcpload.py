@@ -0,0 +1,96 @@
+import asyncio
+import socket
+import threading
+import time
+
+import dhcpload
+
+MAC = dhcpload.client_mac(7)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_packet_round_trip():
+    options = [(dhcpload.OPTION_CLIENT_ID, b"\x01" + MAC), (dhcpload.OPTION_REQUESTED_ADDRESS, bytes([10, 0, 0, 9]))]
+    data = dhcpload.packet(dhcpload.REQUEST, 0x12345678, MAC, options=options)
+    assert len(data) == 300
+    message = dhcpload.parse(data)
+    assert message == {
+        'op': 1, 'hops': 0, 'xid': 0x12345678, 'flags': dhcpload.BROADCAST_FLAG, 'type': dhcpload.REQUEST,
+        'ciaddr': "0.0.0.0", 'yiaddr': "0.0.0.0", 'giaddr': "0.0.0.0", 'mac': MAC,
+        'options': {dhcpload.OPTION_MESSAGE_TYPE: bytes([dhcpload.REQUEST]), **dict(options)},
+    }
+
+
+def test_relayed_packet_round_trip():
+    # a relay agent forwards with one hop and needs no broadcast reply
+    message = dhcpload.parse(dhcpload.packet(dhcpload.DISCOVER, 1, MAC, giaddr="192.0.2.1"))
+    assert (message['giaddr'], message['hops'], message['flags']) == ("192.0.2.1", 1, 0)
+
+    reply = dhcpload.parse(dhcpload.packet(dhcpload.OFFER, 1, MAC, giaddr="192.0.2.1", yiaddr="10.0.0.9", reply=True))
+    assert (reply['op'], reply['hops'], reply['flags'], reply['yiaddr']) == (2, 0, 0, "10.0.0.9")
+
+
+def test_long_packet_is_not_padded():
+    options = [(224 + n, bytes(40)) for n in range(8)]
+    data = dhcpload.packet(dhcpload.DISCOVER, 1, MAC, options=options)
+    assert len(data) > 300 and data.endswith(bytes([dhcpload.OPTION_END]))
+    assert dhcpload.parse(data)['options'][231] == bytes(40)
+    assert dhcpload.parse(data[:200]) is None
+
+
+def test_percentiles():
+    assert dhcpload.percentiles([]) is None
+    assert dhcpload.percentiles([0.004]) == {'p50': 4.0, 'p90': 4.0, 'p99': 4.0, 'max': 4.0}
+    # 1ms to 100ms in any order
+    values = [n / 1000 for n in range(100, 0, -1)]
+    assert dhcpload.percentiles(values) == {'p50': 50.0, 'p90': 90.0, 'p99': 99.0, 'max': 100.0}
+
+
+def test_stand_in_naks_a_request_it_did_not_offer():
+    server = dhcpload.StandIn("10.0.0.0/29", "10.0.0.1")
+    request = dhcpload.packet(dhcpload.REQUEST, 1, MAC, options=[
+        (dhcpload.OPTION_REQUESTED_ADDRESS, bytes([10, 0, 0, 2]))])
+    (response, to) = server.answer(dhcpload.parse(request))
+    assert dhcpload.parse(response)['type'] == dhcpload.NAK
+    assert to == ("255.255.255.255", dhcpload.CLIENT_PORT)
+    assert server.leases == {}
+
+    # once offered, the same request is granted
+    (offer, _) = server.answer(dhcpload.parse(dhcpload.packet(dhcpload.DISCOVER, 2, MAC)))
+    assert dhcpload.parse(offer)['yiaddr'] == "10.0.0.2"
+    (ack, _) = server.answer(dhcpload.parse(request))
+    assert (dhcpload.parse(ack)['type'], dhcpload.parse(ack)['yiaddr']) == (dhcpload.ACK, "10.0.0.2")
+
+
+def test_stand_in_runs_out_of_addresses():
+    server = dhcpload.StandIn("10.0.0.0/30", "10.0.0.1")
+    discover = [dhcpload.parse(dhcpload.packet(dhcpload.DISCOVER, n, dhcpload.client_mac(n))) for n in range(2)]
+    assert dhcpload.parse(server.answer(discover[0])[0])['yiaddr'] == "10.0.0.2"
+    assert server.answer(discover[1]) is None
+
+    # a released address is offered to the next client
+    server.answer(dhcpload.parse(dhcpload.packet(dhcpload.RELEASE, 3, dhcpload.client_mac(0))))
+    assert dhcpload.parse(server.answer(discover[1])[0])['yiaddr'] == "10.0.0.2"
+
+
+def test_load_against_the_stand_in_as_a_relay():
+    port = free_port()
+    server = dhcpload.StandIn("10.0.0.0/24", "10.0.0.1", port=port)
+    threading.Thread(target=server.serve, daemon=True).start()
+
+    generator = dhcpload.LoadGenerator(server="127.0.0.1", relay="127.0.0.2", port=port, timeout=1)
+    result = asyncio.run(dhcpload._measure(generator, 4, 0.3, time.perf_counter(), 5))
+    assert result['counts']['handshakes'] > 0
+    assert (result['counts']['timeouts'], result['counts']['naks']) == (0, 0)
+    assert result['latency_ms']['handshake']['max'] >= result['latency_ms']['handshake']['p50'] > 0
+
+    # every client released its lease, the first OFFER's client never took one
+    deadline = time.monotonic() + 2
+    while len(server.leases) > 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert list(server.leases) == [dhcpload.client_mac(0xffffffff)]
@@ -0,0 +1,56 @@
+import pytest
+
+import elffile
+import synthrepo
+
+loader = "/lib64/ld-linux-x86-64.so.2"
+
+
+def place(root, path, data):
+    local = root / path.lstrip("/")
+    local.parent.mkdir(parents=True, exist_ok=True)
+    local.write_bytes(data)
+
+
+def test_needed_runpath_and_origin(tmp_path):
+    """
+    Libraries are found in the default directories and through a
+    DT_RUNPATH with $ORIGIN; missing ones get the default path
+    """
+    place(tmp_path, "/usr/sbin/daemon", synthrepo.stub_elf(
+        ["liba.so.1", "libb.so.1", "libc-missing.so.1"], interp=loader, runpath="$ORIGIN/../lib64/daemon"))
+    place(tmp_path, "/usr/lib64/liba.so.1", synthrepo.stub_elf(["libdeep.so.1"], soname="liba.so.1"))
+    place(tmp_path, "/usr/lib64/libdeep.so.1", synthrepo.stub_elf(soname="libdeep.so.1"))
+    place(tmp_path, "/usr/lib64/daemon/libb.so.1", synthrepo.stub_elf(soname="libb.so.1"))
+    place(tmp_path, loader, synthrepo.stub_elf(soname="ld-linux-x86-64.so.2"))
+
+    elf = elffile.ElfFile(str(tmp_path / "usr/sbin/daemon"))
+    assert elf.needed == ["liba.so.1", "libb.so.1", "libc-missing.so.1"]
+    assert elf.runpath == ["$ORIGIN/../lib64/daemon"]
+    assert elf.interp == loader
+
+    root = str(tmp_path)
+    assert elffile.DependencyWalker([root]).closure(root, "/usr/sbin/daemon") == [
+        (root, "/usr/lib64/liba.so.1"),
+        (root, "/usr/lib64/daemon/libb.so.1"),
+        (None, "/usr/lib64/libc-missing.so.1"),
+        (root, "/usr/lib64/libdeep.so.1"),
+        (root, loader),
+    ]
+
+
+def test_truncated_file(tmp_path):
+    """
+    A truncated library raises ElfError and is passed over by the walker
+    rather than ending the walk
+    """
+    place(tmp_path, "/usr/sbin/daemon", synthrepo.stub_elf(["libcut.so.1"]))
+    place(tmp_path, "/usr/lib64/libcut.so.1", synthrepo.stub_elf(soname="libcut.so.1")[:150])
+
+    with pytest.raises(elffile.ElfError):
+        elffile.ElfFile(str(tmp_path / "usr/lib64/libcut.so.1"))
+
+    root = str(tmp_path)
+    assert elffile.DependencyWalker([root]).closure(root, "/usr/sbin/daemon") == [
+        (None, "/usr/lib64/libcut.so.1"),
+    ]
@@ -0,0 +1,134 @@
+import hashlib
+import os
+
+import benchmark
+import fetch
+
+
+def test_removed_file_is_downloaded_again(tmp_path):
+    """
+    A finished download is not reused once its file is gone
+    """
+    served = tmp_path / "served"
+    served.mkdir()
+    (served / "a.rpm").write_bytes(b"rpm")
+    path = str(tmp_path / "packages" / "a.rpm")
+
+    with benchmark.RepoServer(str(served)) as server, fetch.DownloadPool(workers=2) as pool:
+        url = f"{server.url}/a.rpm"
+        assert pool.fetch([(url, path)]) == [path]
+        os.unlink(path)
+        assert pool.fetch([(url, path)]) == [path]
+        assert open(path, "rb").read() == b"rpm"
+
+
+def test_retrieve_all_locates_every_package_at_once(model_tree, tmp_path, monkeypatch):
+    """
+    The URLs of a set of packages come from one dnf query and the files
+    are then fetched together
+    """
+    served = tmp_path / "served"
+    served.mkdir()
+    names = ["alpha", "beta", "gamma"]
+    for name in names:
+        (served / f"{name}-1.0-1.x86_64.rpm").write_bytes(name.encode())
+
+    Package = model_tree.Package
+    for (attribute, value) in (("index", None), ("store", None), ("workdirs", None), ("cache", None), ("_urls", {})):
+        monkeypatch.setattr(Package, attribute, value)
+
+    with benchmark.RepoServer(str(served)) as server, fetch.DownloadPool(workers=4) as pool:
+        queries = []
+
+        def query(command, check=False):
+            queries.append(command)
+            keys = command[command.index("https") + 1:]
+            return "".join(f"{server.url}/{key}-1.0-1.x86_64.rpm\n" for key in reversed(keys))
+
+        monkeypatch.setattr(Package, "query", staticmethod(query))
+        Package.retrieve_all([Package(name) for name in names], str(tmp_path / "packages"),
+                             dependencies=False, pool=pool)
+
+    assert len(queries) == 1
+    for name in names:
+        assert (tmp_path / "packages" / f"{name}-1.0-1.x86_64.rpm").read_bytes() == name.encode()
+
+
+def served_file(tmp_path, size, name="big.rpm"):
+    """
+    A directory holding one file of size bytes, and the file's content
+    """
+    served = tmp_path / "served"
+    served.mkdir(exist_ok=True)
+    data = bytes(n % 251 for n in range(size))
+    (served / name).write_bytes(data)
+    return (served, data)
+
+
+def test_cut_transfer_resumes_with_range(tmp_path):
+    """
+    A transfer cut off mid-file carries on from where it stopped
+    """
+    (served, data) = served_file(tmp_path, 300 * 1024)
+    path = str(tmp_path / "packages" / "big.rpm")
+
+    with benchmark.RepoServer(str(served), drop_after=128 * 1024) as server, fetch.DownloadPool(workers=1) as pool:
+        pool.fetch([(f"{server.url}big.rpm", path, ("sha256", hashlib.sha256(data).hexdigest()))])
+
+    assert open(path, "rb").read() == data
+    assert [r for (p, r) in server.requests] == [None, f"bytes={128 * 1024}-", f"bytes={256 * 1024}-"]
+
+
+def test_corrupt_partial_file_is_fetched_again(tmp_path):
+    """
+    A .part file that does not start like the real file is resumed, fails
+    its checksum and is then downloaded whole
+    """
+    (served, data) = served_file(tmp_path, 64 * 1024)
+    path = tmp_path / "packages" / "big.rpm"
+    path.parent.mkdir()
+    (tmp_path / "packages" / "big.rpm.part").write_bytes(b"x" * 1024)
+
+    with benchmark.RepoServer(str(served)) as server, fetch.DownloadPool(workers=1) as pool:
+        pool.fetch([(f"{server.url}big.rpm", str(path), ("sha256", hashlib.sha256(data).hexdigest()))])
+
+    assert path.read_bytes() == data
+    assert [r for (p, r) in server.requests] == ["bytes=1024-", None]
+
+
+def test_throttled_mirror_is_ranked_below_a_fast_one(tmp_path):
+    """
+    Once both mirrors have served a file the faster one is tried first
+    """
+    (tmp_path / "served" / "Packages").mkdir(parents=True)
+    (served, data) = served_file(tmp_path, 256 * 1024, "Packages/a.rpm")
+    (served / "Packages" / "b.rpm").write_bytes(data)
+
+    with benchmark.RepoServer(str(served), rate=1024 * 1024) as slow, benchmark.RepoServer(str(served)) as fast:
+        mirrors = fetch.Mirrors([slow.url, fast.url])
+        with fetch.DownloadPool(workers=1, mirrors=mirrors) as pool:
+            for name in ("a.rpm", "b.rpm"):
+                pool.fetch([(f"{slow.url}Packages/{name}", str(tmp_path / "packages" / name))])
+            assert [url.split("Packages/")[0] for url in pool.candidates(f"{slow.url}Packages/c.rpm")] == \
+                [fast.url, slow.url]
+
+
+def test_slow_mirror_hands_over_to_another(tmp_path, monkeypatch):
+    """
+    A transfer below the minimum rate moves to the next mirror and
+    resumes there
+    """
+    monkeypatch.setattr(fetch, "slow_grace", 0.2)
+    (tmp_path / "served" / "Packages").mkdir(parents=True)
+    (served, data) = served_file(tmp_path, 512 * 1024, "Packages/a.rpm")
+    path = str(tmp_path / "packages" / "a.rpm")
+
+    with benchmark.RepoServer(str(served), rate=128 * 1024) as slow, benchmark.RepoServer(str(served)) as fast:
+        mirrors = fetch.Mirrors([slow.url, fast.url])
+        with fetch.DownloadPool(workers=1, mirrors=mirrors, min_rate=1024 * 1024) as pool:
+            pool.fetch([(f"{slow.url}Packages/a.rpm", path, ("sha256", hashlib.sha256(data).hexdigest()))])
+            stats = pool.stats
+
+    assert open(path, "rb").read() == data
+    assert stats[slow.url]['failures'] == 1
+    assert [r is not None for (p, r) in fast.requests] == [True]
@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+import leases
+
+COMMENTS = b"""\
+# The format of this file is documented in the dhcpd.leases(5) manual page.
+# This lease file was written by isc-dhcp-4.4.3
+
+# authoring-byte-order entry is generated, DO NOT DELETE
+"""
+
+HEAD = COMMENTS + b"authoring-byte-order little-endian;\n\n"
+
+FAILOVER = b"""\
+failover peer "dhcp-failover" state {
+  my state normal at 3 2024/05/01 09:00:00;
+  partner state normal at 3 2024/05/01 09:00:00;
+}
+"""
+
+
+def lease(address, mac, state, starts, hostname=None):
+    text = (f"lease {address} {{\n"
+            f"  starts 3 2024/05/01 {starts};\n"
+            f"  ends 3 2024/05/01 23:00:00;\n"
+            f"  binding state {state};\n"
+            f"  hardware ethernet {mac};\n")
+    hostname is not None and (text := text + f'  client-hostname "{hostname}";\n')
+    return (text + "}\n").encode()
+
+
+@pytest.fixture
+def lease_file(tmp_path):
+    """
+    A lease file in which 10.0.0.10 was leased three times and released,
+    10.0.0.11 renewed once and a failover block was written in between
+    """
+    path = str(tmp_path / "dhcpd.leases")
+    with open(path, "wb") as f:
+        f.write(HEAD)
+        f.write(lease("10.0.0.10", "52:54:00:00:00:0a", "active", "09:00:00", "first"))
+        f.write(lease("10.0.0.11", "52:54:00:00:00:0b", "active", "09:00:05"))
+        f.write(FAILOVER)
+        f.write(lease("10.0.0.10", "52:54:00:00:00:0a", "active", "10:00:00", "second"))
+        f.write(b"authoring-byte-order little-endian;\n")
+        f.write(lease("10.0.0.11", "52:54:00:00:00:0b", "active", "11:00:05"))
+        f.write(lease("10.0.0.10", "52:54:00:00:00:0c", "free", "12:00:00"))
+    return path
+
+
+def test_last_lease_of_an_address_wins(lease_file):
+    with leases.LeaseIndex(lease_file) as index:
+        assert index.update() == 8
+        [found] = index.lookup(ip="10.0.0.10")
+        assert (found['state'], found['mac'], found['hostname']) == ("free", "52:54:00:00:00:0c", None)
+        assert found['starts'] == leases.lease_time(b"3 2024/05/01 12:00:00")
+        assert index.lookup(mac="52-54-00-00-00-0A") == []
+        assert [l['address'] for l in index.lookup(mac="52:54:00:00:00:0b")] == ["10.0.0.11"]
+        assert index.text(b"failover peer \"dhcp-failover\" state").startswith("failover peer")
+        assert index.stats == {'entries': 4, 'leases': 2, 'bytes': os.path.getsize(lease_file)}
+
+
+def test_compacted_file_keeps_only_the_live_leases(lease_file):
+    with leases.LeaseIndex(lease_file) as index:
+        result = index.compact()
+    compacted = open(f"{lease_file}.compact", "rb").read()
+    assert compacted == (COMMENTS + b"authoring-byte-order little-endian;\n" + FAILOVER +
+                         lease("10.0.0.11", "52:54:00:00:00:0b", "active", "11:00:05") +
+                         lease("10.0.0.10", "52:54:00:00:00:0c", "free", "12:00:00"))
+    assert result == {'before': os.path.getsize(lease_file), 'after': len(compacted), 'entries': 4}
+
+    # the compacted file holds the same leases
+    with leases.LeaseIndex(f"{lease_file}.compact") as index:
+        assert index.update() == 4
+        assert [(l['address'], l['state']) for l in index.lookup(mac="52:54:00:00:00:0c")] == \
+            [("10.0.0.10", "free")]
+        assert index.stats['leases'] == 2
+
+
+def test_block_cut_off_at_the_end_is_read_once_finished(lease_file):
+    last = lease("10.0.0.12", "52:54:00:00:00:0d", "active", "13:00:00")
+    with open(lease_file, "ab") as f:
+        f.write(last[:60])
+    size = os.path.getsize(lease_file)
+
+    with leases.LeaseIndex(lease_file) as index:
+        assert index.update() == 8
+        assert index.lookup(ip="10.0.0.12") == []
+        assert index.stats['bytes'] == size - 60
+        with pytest.raises(leases.LeaseError, match="unfinished statement"):
+            index.compact()
+        assert not os.path.exists(f"{lease_file}.compact")
+
+        # dhcpd finishes writing it: only the rest is read
+        with open(lease_file, "ab") as f:
+            f.write(last[60:])
+        assert index.update() == 1
+        assert [l['state'] for l in index.lookup(ip="10.0.0.12")] == ["active"]
+        assert index.compact(in_place=True)['entries'] == 5
+    assert open(f"{lease_file}~", "rb").read().endswith(last)
+
+
+def test_garbage_before_the_end_is_an_error(tmp_path):
+    path = str(tmp_path / "dhcpd.leases")
+    with open(path, "wb") as f:
+        f.write(HEAD + b"not a statement\n" + lease("10.0.0.2", "52:54:00:00:00:02", "active", "09:00:00"))
+    with leases.LeaseIndex(path) as index, pytest.raises(leases.LeaseError, match="line 7"):
+        index.update()
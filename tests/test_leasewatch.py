@@ -0,0 +1,140 @@
+import os
+
+import pytest
+
+import leasewatch
+
+CONFIG = """\
+subnet 10.0.0.0 netmask 255.255.255.0 {
+  range 10.0.0.200 10.0.0.209;
+  pool {
+    range 10.0.0.10 10.0.0.19;
+  }
+}
+"""
+
+
+def lease(address, state, starts="09:00:00"):
+    return (f"lease {address} {{\n"
+            f"  starts 3 2024/05/01 {starts};\n"
+            f"  ends 3 2024/05/01 23:00:00;\n"
+            f"  binding state {state};\n"
+            f"  hardware ethernet 52:54:00:00:00:01;\n"
+            f"}}\n").encode()
+
+
+@pytest.fixture
+def files(tmp_path):
+    config = tmp_path / "dhcpd.conf"
+    config.write_text(CONFIG)
+    path = str(tmp_path / "dhcpd.leases")
+    with open(path, "wb") as f:
+        f.write(b"# dhcpd\nauthoring-byte-order little-endian;\n\n")
+        f.write(lease("10.0.0.10", "active"))
+        f.write(lease("10.0.0.11", "free"))
+    return (leasewatch.Pools(str(config)), path)
+
+
+@pytest.fixture
+def tail(files):
+    (pools, path) = files
+    tail = leasewatch.LeaseTail(path, pools)
+    yield tail
+    tail.close()
+
+
+def counts(tail):
+    return {(pool.name if pool is not None else None, state): count
+            for (pool, states) in tail.counts.items() for (state, count) in states.items() if count}
+
+
+def test_half_written_block_waits_for_the_rest(files, tail):
+    (pools, path) = files
+    assert tail.poll() == os.path.getsize(path)
+    assert counts(tail) == {("10.0.0.10-10.0.0.19", "active"): 1, ("10.0.0.10-10.0.0.19", "free"): 1}
+
+    # dhcpd is part way through a line of the next lease
+    added = lease("10.0.0.200", "active")
+    with open(path, "ab") as f:
+        f.write(added[:50])
+    assert tail.poll() == 50
+    assert ("10.0.0.200-10.0.0.209", "active") not in counts(tail)
+    assert tail.offset < os.path.getsize(path)
+
+    with open(path, "ab") as f:
+        f.write(added[50:])
+    assert tail.poll() == len(added) - 50
+    assert counts(tail)[("10.0.0.200-10.0.0.209", "active")] == 1
+    assert tail.offset == os.path.getsize(path)
+    assert tail.grants[pools.find("10.0.0.200")] == 1
+    assert (tail.rewrites, tail.errors) == (0, 0)
+
+
+def test_renamed_file_is_read_from_the_start(files, tail):
+    (pools, path) = files
+    tail.poll()
+    # the last lease of the old file, then the rewrite that carries it over
+    with open(path, "ab") as f:
+        f.write(lease("10.0.0.12", "active"))
+    with open(f"{path}.new", "wb") as f:
+        f.write(lease("10.0.0.10", "active") + lease("10.0.0.12", "active") + lease("10.0.0.13", "active"))
+    os.replace(f"{path}.new", path)
+
+    tail.poll()
+    assert tail.rewrites == 1
+    assert tail.offset == os.path.getsize(path)
+    # 10.0.0.11 was dropped by the rewrite
+    assert counts(tail) == {("10.0.0.10-10.0.0.19", "active"): 3}
+    # 10.0.0.12 was granted in the old file, 10.0.0.13 only in the new one
+    assert tail.grants[pools.find("10.0.0.12")] == 2
+
+
+def test_truncated_file_is_read_from_the_start(files, tail):
+    (pools, path) = files
+    tail.poll()
+    identity = os.stat(path).st_ino
+    with open(path, "r+b") as f:
+        f.truncate(0)
+        f.write(lease("10.0.0.14", "free"))
+    assert os.stat(path).st_ino == identity and os.path.getsize(path) < tail.offset
+
+    assert tail.poll() == os.path.getsize(path)
+    assert tail.rewrites == 1
+    assert counts(tail) == {("10.0.0.10-10.0.0.19", "free"): 1}
+
+
+def test_metrics_render_the_pool_gauges(files, tail):
+    (pools, path) = files
+    with open(path, "ab") as f:
+        f.write(lease("10.0.0.200", "active"))
+        f.write(lease("10.0.0.201", "backup"))
+        f.write(lease("10.0.0.50", "active"))
+        f.write(lease("192.168.1.1", "active"))
+    tail.poll()
+    metrics = leasewatch.Metrics(tail)
+    metrics.update(pools)
+
+    samples = {}
+    for line in metrics.text.decode().splitlines():
+        if not line.startswith("#"):
+            (name, value) = line.rsplit(" ", 1)
+            samples[name] = float(value)
+
+    pool = 'subnet="10.0.0.0/24",pool="10.0.0.10-10.0.0.19"'
+    direct = 'subnet="10.0.0.0/24",pool="10.0.0.200-10.0.0.209"'
+    other = 'subnet="10.0.0.0/24",pool=""'
+    assert samples[f"dhcpd_pool_addresses{{{pool}}}"] == 10
+    assert samples[f"dhcpd_pool_addresses{{{direct}}}"] == 10
+    assert samples[f"dhcpd_pool_addresses{{{other}}}"] == 0
+    assert samples[f'dhcpd_pool_leases{{{pool},state="active"}}'] == 1
+    assert samples[f'dhcpd_pool_leases{{{pool},state="free"}}'] == 1
+    assert samples[f'dhcpd_pool_leases{{{pool},state="backup"}}'] == 0
+    assert samples[f'dhcpd_pool_leases{{{direct},state="backup"}}'] == 1
+    assert samples[f'dhcpd_pool_leases{{{other},state="active"}}'] == 1
+    assert samples[f"dhcpd_pool_utilization{{{pool}}}"] == 0.1
+    assert samples[f"dhcpd_pool_utilization{{{direct}}}"] == 0.1
+    assert f"dhcpd_pool_utilization{{{other}}}" not in samples
+    assert samples["dhcpd_leases_unmatched"] == 1
+    assert samples["dhcpd_leases_read_bytes"] == os.path.getsize(path)
+    # the first read grants nothing
+    assert samples[f"dhcpd_pool_grants_total{{{direct}}}"] == 0
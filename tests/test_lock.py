@@ -0,0 +1,66 @@
+import os
+
+import yaml
+
+import elffile
+import synthrepo
+
+
+def tree(root):
+    """
+    Every entry under root, by relative path: the target of a symlink,
+    else the mode and content of a file
+    """
+    entries = {}
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                entries[os.path.relpath(path, root)] = os.readlink(path)
+            elif os.path.isfile(path):
+                with open(path, "rb") as f:
+                    entries[os.path.relpath(path, root)] = (os.stat(path).st_mode, f.read())
+    return entries
+
+
+def test_from_lock_reproduces_oci_layout(synthetic, tmp_path):
+    """
+    A build from a lockfile in an empty directory writes the same image
+    as the build that wrote the lockfile, without asking dnf anything
+    """
+    lock = str(tmp_path / "model.lock")
+    synthetic.build(str(tmp_path / "first"), "--write-lock", lock, "--oci-layout", "image")
+    synthetic.dnf_calls()
+    synthetic.build(str(tmp_path / "second"), "--from-lock", lock, "--oci-layout", "image")
+    assert synthetic.dnf_calls() == []
+
+    first = tree(tmp_path / "first" / "image")
+    assert "index.json" in first
+    assert tree(tmp_path / "second" / "image") == first
+
+
+def test_from_lock_rebuilds_each_arch(multiarch, tmp_path):
+    """
+    A lockfile of a build for two arches pins each arch's own packages,
+    and rebuilds the model tree of each arch and the image index of both
+    """
+    lock = str(tmp_path / "model.lock")
+    multiarch.build(str(tmp_path / "first"), "--arch", "x86_64,aarch64", "--write-lock", lock, "--oci-layout", "image")
+    multiarch.dnf_calls()
+    multiarch.build(str(tmp_path / "second"), "--from-lock", lock, "--oci-layout", "image")
+    assert multiarch.dnf_calls() == []
+
+    with open(lock) as f:
+        images = yaml.safe_load(f)['images']
+    assert [(image['name'], image['arch']) for image in images] == [("benchd", "aarch64"), ("benchd", "x86_64")]
+    for image in images:
+        assert sorted(rpm['nevra'] for rpm in image['rpms']) == sorted(
+            f"{name}-1.0-1.bench.{image['arch']}" for name in
+            ["bench-daemon", "bench-loader", "bench-lib0", "bench-lib1", "bench-lib2"])
+
+    for (arch, (machine, loader)) in synthrepo.machines.items():
+        model = tmp_path / "first" / "workdir" / "model" / arch / multiarch.daemon
+        assert elffile.ElfFile(str(model / "usr/sbin/benchd")).machine == machine
+        assert (model / "usr" / loader.lstrip("/")).is_file()
+        assert tree(tmp_path / "second" / "workdir" / "model" / arch / multiarch.daemon) == tree(model)
+    assert tree(tmp_path / "second" / "image") == tree(tmp_path / "first" / "image")
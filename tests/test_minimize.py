@@ -0,0 +1,21 @@
+import os
+
+
+def test_rebuild_after_minimize(synthetic, tmp_path):
+    """
+    A file the minimizer turned into a link is placed again when the
+    file it pointed at leaves the model
+    """
+    run_dir = str(tmp_path)
+    model = tmp_path / "workdir" / "model" / synthetic.daemon
+
+    synthetic.build(run_dir, "--extra-files", "/etc/benchd/a.conf", "--extra-files", "/etc/benchd/b.conf",
+                    "--minimize")
+    assert (model / "etc" / "benchd" / "b.conf").is_symlink() or (model / "etc" / "benchd" / "a.conf").is_symlink()
+
+    for _ in range(2):
+        synthetic.build(run_dir, "--extra-files", "/etc/benchd/b.conf")
+        conf = model / "etc" / "benchd" / "b.conf"
+        assert not (model / "etc" / "benchd" / "a.conf").exists()
+        assert not conf.is_symlink()
+        assert conf.read_bytes() == b"# benchd defaults\n"
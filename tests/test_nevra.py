@@ -0,0 +1,85 @@
+import functools
+import itertools
+
+import pytest
+
+import nevra
+
+# (a, b, rpmvercmp(a, b)) from rpm's own rpmvercmp test cases
+cases = [
+    ("1.0", "1.0", 0),
+    ("1.0", "2.0", -1),
+    ("2.0.1", "2.0", 1),
+    ("2.0.1a", "2.0.1", 1),
+    ("1.0a", "1.0.1", -1),
+    ("5.5p1", "5.5p2", -1),
+    ("5.5p10", "5.5p1", 1),
+    ("10xyz", "10.1xyz", -1),
+    ("xyz10", "xyz10.1", -1),
+    ("xyz.4", "8", -1),
+    ("xyz.4", "2", -1),
+    ("5.6p1", "6.5p1", -1),
+    ("6.0.rc1", "6.0", 1),
+    ("10b2", "10a1", 1),
+    ("1.0a", "1.0aa", -1),
+    ("1.01", "1.1", 0),
+    ("10.0001", "10.1", 0),
+    ("10.0001", "10.0039", -1),
+    ("4.999.9", "5.0", -1),
+    ("20101121", "20101122", -1),
+    ("2.0", "2_0", 0),
+    ("+a", "_a", 0),
+    ("1.0~rc1", "1.0", -1),
+    ("1.0~rc1", "1.0~rc2", -1),
+    ("1.0~rc1~git123", "1.0~rc1", -1),
+    ("1.0^", "1.0", 1),
+    ("1.0^git1", "1.0", 1),
+    ("1.0^git1", "1.0^git2", -1),
+    ("1.0^git1", "1.01", -1),
+    ("1.0^git1", "1.0.1", -1),
+    ("1.0^20160101^git1", "1.0^20160101", 1),
+    ("1.0~rc1^git1", "1.0~rc1", 1),
+    ("1.0^git1~pre", "1.0^git1", -1),
+]
+
+
+def sign(n):
+    return (n > 0) - (n < 0)
+
+
+@pytest.mark.parametrize("a, b, expected", cases)
+def test_rpmvercmp(a, b, expected):
+    assert nevra.rpmvercmp(a, b) == expected
+    assert nevra.rpmvercmp(b, a) == -expected
+
+
+@pytest.mark.parametrize("a, b, expected", cases)
+def test_version_key_agrees_with_rpmvercmp(a, b, expected):
+    (ka, kb) = (nevra.version_key(a), nevra.version_key(b))
+    assert sign((ka > kb) - (ka < kb)) == expected
+
+
+def test_sorting_by_key_matches_pairwise_order():
+    versions = sorted({v for (a, b, expected) in cases for v in (a, b)})
+    by_key = sorted(versions, key=nevra.version_key)
+    pairwise = sorted(versions, key=functools.cmp_to_key(nevra.rpmvercmp))
+    assert [nevra.version_key(v) for v in by_key] == [nevra.version_key(v) for v in pairwise]
+    for (a, b) in itertools.combinations(by_key, 2):
+        assert nevra.rpmvercmp(a, b) <= 0
+
+
+def test_epoch_beats_version():
+    old = nevra.Nevra.parse("pkg-9.9-1.fc40.x86_64")
+    new = nevra.Nevra.parse("pkg-1:1.0-1.fc40.x86_64")
+    assert (new.epoch, old.epoch) == (1, 0)
+    assert old < new
+    assert nevra._pairwise(new, old) == 1
+    assert nevra.Nevra.parse("1:pkg-1.0-1.fc40.x86_64").key == new.key
+
+
+def test_parse():
+    n = nevra.Nevra.parse("glibc-2.39-17.fc40.x86_64")
+    assert (n.name, n.epoch, n.version, n.release, n.arch, n.distro) == \
+        ("glibc", 0, "2.39", "17.fc40", "x86_64", "fc40")
+    assert str(n) == "glibc-2.39-17.fc40.x86_64"
+    assert nevra.Nevra.parse("not-a-package") is None
@@ -0,0 +1,66 @@
+import argparse
+import json
+import os
+
+import ocilayout
+
+
+def settings():
+    parser = argparse.ArgumentParser()
+    ocilayout.add_image_arguments(parser)
+    return ocilayout.image_settings(parser.parse_args(["--cmd", "/usr/sbin/daemon", "--mkdir", "/var/lib/daemon"]))
+
+
+def model_tree(root, mtime):
+    (root / "usr" / "sbin").mkdir(parents=True)
+    (root / "usr" / "sbin" / "daemon").write_bytes(b"\x7fELF daemon")
+    (root / "usr" / "sbin" / "daemon").chmod(0o755)
+    (root / "etc").mkdir()
+    (root / "etc" / "daemon.conf").write_text("# daemon\n")
+    os.symlink("usr/sbin", root / "sbin")
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        for name in dirnames + filenames:
+            os.utime(os.path.join(dirpath, name), (mtime, mtime), follow_symlinks=False)
+
+
+def layout_files(root):
+    files = {}
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        for name in filenames:
+            with open(os.path.join(dirpath, name), "rb") as f:
+                files[os.path.relpath(os.path.join(dirpath, name), root)] = f.read()
+    return files
+
+
+def test_same_tree_gives_identical_layout(tmp_path):
+    """
+    Two trees with the same files but different times and directories
+    give byte-identical layouts
+    """
+    for (n, mtime) in ((1, 1000000000), (2, 1700000000)):
+        model_tree(tmp_path / f"tree{n}", mtime)
+        ocilayout.write_image(str(tmp_path / f"layout{n}"), str(tmp_path / f"tree{n}"), "daemon:latest", settings())
+
+    first = layout_files(tmp_path / "layout1")
+    assert set(first) >= {"oci-layout", "index.json"}
+    assert layout_files(tmp_path / "layout2") == first
+
+
+def test_name_keeps_entries_without_annotations(tmp_path):
+    """
+    index.json may hold manifests with no annotations; naming another
+    one keeps them
+    """
+    model_tree(tmp_path / "tree", 0)
+    layout = ocilayout.ImageLayout(str(tmp_path / "layout"))
+    unnamed = {'mediaType': ocilayout.MEDIA_TYPE_MANIFEST, 'digest': "sha256:" + "0" * 64, 'size': 1}
+    with open(tmp_path / "layout" / "index.json", "w") as f:
+        json.dump({'schemaVersion': 2, 'manifests': [unnamed]}, f)
+
+    descriptor = ocilayout.write_image(str(tmp_path / "layout"), str(tmp_path / "tree"), "daemon:latest", settings())
+
+    with open(tmp_path / "layout" / "index.json") as f:
+        manifests = json.load(f)['manifests']
+    assert manifests[0] == unnamed
+    assert manifests[1]['digest'] == descriptor['digest']
+    assert manifests[1]['annotations'] == {ocilayout.ANNOTATION_REF_NAME: "daemon:latest"}
@@ -0,0 +1,33 @@
+import os
+
+
+def tree(root):
+    """
+    Every entry under root, by relative path: the target of a symlink,
+    else the mode and content of a file
+    """
+    entries = {}
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                entries[os.path.relpath(path, root)] = os.readlink(path)
+            elif os.path.isfile(path):
+                with open(path, "rb") as f:
+                    entries[os.path.relpath(path, root)] = (os.stat(path).st_mode, f.read())
+    return entries
+
+
+def test_pipeline_builds_the_same_tree(synthetic, tmp_path):
+    """
+    A pipelined build places the same files as one that runs each stage
+    for every library in turn
+    """
+    synthetic.build(str(tmp_path / "phased"))
+    result = synthetic.build(str(tmp_path / "pipelined"), "--verbose", "--pipeline", "--stage-workers", "fetch=2")
+    assert "pipeline stages:" in result.stdout
+
+    phased = tree(tmp_path / "phased" / "workdir" / "model" / synthetic.daemon)
+    assert "usr/sbin/benchd" in phased
+    assert "usr/lib64/libbench5.so.1.0" in phased
+    assert tree(tmp_path / "pipelined" / "workdir" / "model" / synthetic.daemon) == phased
@@ -0,0 +1,42 @@
+import os
+
+import yaml
+
+packages = [f"{name}-1.0-1.bench.x86_64.rpm" for name in
+            ["bench-daemon"] + [f"bench-lib{n}" for n in range(6)] + ["bench-loader"]]
+
+
+def rpms(root):
+    return sorted(name for (dirpath, dirnames, filenames) in os.walk(root) for name in filenames
+                  if name.endswith(".rpm"))
+
+
+def test_plan_downloads_nothing(synthetic, tmp_path):
+    """
+    --plan reports the daemon package and the providers of its libraries
+    with their sizes, found with a fixed number of dnf queries, and
+    fetches none of them
+    """
+    run_dir = str(tmp_path)
+    synthetic.dnf_calls()
+    [report] = yaml.safe_load_all(synthetic.build(run_dir, "--plan").stdout)
+    assert rpms(run_dir) == []
+
+    assert report['arch'] == os.uname().machine
+    assert [entry['rpm'] for entry in report['packages']] == packages
+    assert all(entry['size'] > 0 and not entry['present'] for entry in report['packages'])
+    assert report['unresolved'] == []
+    total = sum(entry['size'] for entry in report['packages'])
+    assert report['planned'] == {'packages': 8, 'bytes': total, 'download': total}
+    assert report['closure'] == {'packages': 8, 'bytes': total, 'skipped': []}
+
+    # the URLs of all the providers are found at once
+    downloads = [call for call in synthetic.dnf_calls() if "download" in call]
+    assert [call[-1] for call in downloads] == ["bench-daemon", "bench-loader", "bench-daemon"]
+
+    # after a build everything is there and nothing is left to download
+    synthetic.build(run_dir)
+    assert rpms(os.path.join(run_dir, "workdir", "packages")) == packages
+    [report] = yaml.safe_load_all(synthetic.build(run_dir, "--plan").stdout)
+    assert all(entry['present'] for entry in report['packages'])
+    assert report['planned'] == {'packages': 8, 'bytes': total, 'download': 0}
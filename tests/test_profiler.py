@@ -0,0 +1,84 @@
+import json
+import threading
+
+import profiler
+
+
+def test_counts_go_to_every_open_span():
+    p = profiler.Profiler()
+    with p.span("build"):
+        with p.span("retrieve", item="a"):
+            p.count("bytes_downloaded", 100)
+            # work handed to another thread counts toward the spans that asked for it
+            context = p.context()
+
+            def download():
+                with p.attach(context), p.span("download", item="a"):
+                    p.count("bytes_downloaded", 50)
+                    p.count("subprocesses")
+
+            thread = threading.Thread(target=download)
+            thread.start()
+            thread.join()
+        p.count("bytes_written", 7)
+
+    summary = p.summary()
+    assert summary['counters'] == {'subprocesses': 1, 'bytes_downloaded': 150, 'bytes_written': 7}
+    spans = summary['spans']
+    assert (spans['build']['bytes_downloaded'], spans['build']['bytes_written']) == (150, 7)
+    assert (spans['retrieve']['bytes_downloaded'], spans['retrieve']['subprocesses']) == (150, 1)
+    assert (spans['download']['bytes_downloaded'], spans['download']['bytes_written']) == (50, 0)
+    assert spans['build']['total'] >= spans['retrieve']['total'] >= spans['download']['total']
+
+    # the download ran inside the retrieve of the same item on another
+    # thread, so it is not counted toward the item twice
+    item = summary['items']['a']
+    assert set(item['spans']) == {"retrieve", "download"}
+    assert item['total'] == item['spans']['retrieve']
+
+
+def test_trace_events():
+    p = profiler.Profiler()
+    with p.span("outer", command="dnf"):
+        with p.span("inner", item="x"):
+            p.count("subprocesses")
+    events = p.trace()['traceEvents']
+    assert [e['name'] for e in events] == ["outer", "inner"]
+    assert all(e['ph'] == "X" and e['dur'] >= 0 for e in events)
+    assert events[0]['ts'] <= events[1]['ts']
+    assert events[0]['args'] == {'command': "dnf", 'subprocesses': 1}
+    assert events[1]['args'] == {'subprocesses': 1, 'item': "x"}
+
+
+def test_helpers_do_nothing_until_enabled(monkeypatch):
+    monkeypatch.setattr(profiler, "_active", None)
+
+    @profiler.traced("traced")
+    def work():
+        profiler.count("subprocesses")
+        return 1
+
+    assert work() == 1
+    assert profiler.context() is None
+    with profiler.span("nothing"), profiler.attach(None):
+        pass
+    assert profiler.active() is None
+
+
+def test_profile_of_a_build(synthetic, tmp_path):
+    synthetic.dnf_calls()
+    synthetic.build(str(tmp_path), "--profile", "profile")
+    calls = synthetic.dnf_calls()
+
+    with open(tmp_path / "profile.json") as f:
+        summary = json.load(f)
+    assert summary['counters']['subprocesses'] == len(calls)
+    assert summary['counters']['bytes_downloaded'] > 0
+    assert summary['spans']['dnf']['count'] == len(calls)
+    assert summary['spans']['Package.retrieve_all']['bytes_downloaded'] == summary['counters']['bytes_downloaded']
+    assert {"retrieve", "model"} <= set(summary['spans'])
+    assert "bench-lib5" in summary['items']
+
+    with open(tmp_path / "profile.trace.json") as f:
+        trace = json.load(f)
+    assert len(trace['traceEvents']) == sum(entry['count'] for entry in summary['spans'].values())
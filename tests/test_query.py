@@ -0,0 +1,21 @@
+import subprocess
+
+import pytest
+
+import metacache
+
+
+def test_cached_failure_still_fails_checked_query(model_tree, tmp_path, monkeypatch):
+    """
+    A failed query that printed something is cached with its exit status
+    """
+    monkeypatch.setattr(model_tree.Package, "cache", metacache.MetadataCache(str(tmp_path / "cache.sqlite")))
+    command = ["sh", "-c", "echo partial; exit 1"]
+
+    assert model_tree.Package.query(command) == "partial\n"
+    with pytest.raises(subprocess.CalledProcessError):
+        model_tree.Package.query(command, check=True)
+    assert model_tree.Package.cache.stats == {'hits': 1, 'misses': 1}
+
+    assert model_tree.Package.query(["sh", "-c", "echo fine"], check=True) == "fine\n"
+    assert model_tree.Package.query(["sh", "-c", "echo fine"], check=True) == "fine\n"
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import repodata
+
+
+@pytest.fixture(params=[None, 2], ids=["one-run", "merged-runs"])
+def index(synthetic, tmp_path, monkeypatch, request):
+    """
+    The synthetic repo indexed with the keys sorted in memory, and with
+    runs of two keys merged from disk
+    """
+    request.param is not None and monkeypatch.setattr(repodata, "sort_run_size", request.param)
+    path = str(tmp_path / "repo.idx")
+    repodata.build_index([repodata.Repository(synthetic.url, workdir=str(tmp_path / "cache"))], path)
+    index = repodata.RepoIndex(path, arch="x86_64")
+    yield index
+    index.close()
+
+
+def names(packages):
+    return [pkg['name'] for pkg in packages]
+
+
+def test_lookup_by_name(index):
+    assert len(index) == 8
+    # the first and last keys of the sorted table
+    assert names(index.by_name("bench-daemon")) == ["bench-daemon"]
+    assert names(index.by_name("bench-loader")) == ["bench-loader"]
+    assert names(index.by_name("bench-lib3")) == ["bench-lib3"]
+    assert index.by_name("bench-absent") == []
+    assert index.by_name("a") == []
+    assert index.by_name("zzz") == []
+
+
+def test_lookup_by_capability(index):
+    assert names(index.whatprovides("ld-linux-x86-64.so.2()(64bit)")) == ["bench-loader"]
+    assert names(index.whatprovides("libbench5.so.1()(64bit)")) == ["bench-lib5"]
+    assert index.whatprovides("libbench6.so.1()(64bit)") == []
+
+
+def test_lookup_by_file(index):
+    # libraries 0 and 1 are packaged under /lib64
+    assert names(index.whatprovides("/lib64/libbench0.so.1")) == ["bench-lib0"]
+    assert names(index.whatprovides_file("/usr/sbin/benchd")) == ["bench-daemon"]
+    assert names(index.whatprovides("/usr/lib64/libbench5.so.1.0")) == ["bench-lib5"]
+    assert index.whatprovides("/usr/lib64/libbench0.so.1") == []
+    # /etc is outside the default path filter
+    assert index.whatprovides("/etc/benchd.conf") == []
+
+
+def test_records(index):
+    [daemon] = index.by_name("bench-daemon")
+    assert daemon['nevra'] == "bench-daemon-1.0-1.bench.x86_64"
+    assert index.url(daemon).endswith("/Packages/bench-daemon-1.0-1.bench.x86_64.rpm")
+    assert daemon['checksum_type'] == "sha256"
+    closure = names(index.closure(daemon))
+    assert closure[0] == "bench-daemon"
+    assert sorted(closure[1:]) == sorted(["bench-loader"] + [f"bench-lib{n}" for n in range(6)])
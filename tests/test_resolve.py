@@ -0,0 +1,26 @@
+import os
+
+
+def test_one_provides_query(synthetic, tmp_path):
+    """
+    Every library is looked up with a single dnf provides, including the
+    ones packaged under /lib64
+    """
+    synthetic.dnf_calls()
+    synthetic.build(str(tmp_path))
+
+    calls = synthetic.dnf_calls()
+    provides = [call for call in calls if "provides" in call]
+    assert len(provides) == 1
+    # the daemon package by name, then the provides and the URLs of every
+    # library package and the loader at once
+    assert len(calls) == 3, calls
+
+    names = set(provides[0])
+    for n in range(6):
+        assert f"/usr/lib64/libbench{n}.so.1" in names
+        assert f"/lib64/libbench{n}.so.1" in names
+
+    model = tmp_path / "workdir" / "model" / synthetic.daemon
+    assert (model / "lib64" / "libbench0.so.1").exists()
+    assert (model / "usr" / "lib64" / "libbench5.so.1").exists()
@@ -0,0 +1,40 @@
+import bz2
+import gzip
+import lzma
+
+import pytest
+
+import rpmfile
+import synthrepo
+
+
+def test_extract_refuses_to_write_through_symlinks(tmp_path):
+    """
+    A payload cannot place a file outside destdir through a symlink it
+    placed first
+    """
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    rpm_path = str(tmp_path / "escape-1.0-1.x86_64.rpm")
+    synthrepo.write_rpm(rpm_path, "escape", "1.0", "1", "x86_64", [
+        ("/dir", 0o120777, str(outside)),
+        ("/dir/x", 0o100644, b"x"),
+    ])
+
+    with pytest.raises(rpmfile.RpmError):
+        rpmfile.RpmFile(rpm_path).extract(str(tmp_path / "root"))
+    assert not (outside / "x").exists()
+
+
+@pytest.mark.parametrize("compressor, module", [("gzip", gzip), ("xz", lzma), ("bzip2", bz2)])
+def test_decompress_closes_the_file(tmp_path, compressor, module):
+    """
+    Closing a decompressing reader closes the file it reads from
+    """
+    path = tmp_path / "data"
+    path.write_bytes(module.compress(b"payload"))
+
+    f = open(path, "rb")
+    with rpmfile.decompress(f, compressor) as stream:
+        assert stream.read() == b"payload"
+    assert f.closed
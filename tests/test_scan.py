@@ -0,0 +1,79 @@
+import os
+import struct
+
+import pytest
+
+import elffile
+import synthrepo
+
+loader = "/lib64/ld-linux-x86-64.so.2"
+
+
+def exec_type(data):
+    # ET_EXEC: linked at a fixed address, not position independent
+    return data[:16] + struct.pack("<H", 2) + data[18:]
+
+
+@pytest.fixture
+def root(tmp_path):
+    """
+    A package tree with one file of each kind, and files the scanner
+    must pass over
+    """
+    files = {
+        "/usr/sbin/daemon": (0o755, exec_type(synthrepo.stub_elf(["liba.so.1"], interp=loader))),
+        "/usr/libexec/daemon": (0o755, synthrepo.stub_elf(["liba.so.1"], interp=loader)),
+        "/usr/bin/tool": (0o711, synthrepo.stub_elf(interp=loader)),
+        "/usr/bin/static": (0o755, exec_type(synthrepo.stub_elf())),
+        "/usr/lib64/liba.so.1.0": (0o755, synthrepo.stub_elf(soname="liba.so.1")),
+        "/usr/bin/script": (0o755, b"#!/bin/sh\nexec /usr/sbin/daemon\n"),
+        # not executable, not ELF or cut short
+        "/usr/lib64/libb.so.1.0": (0o644, synthrepo.stub_elf(soname="libb.so.1")),
+        "/usr/share/data.bin": (0o755, b"\0" * 128),
+        "/usr/bin/cut": (0o755, synthrepo.stub_elf(interp=loader)[:40]),
+    }
+    for (path, (mode, data)) in files.items():
+        local = tmp_path / path.lstrip("/")
+        local.parent.mkdir(parents=True, exist_ok=True)
+        local.write_bytes(data)
+        local.chmod(mode)
+    # links are not followed or reported
+    os.symlink("daemon", tmp_path / "usr/sbin/daemon-link")
+    os.symlink("../sbin", tmp_path / "usr/bin/sbin")
+    return str(tmp_path)
+
+
+expected = {
+    "/usr/bin/script": elffile.SCRIPT,
+    "/usr/bin/static": elffile.STATIC,
+    "/usr/bin/tool": elffile.PIE,
+    "/usr/lib64/liba.so.1.0": elffile.SHARED,
+    "/usr/libexec/daemon": elffile.PIE,
+    "/usr/sbin/daemon": elffile.DYNAMIC,
+}
+
+
+def test_scan_classifies_executables(root):
+    assert elffile.scan(root) == expected
+    assert list(elffile.scan(root)) == sorted(expected)
+    assert elffile.classify(os.path.join(root, "usr/lib64/libb.so.1.0")) == elffile.SHARED
+
+
+def test_scan_with_workers(root, monkeypatch):
+    monkeypatch.setattr(elffile, "parallel_threshold", 0)
+    assert elffile.scan(root, workers=4) == expected
+    assert elffile.scan(root + "/", workers=4) == expected
+
+
+def test_find_keeps_only_dynamic_executables(root, model_tree):
+    DynamicExecutable = model_tree.DynamicExecutable
+    executables = DynamicExecutable.find(root, package="pkg", arch="aarch64")
+    assert sorted(executables) == ["/usr/bin/tool", "/usr/libexec/daemon", "/usr/sbin/daemon"]
+    assert [(exe.name, exe.kind, exe.arch) for exe in executables.values()] == [
+        ("tool", elffile.PIE, "aarch64"), ("daemon", elffile.PIE, "aarch64"), ("daemon", elffile.DYNAMIC, "aarch64")]
+
+    assert DynamicExecutable.select(executables, "tool").path == "/usr/bin/tool"
+    assert DynamicExecutable.select(executables, "/usr/sbin/daemon").kind == elffile.DYNAMIC
+    assert DynamicExecutable.select(executables, "script") is None
+    with pytest.raises(ValueError, match="several executables"):
+        DynamicExecutable.select(executables, "daemon")
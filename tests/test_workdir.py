@@ -0,0 +1,38 @@
+import hashlib
+import os
+
+import workdir
+
+
+def test_unmarked_file_without_checksum_is_fetched_again(tmp_path):
+    """
+    A file left by a build that did not finish is not trusted when there
+    is no checksum to check it against
+    """
+    path = str(tmp_path / "a-1.0-1.x86_64.rpm")
+    with open(path, "wb") as f:
+        f.write(b"half")
+    fetched = []
+
+    def fetch(wanted):
+        # like Package._fetch, files that are there are not fetched
+        for name in wanted:
+            if os.path.exists(name):
+                continue
+            fetched.append(name)
+            with open(name, "wb") as f:
+                f.write(b"whole")
+
+    workdirs = workdir.Workdirs()
+    try:
+        workdirs.get(str(tmp_path)).fetch({path: ("http://example.invalid/a.rpm", None)}, fetch)
+        assert fetched == [path]
+        assert open(path, "rb").read() == b"whole"
+        assert workdirs.get(str(tmp_path)).marker("a-1.0-1.x86_64.rpm")['sha256'] == \
+            hashlib.sha256(b"whole").hexdigest()
+
+        # once it is marked complete it is used as it is
+        workdirs.get(str(tmp_path)).fetch({path: ("http://example.invalid/a.rpm", None)}, fetch)
+        assert fetched == [path]
+    finally:
+        workdirs.close()